@@ -0,0 +1,94 @@
+import json
+import sqlite3
+import threading
+import time
+
+#### DISK CACHE ####
+### sqlite-backed key/value cache with per-entry TTL and size-bounded LRU eviction,
+### values are stored as JSON so anything the API returns can be cached as is
+class DiskCache:
+    def __init__(self, path: str, table: str = "cache", ttl: float = None, max_entries: int = None):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                           "(key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)")
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table} (accessed)")
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_created ON {table} (created)")
+        self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def __contains__(self, key) -> bool:
+        return str(key) in self.get_many([key])
+
+    def _fresh(self, created: float, now: float) -> bool:
+        return self.ttl is None or now - created <= self.ttl
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(str(key), default)
+
+    def get_many(self, keys) -> dict:
+        keys = [str(k) for k in keys]
+        now = time.time()
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, value, created FROM {self.table} WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, value, created in rows:
+                    if self._fresh(created, now):
+                        found[key] = json.loads(value)
+            if found:
+                self._conn.executemany(f"UPDATE {self.table} SET accessed = ? WHERE key = ?",
+                                       [(now, k) for k in found])
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items: dict):
+        now = time.time()
+        rows = [(str(k), json.dumps(v), now, now) for k, v in items.items()]
+        with self._lock:
+            self._conn.executemany(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)", rows)
+            self._evict()
+            self._conn.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (str(key),))
+            self._conn.commit()
+
+    def _evict(self):
+        if self.ttl is not None:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE created < ?", (time.time() - self.ttl,))
+        if self.max_entries is not None:
+            count = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    f"DELETE FROM {self.table} WHERE key IN "
+                    f"(SELECT key FROM {self.table} ORDER BY accessed ASC LIMIT ?)", (count - self.max_entries,)
+                )
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"entries": len(self), "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
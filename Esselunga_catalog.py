@@ -0,0 +1,144 @@
+import threading
+import numpy as np
+
+### fields of extract_product_info that change from store to store,
+### everything else is the same for a given product id across the whole chain
+VOLATILE_FIELDS = ("price", "disc_price", "promo", "oos", "quantity")
+
+
+def toFloat(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+#### CATALOG ####
+### static product fields are stored once per product id (self.static[idx]),
+### each store only keeps aligned arrays of product indexes and volatile values
+class ProductCatalog:
+    def __init__(self):
+        self.static = []
+        self.index = {}
+        self.stores = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.static)
+
+    def _productIndex(self, fields: dict) -> int:
+        product_id = fields.get("id")
+        idx = self.index.get(product_id)
+        if idx is None:
+            idx = len(self.static)
+            self.index[product_id] = idx
+            self.static.append({k: v for k, v in fields.items() if k not in VOLATILE_FIELDS})
+        return idx
+
+    def add_store(self, store_id, products_extracted: dict, row_count: int = None):
+        ### row_count: facet rowCount of the store, when known
+        with self._lock:
+            idx = np.fromiter((self._productIndex(fields) for fields in products_extracted.values()),
+                              dtype=np.int32, count=len(products_extracted))
+        order = np.argsort(idx, kind="stable")
+        values = list(products_extracted.values())
+        values = [values[i] for i in order]
+        promo = {}
+        for i, fields in enumerate(values):
+            if fields.get("promo"):
+                promo[i] = fields.get("promo")
+        store = {
+            "idx": idx[order],
+            "price": np.array([toFloat(f.get("price")) for f in values], dtype=np.float64),
+            "disc_price": np.array([toFloat(f.get("disc_price")) for f in values], dtype=np.float64),
+            "oos": np.array([bool(f.get("oos")) for f in values], dtype=bool),
+            "quantity": np.array([toFloat(f.get("quantity")) for f in values], dtype=np.float64),
+            "promo": promo,
+            "row_count": row_count
+        }
+        with self._lock:
+            self.stores[store_id] = store
+
+    ## store_id shares source_id's arrays (stores sharing a price list, see Esselunga_pricelists)
+    def link_store(self, store_id, source_id):
+        with self._lock:
+            self.stores[store_id] = self.stores[source_id]
+
+    def _volatile(self, store: dict, i: int) -> dict:
+        return {
+            "price": None if np.isnan(store["price"][i]) else float(store["price"][i]),
+            "disc_price": None if np.isnan(store["disc_price"][i]) else float(store["disc_price"][i]),
+            "promo": store["promo"].get(i, {}),
+            "oos": bool(store["oos"][i]),
+            "quantity": None if np.isnan(store["quantity"][i]) else float(store["quantity"][i])
+        }
+
+    def _position(self, store: dict, product_id) -> int:
+        idx = self.index.get(product_id)
+        if idx is None:
+            return -1
+        pos = int(np.searchsorted(store["idx"], idx))
+        if pos < len(store["idx"]) and store["idx"][pos] == idx:
+            return pos
+        return -1
+
+    ## static fields of a product
+    def product(self, product_id) -> dict:
+        idx = self.index.get(product_id)
+        return None if idx is None else self.static[idx]
+
+    ## full product dict (same shape as extract_product_info) for one store
+    def get(self, store_id, product_id) -> dict:
+        store = self.stores.get(store_id)
+        if store is None:
+            return None
+        pos = self._position(store, product_id)
+        if pos < 0:
+            return None
+        return {**self.static[store["idx"][pos]], **self._volatile(store, pos)}
+
+    ## rebuild the extract_product_info view of a store on demand
+    def store_products(self, store_id) -> dict:
+        store = self.stores.get(store_id)
+        if store is None:
+            return {}
+        products = {}
+        for pos, idx in enumerate(store["idx"]):
+            fields = {**self.static[idx], **self._volatile(store, pos)}
+            products[fields.get("id")] = fields
+        return products
+
+    ## volatile fields of a product in every store that sells it
+    def product_stores(self, product_id) -> dict:
+        result = {}
+        for store_id, store in self.stores.items():
+            pos = self._position(store, product_id)
+            if pos >= 0:
+                result[store_id] = self._volatile(store, pos)
+        return result
+
+    ## dense (products x stores) matrix of a volatile numeric field, NaN where not sold
+    def price_matrix(self, store_ids: list = None, field: str = "price"):
+        store_ids = list(self.stores.keys()) if store_ids is None else list(store_ids)
+        matrix = np.full((len(self.static), len(store_ids)), np.nan)
+        for j, store_id in enumerate(store_ids):
+            store = self.stores[store_id]
+            matrix[store["idx"], j] = store[field]
+        product_ids = [fields.get("id") for fields in self.static]
+        return product_ids, store_ids, matrix
+
+    ## facet rowCount of each store, the number of priced products where it was not recorded
+    def row_counts(self, store_ids: list) -> np.ndarray:
+        counts = []
+        for store_id in store_ids:
+            store = self.stores[store_id]
+            row_count = store.get("row_count")
+            counts.append(row_count if row_count is not None else int((~np.isnan(store["price"])).sum()))
+        return np.array(counts, dtype=np.float64)
+
+    def nbytes(self) -> int:
+        total = 0
+        # linked stores share arrays, count them once
+        for store in {id(s): s for s in self.stores.values()}.values():
+            total += sum(store[k].nbytes for k in ("idx", "price", "disc_price", "oos", "quantity"))
+        return total
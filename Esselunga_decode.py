@@ -0,0 +1,96 @@
+import json
+import os
+from typing import Any, Optional
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#### PAYLOAD DECODING ####
+### facet pages and product details are decoded once, from the raw body, with the fastest
+### decoder installed: msgspec (schema below), else orjson, else the stdlib json module.
+### With msgspec the schema lists only the fields extract_product_info / parseProductDetails
+### read, everything else in the payload (facets, breadcrumbs, media...) is skipped while
+### parsing. Decoded entities keep dict-style access (.get / []), so the extraction code is
+### the same whatever decoder produced them. ESSELUNGA_JSON=json|orjson|msgspec forces one.
+DECODERS = [name for name, module in (("msgspec", msgspec), ("orjson", orjson)) if module is not None] + ["json"]
+DECODER = os.environ.get("ESSELUNGA_JSON") if os.environ.get("ESSELUNGA_JSON") in DECODERS else DECODERS[0]
+
+
+if msgspec is not None:
+    class Schema(msgspec.Struct):
+        ### dict-style read access on top of the struct fields
+        def get(self, key, default=None):
+            return getattr(self, key) if key in self.__struct_fields__ else default
+
+        def __getitem__(self, key):
+            if key not in self.__struct_fields__:
+                raise KeyError(key)
+            return getattr(self, key)
+
+        def __contains__(self, key) -> bool:
+            return key in self.__struct_fields__
+
+    ## fields read by getProductFields / extract_product_info
+    class FacetEntity(Schema):
+        id: Any = None
+        code: Any = None
+        description: Any = None
+        htmlDescription: Any = None
+        name: Any = None
+        n_portions: Any = None
+        brand: Any = None
+        label: Any = None
+        price: Any = None
+        discountedPrice: Any = None
+        disc_price: Any = None
+        attributes: Any = None
+        values: Any = None
+        txt: Any = None
+        variableWeight: Any = None
+        outOfStock: Any = None
+        productType: Any = None
+        raee: Any = None
+        quantity: Any = None
+        promo: Any = None
+        unit_text: Any = None
+        unit_value: Any = None
+        barcode: Any = None
+        children: Optional[list["FacetEntity"]] = None
+
+    class Displayables(Schema):
+        rowCount: int = 0
+        entities: Optional[list[FacetEntity]] = None
+
+    class FacetResponse(Schema):
+        displayables: Displayables
+
+    ## fields read by parseProductDetails
+    class DetailResponse(Schema):
+        seo: Any = None
+        displayableProduct: Any = None
+        informations: Any = None
+        familyChildren: Any = None
+
+    FACET_DECODER = msgspec.json.Decoder(FacetResponse)
+    DETAIL_DECODER = msgspec.json.Decoder(DetailResponse)
+
+
+def decodeFacet(body, decoder: str = None) -> tuple:
+    ### (rowCount, entities) of a facet page, raises ValueError on a malformed body
+    decoder = decoder or DECODER
+    if decoder == "msgspec":
+        displayables = FACET_DECODER.decode(body).displayables
+        return displayables.rowCount, displayables.entities or []
+    displayables = (orjson.loads(body) if decoder == "orjson" else json.loads(body))["displayables"]
+    return displayables["rowCount"], displayables.get("entities") or []
+
+def decodeDetail(body, decoder: str = None):
+    decoder = decoder or DECODER
+    if decoder == "msgspec":
+        return DETAIL_DECODER.decode(body)
+    return orjson.loads(body) if decoder == "orjson" else json.loads(body)
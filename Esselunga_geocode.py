@@ -0,0 +1,122 @@
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from Esselunga_cache import DiskCache
+
+### batch geocoder for the map: inputs are deduplicated on their normalized string, hits come
+### from a persistent sqlite cache and only misses reach the (rate limited) backend.
+### A backend is any callable location -> (lat, lon), returning (None, None) when not found
+### and raising when the lookup should be retried on a later run (nothing is cached then).
+### Coordinates never expire; "not found" answers go to a second table with a short TTL, so a
+### temporary backend miss is asked again on a later run instead of being kept forever.
+GEOCODE_CACHE_PATH = "geocode.sqlite"
+GEOCODE_MISS_TTL = 24 * 3600
+
+
+def normalizeLocation(location: str) -> str:
+    location = re.sub(r"\s*,\s*", ", ", str(location).lower())
+    return re.sub(r"\s+", " ", location).strip(" ,")
+
+def openGeocodeCache(path: str = GEOCODE_CACHE_PATH) -> DiskCache:
+    return DiskCache(path, table="geocode")
+
+def openGeocodeMissCache(path: str = GEOCODE_CACHE_PATH, ttl: float = GEOCODE_MISS_TTL) -> DiskCache:
+    return DiskCache(path, table="geocode_missing", ttl=ttl)
+
+def notFound(result) -> bool:
+    return result is None or any(v is None for v in result)
+
+
+class NominatimBackend:
+    def __init__(self, user_agent: str = "geoapiExercises", timeout: int = 10, max_retries: int = 3, wait_time: float = 2):
+        from geopy.geocoders import Nominatim
+        from geopy.exc import GeocoderTimedOut
+        self.geolocator = Nominatim(user_agent=user_agent, timeout=timeout)
+        self.timeout_error = GeocoderTimedOut
+        self.max_retries = max_retries
+        self.wait_time = wait_time
+
+    def __call__(self, location: str) -> tuple:
+        for retries in range(self.max_retries):
+            try:
+                loc = self.geolocator.geocode(location)
+                return (loc.latitude, loc.longitude) if loc else (None, None)
+            except self.timeout_error:
+                print(f"Timeout error for location {location}. Retrying ({retries + 1}/{self.max_retries})...")
+                time.sleep(self.wait_time)
+        raise TimeoutError(f"Max retries exceeded for location {location}.")
+
+
+## offline backend for tests/benchmarks: a {location: [lat, lon]} JSON file or dict
+class FixtureBackend:
+    def __init__(self, fixture):
+        if isinstance(fixture, str):
+            with open(fixture, "r", encoding="utf-8") as file:
+                fixture = json.load(file)
+        self.locations = {normalizeLocation(k): tuple(v) for k, v in fixture.items()}
+        self.calls = 0
+
+    def __call__(self, location: str) -> tuple:
+        self.calls += 1
+        return self.locations.get(normalizeLocation(location), (None, None))
+
+
+class RateLimiter:
+    def __init__(self, min_interval: float = 1.0):
+        self.min_interval = min_interval
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.min_interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def geocodeBatch(locations, backend=None, cache: DiskCache = None, min_interval: float = 1.0,
+                 max_workers: int = 1, flush_every: int = 50, miss_cache: DiskCache = None) -> dict:
+    backend = backend or NominatimBackend()
+    cache = cache if cache is not None else openGeocodeCache()
+    miss_cache = miss_cache if miss_cache is not None else openGeocodeMissCache(cache.path)
+    keys = {location: normalizeLocation(location) for location in locations}
+    unique = list(dict.fromkeys(keys.values()))
+    found = {k: tuple(v) for k, v in cache.get_many(unique).items()}
+    for k in [k for k, v in found.items() if notFound(v)]:
+        # "not found" written by older runs, without expiry
+        cache.delete(k)
+        del found[k]
+    found.update({k: (None, None) for k in miss_cache.get_many([k for k in unique if k not in found])})
+    misses = [k for k in unique if k not in found]
+    print("geocoding: {} inputs, {} distinct, {} cached, {} to fetch".format(len(keys), len(unique), len(found), len(misses)))
+    limiter = RateLimiter(min_interval)
+    fetched = {}
+    lock = threading.Lock()
+
+    def flush():
+        cache.set_many({k: v for k, v in fetched.items() if not notFound(v)})
+        miss_cache.set_many({k: v for k, v in fetched.items() if notFound(v)})
+        found.update(fetched)
+        fetched.clear()
+
+    def lookup(key: str):
+        limiter.wait()
+        try:
+            result = tuple(backend(key))
+        except Exception as e:
+            print(f"Geocoding failed for {key}: {e}")
+            return
+        with lock:
+            fetched[key] = result
+            if len(fetched) >= flush_every:
+                flush()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lookup, misses))
+    flush()
+    print("geocode cache: {}".format(cache.stats()))
+    return {location: found.get(key, (None, None)) for location, key in keys.items()}
@@ -0,0 +1,309 @@
+import argparse
+import os
+import sqlite3
+import threading
+from datetime import date as dt_date
+import numpy as np
+import pandas as pd
+from Esselunga_snapshot import productsToFrame, listSnapshotDates, loadSnapshot
+
+#### PRICE HISTORY ####
+### every scrape appends one row per (product, store, day) to a sqlite table clustered on
+### (product, store, day), so "product X in every store over the last 90 days" is a single
+### index range scan instead of reading every dump. Product ids and store ids are mapped to
+### small integers, days are stored as ordinals and prices as integer cents: a row is a
+### handful of varints, which keeps hundreds of millions of rows on one disk and in cache.
+### Catalog-wide aggregates read a per (product, day) rollup instead of every store row; days
+### touched by a write are marked dirty and rolled up again on the next aggregate query.
+### Effective price = discounted price when there is one, else the list price.
+HISTORY_PATH = "price_history.sqlite"
+EFFECTIVE = "COALESCE(disc_cents, price_cents)"
+
+
+def toDay(value) -> int:
+    if value is None:
+        return dt_date.today().toordinal()
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        value = dt_date.fromisoformat(value)
+    return value.toordinal()
+
+def fromDay(day: int) -> str:
+    return dt_date.fromordinal(int(day)).isoformat()
+
+def toCentsArray(values) -> list:
+    values = pd.to_numeric(values, errors="coerce").to_numpy(dtype=np.float64)
+    missing = np.isnan(values)
+    cents = np.rint(np.where(missing, 0, values) * 100).astype(np.int64).tolist()
+    for i in np.flatnonzero(missing):
+        cents[i] = None
+    return cents
+
+
+class PriceHistory:
+    def __init__(self, path: str = HISTORY_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA cache_size=-262144")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS products (pid INTEGER PRIMARY KEY, product_id TEXT UNIQUE, product_code TEXT, name TEXT);
+            CREATE TABLE IF NOT EXISTS stores (sid INTEGER PRIMARY KEY, store TEXT UNIQUE);
+            CREATE TABLE IF NOT EXISTS promo_types (tid INTEGER PRIMARY KEY, promo_type TEXT UNIQUE);
+            CREATE TABLE IF NOT EXISTS prices (
+                pid INTEGER, sid INTEGER, day INTEGER, price_cents INTEGER, disc_cents INTEGER,
+                promo INTEGER, tid INTEGER, oos INTEGER,
+                PRIMARY KEY (pid, sid, day)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS prices_product_day ON prices (pid, day);
+            CREATE INDEX IF NOT EXISTS prices_day ON prices (day);
+            CREATE TABLE IF NOT EXISTS daily (
+                day INTEGER, pid INTEGER, observations INTEGER, priced INTEGER, min_cents INTEGER, max_cents INTEGER,
+                sum_cents INTEGER, promo_days INTEGER,
+                PRIMARY KEY (day, pid)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS dirty_days (day INTEGER PRIMARY KEY);
+        """)
+        self._conn.commit()
+        self.products = dict(self._conn.execute("SELECT product_id, pid FROM products"))
+        self.stores = dict(self._conn.execute("SELECT store, sid FROM stores"))
+        self.promo_types = dict(self._conn.execute("SELECT promo_type, tid FROM promo_types"))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _ids(self, table: str, column: str, mapping: dict, keys, extra: dict = None) -> list:
+        ### dictionary-encode keys, inserting the ones not seen yet
+        new = [k for k in dict.fromkeys(keys) if k not in mapping]
+        if new:
+            if table == "products":
+                rows = [(k, *(extra or {}).get(k, (None, None))) for k in new]
+                self._conn.executemany("INSERT OR IGNORE INTO products (product_id, product_code, name) VALUES (?, ?, ?)", rows)
+            else:
+                self._conn.executemany(f"INSERT OR IGNORE INTO {table} ({column}) VALUES (?)", [(k,) for k in new])
+            id_column = {"products": "pid", "stores": "sid", "promo_types": "tid"}[table]
+            for i in range(0, len(new), 500):
+                chunk = new[i:i + 500]
+                mapping.update(self._conn.execute(
+                    f"SELECT {column}, {id_column} FROM {table} WHERE {column} IN ({','.join('?' * len(chunk))})", chunk))
+        return [mapping[k] for k in keys]
+
+    #### WRITE ####
+    def addFrame(self, frame: pd.DataFrame, store, date=None, commit: bool = True) -> int:
+        ### frame in the productsToFrame / snapshot layout; bulk loads pass commit=False and call commit()
+        if frame.empty:
+            return 0
+        day = toDay(date)
+        product_ids = frame["id"].astype(str).tolist()
+        extra = dict(zip(product_ids, zip(frame["product_code"], frame["name"])))
+        promo_types = [t if isinstance(t, str) else None for t in frame["promo_type"]]
+        with self._lock:
+            pids = self._ids("products", "product_id", self.products, product_ids, extra)
+            sid = self._ids("stores", "store", self.stores, [str(store)])[0]
+            tids = self._ids("promo_types", "promo_type", self.promo_types, [t for t in promo_types if t is not None])
+            tids = iter(tids)
+            rows = list(zip(pids, [sid] * len(pids), [day] * len(pids), toCentsArray(frame["price"]),
+                            toCentsArray(frame["disc_price"]), [int(t is not None) for t in promo_types],
+                            [None if t is None else next(tids) for t in promo_types],
+                            frame["oos"].fillna(False).astype(int).tolist()))
+            self._conn.executemany("INSERT OR REPLACE INTO prices VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._conn.execute("INSERT OR IGNORE INTO dirty_days VALUES (?)", (day,))
+            if commit:
+                self._conn.commit()
+        return len(rows)
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+
+    def refresh(self) -> int:
+        ### roll up the days written since the last refresh, returns how many
+        with self._lock:
+            days = [d for d, in self._conn.execute("SELECT day FROM dirty_days ORDER BY day")]
+            for day in days:
+                self._conn.execute("DELETE FROM daily WHERE day = ?", (day,))
+                self._conn.execute(
+                    f"INSERT INTO daily SELECT day, pid, COUNT(*), COUNT({EFFECTIVE}), MIN({EFFECTIVE}), MAX({EFFECTIVE}), "
+                    f"SUM({EFFECTIVE}), SUM(promo) FROM prices WHERE day = ? GROUP BY pid", (day,))
+                self._conn.execute("DELETE FROM dirty_days WHERE day = ?", (day,))
+            self._conn.commit()
+        return len(days)
+
+    def add(self, products_extracted: dict, store, date=None) -> int:
+        ### extract_product_info output (dicts or ProductRecord) for one store on one day
+        return self.addFrame(productsToFrame(products_extracted), store, date)
+
+    def importSnapshots(self, root: str = "snapshots") -> int:
+        ### backfill from the Parquet snapshots written by Esselunga_snapshot
+        rows = 0
+        for date in listSnapshotDates(root):
+            base = os.path.join(root, f"date={date}")
+            for d in sorted(os.listdir(base)):
+                if d.startswith("store="):
+                    rows += self.addFrame(loadSnapshot(d[len("store="):], date, root), d[len("store="):], date, commit=False)
+            self.commit()
+        return rows
+
+    #### READ ####
+    def _query(self, sql: str, params=()) -> pd.DataFrame:
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            columns = [c[0] for c in cursor.description]
+            return pd.DataFrame(cursor.fetchall(), columns=columns)
+
+    def _range(self, start, end) -> tuple:
+        end = toDay(end)
+        start = toDay(start) if start is not None else end - 89
+        return start, end
+
+    def _prices(self, df: pd.DataFrame) -> pd.DataFrame:
+        for col in ("price", "disc_price", "effective_price"):
+            if col + "_cents" in df:
+                df[col] = df.pop(col + "_cents") / 100
+        if "day" in df:
+            df.insert(0, "date", [fromDay(d) for d in df.pop("day")])
+        return df
+
+    ## one product in one store on one day, None if it was not observed
+    def point(self, product_id, store, date=None) -> dict:
+        pid, sid = self.products.get(str(product_id)), self.stores.get(str(store))
+        if pid is None or sid is None:
+            return None
+        df = self._prices(self._query(
+            f"SELECT day, price_cents, disc_cents AS disc_price_cents, {EFFECTIVE} AS effective_price_cents, promo, oos "
+            "FROM prices WHERE pid = ? AND sid = ? AND day = ?", (pid, sid, toDay(date))))
+        return None if df.empty else df.iloc[0].to_dict()
+
+    ## price of a product over a date range (default: last 90 days), in every store or in one
+    def history(self, product_id, store=None, start=None, end=None) -> pd.DataFrame:
+        pid = self.products.get(str(product_id))
+        start, end = self._range(start, end)
+        sql = (f"SELECT p.day, s.store, p.price_cents, p.disc_cents AS disc_price_cents, {EFFECTIVE} AS effective_price_cents, "
+               "p.promo, t.promo_type, p.oos FROM prices p JOIN stores s ON s.sid = p.sid LEFT JOIN promo_types t ON t.tid = p.tid "
+               "WHERE p.pid = ? AND p.day BETWEEN ? AND ?")
+        params = [pid, start, end]
+        if store is not None:
+            sql += " AND p.sid = ?"
+            params.append(self.stores.get(str(store)))
+        return self._prices(self._query(sql + " ORDER BY p.day, s.store", params))
+
+    ## min/median/max/mean effective price and promo frequency of one product over a date range
+    def priceStats(self, product_id, start=None, end=None, store=None) -> dict:
+        df = self.history(product_id, store, start, end)
+        prices = df["effective_price"].dropna() if not df.empty else pd.Series(dtype=float)
+        return {
+            "product_id": str(product_id),
+            "observations": len(df),
+            "stores": int(df["store"].nunique()) if not df.empty else 0,
+            "min": float(prices.min()) if len(prices) else None,
+            "median": float(prices.median()) if len(prices) else None,
+            "max": float(prices.max()) if len(prices) else None,
+            "mean": float(prices.mean()) if len(prices) else None,
+            "promo_frequency": float(df["promo"].mean()) if not df.empty else None
+        }
+
+    ## stores selling a product cheapest on a day (default: the last day it was observed)
+    def cheapestStore(self, product_id, date=None, n: int = 1, include_oos: bool = False) -> pd.DataFrame:
+        pid = self.products.get(str(product_id))
+        if date is None:
+            with self._lock:
+                day = self._conn.execute("SELECT MAX(day) FROM prices WHERE pid = ?", (pid,)).fetchone()[0]
+            if day is None:
+                return pd.DataFrame(columns=["date", "store", "effective_price", "promo", "oos"])
+        else:
+            day = toDay(date)
+        sql = (f"SELECT p.day, s.store, {EFFECTIVE} AS effective_price_cents, p.promo, p.oos FROM prices p "
+               "JOIN stores s ON s.sid = p.sid WHERE p.pid = ? AND p.day = ? AND effective_price_cents IS NOT NULL")
+        if not include_oos:
+            sql += " AND p.oos = 0"
+        return self._prices(self._query(sql + " ORDER BY effective_price_cents, s.store LIMIT ?", (pid, day, n)))
+
+    def _where(self, start, end, product_ids=None, store=None, table: str = "p") -> tuple:
+        start, end = self._range(start, end)
+        where, params = [f"{table}.day BETWEEN ? AND ?"], [start, end]
+        if product_ids is not None:
+            pids = [self.products[str(p)] for p in product_ids if str(p) in self.products]
+            where.append(f"{table}.pid IN ({','.join('?' * len(pids))})")
+            params += pids
+        if store is not None:
+            where.append(f"{table}.sid = ?")
+            params.append(self.stores.get(str(store)))
+        return " AND ".join(where), params
+
+    ## per product min/max/mean effective price and promo frequency over a date range, from the daily
+    ## rollup; a store filter or with_median (exact, computed in pandas) read the store rows instead
+    def priceSummary(self, start=None, end=None, product_ids=None, store=None, with_median: bool = False) -> pd.DataFrame:
+        if store is None:
+            self.refresh()
+            where, params = self._where(start, end, product_ids, table="d")
+            summary = self._query(
+                "SELECT pr.product_id, pr.name, SUM(d.observations) AS observations, MIN(d.min_cents) AS min_cents, "
+                "MAX(d.max_cents) AS max_cents, 1.0 * SUM(d.sum_cents) / SUM(d.priced) AS mean_cents, "
+                "1.0 * SUM(d.promo_days) / SUM(d.observations) AS promo_frequency "
+                f"FROM daily d JOIN products pr ON pr.pid = d.pid WHERE {where} GROUP BY d.pid ORDER BY pr.product_id", params)
+        else:
+            where, params = self._where(start, end, product_ids, store)
+            summary = self._query(
+                f"SELECT pr.product_id, pr.name, COUNT(*) AS observations, MIN({EFFECTIVE}) AS min_cents, "
+                f"MAX({EFFECTIVE}) AS max_cents, AVG({EFFECTIVE}) AS mean_cents, AVG(p.promo) AS promo_frequency "
+                f"FROM prices p JOIN products pr ON pr.pid = p.pid WHERE {where} GROUP BY p.pid ORDER BY pr.product_id", params)
+        for col in ("min", "max", "mean"):
+            summary[col] = summary.pop(col + "_cents") / 100
+        if with_median:
+            where, params = self._where(start, end, product_ids, store)
+            values = self._query(f"SELECT pr.product_id, {EFFECTIVE} AS cents FROM prices p JOIN products pr ON pr.pid = p.pid "
+                                 f"WHERE {where}", params)
+            median = values.groupby("product_id")["cents"].median() / 100
+            summary["median"] = summary["product_id"].map(median)
+        return summary
+
+    ## share of observations on promo, per product (rollup) or per product and store
+    def promoFrequency(self, start=None, end=None, product_ids=None, by_store: bool = False) -> pd.DataFrame:
+        if not by_store:
+            self.refresh()
+            where, params = self._where(start, end, product_ids, table="d")
+            return self._query(
+                "SELECT pr.product_id, SUM(d.observations) AS observations, SUM(d.promo_days) AS promo_days, "
+                "1.0 * SUM(d.promo_days) / SUM(d.observations) AS promo_frequency FROM daily d JOIN products pr ON pr.pid = d.pid "
+                f"WHERE {where} GROUP BY d.pid ORDER BY promo_frequency DESC, pr.product_id", params)
+        where, params = self._where(start, end, product_ids)
+        return self._query(
+            "SELECT pr.product_id, s.store, COUNT(*) AS observations, SUM(p.promo) AS promo_days, AVG(p.promo) AS promo_frequency "
+            "FROM prices p JOIN products pr ON pr.pid = p.pid JOIN stores s ON s.sid = p.sid "
+            f"WHERE {where} GROUP BY p.pid, p.sid ORDER BY promo_frequency DESC, pr.product_id, s.store", params)
+
+###   python Esselunga_history.py import --snapshots snapshots
+###   python Esselunga_history.py stats <product_id> --start 2026-01-01
+###   python Esselunga_history.py cheapest <product_id> -n 5
+###   python Esselunga_history.py promo --start 2026-01-01
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Price history queries over accumulated scrapes")
+    parser.add_argument("command", choices=["import", "stats", "history", "cheapest", "promo"])
+    parser.add_argument("product_id", nargs="?")
+    parser.add_argument("--db", default=HISTORY_PATH)
+    parser.add_argument("--snapshots", default="snapshots")
+    parser.add_argument("--store")
+    parser.add_argument("--start")
+    parser.add_argument("--end")
+    parser.add_argument("--date")
+    parser.add_argument("-n", type=int, default=10)
+    args = parser.parse_args()
+
+    history = PriceHistory(args.db)
+    pd.set_option("display.width", 200)
+    if args.command == "import":
+        print("imported {} rows".format(history.importSnapshots(args.snapshots)))
+    elif args.command == "stats":
+        print(history.priceStats(args.product_id, args.start, args.end, args.store))
+    elif args.command == "history":
+        print(history.history(args.product_id, args.store, args.start, args.end).to_string(index=False))
+    elif args.command == "cheapest":
+        print(history.cheapestStore(args.product_id, args.date, args.n).to_string(index=False))
+    else:
+        products = [args.product_id] if args.product_id else None
+        print(history.promoFrequency(args.start, args.end, products).head(args.n).to_string(index=False))
+    history.close()
@@ -1,35 +1,23 @@
 import folium
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import time
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
+import os
+from Esselunga_storemap import loadStoreMap
+from Esselunga_geocode import geocodeBatch, openGeocodeCache, NominatimBackend, FixtureBackend
 
 
-# Initialize geocoder
-geolocator = Nominatim(user_agent="geoapiExercises", timeout=10)
+# batch geocoding goes through a persistent cache; set ESSELUNGA_GEOCODE_FIXTURE to a
+# {location: [lat, lon]} JSON file to run offline against recorded coordinates
+if os.environ.get("ESSELUNGA_GEOCODE_FIXTURE"):
+    geocoder_backend = FixtureBackend(os.environ["ESSELUNGA_GEOCODE_FIXTURE"])
+    geocoder_interval = 0.0
+else:
+    geocoder_backend = NominatimBackend(user_agent="geoapiExercises", timeout=10)
+    geocoder_interval = 1.0
 
 # Create a folium map centered on Italy
 italy_map = folium.Map(location=[41.8719, 12.5674], zoom_start=6)
 
-# Function to get latitude and longitude from town + post code
-def get_lat_lon(location, max_retries=3, wait_time=2):
-    retries = 0
-    while retries < max_retries:
-        try:
-            loc = geolocator.geocode(location)
-            if loc:
-                return (loc.latitude, loc.longitude)
-            else:
-                return (None, None)
-        except GeocoderTimedOut:
-            print(f"Timeout error for location {location}. Retrying ({retries + 1}/{max_retries})...")
-            retries += 1
-            time.sleep(wait_time)
-    print(f"Max retries exceeded for location {location}.")
-    return (None, None)
-
 def generate_colors(n):
     cmap = plt.get_cmap('tab20')  # Tab20 has 20 base colors
     return [mcolors.rgb2hex(cmap(i % 20)) for i in range(n)]
@@ -39,45 +27,36 @@ colors_pool = generate_colors(1000)
 
 # Function to determine the marker color based on the id
 
-with open('store_to_map_new.json', 'r') as file:
-    ssmap = json.load(file)
-
-ssmaps = sorted([int(k) for k in ssmap.keys() if int(k) < 1000000])
+# memory-mapped int arrays built from store_to_map_new.json (see Esselunga_storemap.py)
+store_map = loadStoreMap('store_to_map_new.json')
 
-def get_key_by_value(dictionary, target_value):
-    for key, value_list in dictionary.items():
-        if target_value in value_list:
-            return key  # Return the key as soon as we find it
-    return None
+ssmaps = sorted([int(k) for k in store_map.stores if int(k) < 1000000])
 
-def get_marker_color(ssmap, street_id):
-    id = get_key_by_value(ssmap, street_id)
+def get_marker_color(store_map, street_id):
+    id = store_map.store_of(street_id)
     if id is not None:
         return colors_pool[int(id) % 1000]
     else:
         return colors_pool[0]
 
 
-def process_location(entry):
-    location_str = f"{entry['value']}, {entry['town']}, {entry['postCode']}"
-    lat, lon = get_lat_lon(location_str)
+def location_string(entry):
+    return f"{entry['value']}, {entry['town']}, {entry['postCode']}"
+
+
+# Geocode every distinct location once (cache hits are instant), then add markers to the map
+locations = {k: location_string(streets[k]) for k in streets.keys()}
+coordinates = geocodeBatch(locations.values(), backend=geocoder_backend, cache=openGeocodeCache(),
+                           min_interval=geocoder_interval)
+for k, location_str in locations.items():
+    lat, lon = coordinates[location_str]
+    value = streets[k]['value']
     if lat and lon:
-        return (lat, lon, entry['value'])
+        color = get_marker_color(store_map, k)
+        # Add a marker with the specified color
+        folium.Marker([lat, lon], popup=value, icon=folium.Icon(color=color)).add_to(italy_map)
     else:
-        return (None, None, entry['value'])
-
-
-# Loop through the data and add markers to the map
-with ThreadPoolExecutor(max_workers=20) as executor:
-    futures = {executor.submit(process_location, streets[k]): k for k in streets.keys()}
-    for future in as_completed(futures):
-        lat, lon, value = future.result()
-        if lat and lon:
-            color = get_marker_color(ssmap, street_id)
-            # Add a marker with the specified color
-            folium.Marker([lat, lon], popup=value, icon=folium.Icon(color=color)).add_to(italy_map)
-        else:
-            print(f"Location not found for: {value}")
+        print(f"Location not found for: {value}")
 
 
 # Save map to an HTML file
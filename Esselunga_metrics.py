@@ -0,0 +1,216 @@
+import json
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import defaultdict
+from contextlib import contextmanager
+
+### in-process metrics: counters, gauges and latency histograms keyed by (name, labels),
+### dumped per run as Prometheus text and JSON. METRICS is the registry shared by all stages.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+METRIC_PREFIX = "esselunga_"
+
+
+def labelKey(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def endpointLabel(url: str) -> str:
+    ### /commerce/resources/displayable/detail/code/123456 -> /commerce/resources/displayable/detail/code/:id
+    path = re.sub(r"^[a-z]+://[^/]+", "", str(url)).split("?")[0]
+    return re.sub(r"/\d+(?=/|$)", "/:id", path) or "/"
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self) -> list:
+        total, out = 0, []
+        for c in self.counts:
+            total += c
+            out.append(total)
+        return out
+
+    def quantile(self, q: float) -> float:
+        ### upper bound of the bucket holding the q-th observation
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        for bound, total in zip(self.buckets, self.cumulative()):
+            if total >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.gauges = defaultdict(float)
+        self.histograms = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+            self.started = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self.counters[(name, labelKey(labels))] += value
+
+    def gauge(self, name: str, delta: float, **labels):
+        with self._lock:
+            self.gauges[(name, labelKey(labels))] += delta
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, labelKey(labels))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timed(self, stage: str, **labels):
+        ### stage latency histogram + in-flight gauge + error counter around a block
+        self.gauge("stage_in_flight", 1, stage=stage)
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("stage_errors_total", stage=stage, **labels)
+            raise
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - started, stage=stage, **labels)
+            self.gauge("stage_in_flight", -1, stage=stage)
+
+    def observe_request(self, method: str, url: str, status, latency: float, size: int = 0):
+        endpoint = endpointLabel(url)
+        self.inc("http_requests_total", method=method, endpoint=endpoint, status=status)
+        self.inc("http_response_bytes_total", size or 0, endpoint=endpoint)
+        self.observe("http_request_seconds", latency, method=method, endpoint=endpoint)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        fmt = lambda labels: "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+        with self._lock:
+            for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({n for n, _ in series}):
+                    lines.append(f"# TYPE {METRIC_PREFIX}{name} {kind}")
+                    for (n, labels), value in sorted(series.items()):
+                        if n == name:
+                            lines.append(f"{METRIC_PREFIX}{name}{fmt(labels)} {value:.15g}")
+            for name in sorted({n for n, _ in self.histograms}):
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} histogram")
+                for (n, labels), h in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, total in zip(h.buckets, h.cumulative()):
+                        lines.append(f"{METRIC_PREFIX}{name}_bucket{fmt(labels + (('le', f'{bound:g}'),))} {total}")
+                    lines.append(f"{METRIC_PREFIX}{name}_bucket{fmt(labels + (('le', '+Inf'),))} {h.count}")
+                    lines.append(f"{METRIC_PREFIX}{name}_sum{fmt(labels)} {h.sum:.15g}")
+                    lines.append(f"{METRIC_PREFIX}{name}_count{fmt(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "elapsed": time.time() - self.started,
+                "counters": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in sorted(self.counters.items())],
+                "gauges": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in sorted(self.gauges.items())],
+                "histograms": [{"name": n, "labels": dict(l), "count": h.count, "sum": h.sum,
+                                "p50": h.quantile(0.5), "p99": h.quantile(0.99)}
+                               for (n, l), h in sorted(self.histograms.items())]
+            }
+
+    def write_report(self, prefix: str = "metrics") -> tuple:
+        with open(prefix + ".prom", "w") as file:
+            file.write(self.to_prometheus())
+        with open(prefix + ".json", "w") as file:
+            json.dump(self.to_dict(), file, indent=1)
+        return prefix + ".prom", prefix + ".json"
+
+
+METRICS = Metrics()
+
+
+#### HTTP HOOKS ####
+def instrumentSession(session, metrics: Metrics = METRICS):
+    ### requests response hook: every call made through the session is timed and counted
+    def hook(response, *args, **kwargs):
+        metrics.observe_request(response.request.method, response.url, response.status_code,
+                                response.elapsed.total_seconds(), len(response.content or b""))
+    session.hooks.setdefault("response", []).append(hook)
+    return session
+
+def aiohttpTraceConfig(metrics: Metrics = METRICS):
+    import aiohttp
+
+    async def on_request_start(session, context, params):
+        context.started = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        metrics.observe_request(params.method, str(params.url), params.response.status,
+                                time.perf_counter() - context.started, params.response.content_length or 0)
+
+    async def on_request_exception(session, context, params):
+        metrics.observe_request(params.method, str(params.url), "error", time.perf_counter() - context.started)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+#### SAMPLING PROFILER ####
+### optional: samples every thread's stack at a fixed interval and writes collapsed stacks
+### ("frame;frame;frame count" per line), the input format of flamegraph.pl/speedscope
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.stacks = defaultdict(int)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = ";".join(f"{f.name} ({f.filename.split('/')[-1]}:{f.lineno})"
+                                 for f in traceback.extract_stack(frame))
+                self.stacks[stack] += 1
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write(self, path: str = "profile.folded"):
+        with open(path, "w") as file:
+            for stack, count in sorted(self.stacks.items(), key=lambda x: -x[1]):
+                file.write(f"{stack} {count}\n")
+        return path
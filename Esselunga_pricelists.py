@@ -0,0 +1,262 @@
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date as dt_date
+import numpy as np
+from Esselunga_catalog import ProductCatalog
+from Esselunga_metrics import METRICS
+from Esselunga_decode import decodeFacet
+from Esselunga_scraper import (main, logger, get_pooled_session, fetch_first_page, extract_product_info,
+                               storesToScrape, STORE_LIMITER)
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
+#### PRICE LISTS ####
+### most stores share a price list. From a full scrape (a ProductCatalog) every store becomes a
+### sparse row over products; with a second sparse matrix over (product, price) pairs,
+###     same[i, j]   = products priced identically in stores i and j   = F @ F.T
+###     common[i, j] = products sold (and priced) in both              = S @ S.T
+### so the agreement of every pair of stores comes out of two sparse products. Stores are then
+### grouped greedily: the store with the largest assortment leads a cluster and takes every
+### unassigned store agreeing with it on >= AGREEMENT of their common products.
+### The plan is saved to PLAN_PATH; mainClustered scrapes one representative per cluster in
+### full and only spot-checks the first facet page of the other members against it.
+PLAN_PATH = "price_lists.json"
+AGREEMENT = 0.995
+MIN_COMMON = 50
+SPOT_CHECK_SIZE = 99
+SPOT_CHECK_MIN_COMMON = 20
+ROW_TOLERANCE = 0.02
+PLAN_MAX_AGE_DAYS = 7
+
+
+def _binary(rows, cols, shape):
+    if sparse is not None:
+        return sparse.csr_matrix((np.ones(len(rows), dtype=np.float64), (rows, cols)), shape=shape)
+    dense = np.zeros(shape, dtype=np.float64)
+    dense[rows, cols] = 1.0
+    return dense
+
+def _dense(matrix) -> np.ndarray:
+    return matrix.toarray() if sparse is not None and sparse.issparse(matrix) else np.asarray(matrix)
+
+def similarityMatrix(catalog: ProductCatalog, store_ids: list = None, field: str = "price") -> tuple:
+    ### (store_ids, agreement, common): share of common products with the same price, number of common products
+    store_ids = list(catalog.stores.keys()) if store_ids is None else list(store_ids)
+    if not store_ids:
+        # every store failed: nothing to compare
+        return store_ids, np.zeros((0, 0)), np.zeros((0, 0))
+    rows, products, cents = [], [], []
+    for i, store_id in enumerate(store_ids):
+        store = catalog.stores[store_id]
+        priced = ~np.isnan(store[field])
+        rows.append(np.full(int(priced.sum()), i, dtype=np.int64))
+        products.append(store["idx"][priced].astype(np.int64))
+        cents.append(np.rint(store[field][priced] * 100).astype(np.int64))
+    rows, products, cents = np.concatenate(rows), np.concatenate(products), np.concatenate(cents)
+    # one column per (product, price) pair actually seen
+    features, columns = np.unique(products * (1 << 32) + cents, return_inverse=True)
+    S = _binary(rows, products, (len(store_ids), len(catalog)))
+    F = _binary(rows, columns.ravel(), (len(store_ids), len(features)))
+    common = _dense(S @ S.T)
+    same = _dense(F @ F.T)
+    agreement = np.divide(same, common, out=np.zeros_like(same), where=common > 0)
+    return store_ids, agreement, common
+
+def clusterPriceLists(store_ids: list, agreement: np.ndarray, common: np.ndarray, sizes=None,
+                      threshold: float = AGREEMENT, min_common: int = MIN_COMMON) -> list:
+    ### [[representative, member, ...], ...], largest assortment first
+    sizes = np.diag(common) if sizes is None else np.asarray(sizes)
+    unassigned = np.ones(len(store_ids), dtype=bool)
+    clusters = []
+    for i in np.argsort(-sizes, kind="stable"):
+        if not unassigned[i]:
+            continue
+        members = unassigned & (agreement[i] >= threshold) & (common[i] >= min_common)
+        members[i] = False
+        unassigned[i] = False
+        unassigned &= ~members
+        clusters.append([store_ids[i]] + [store_ids[j] for j in np.flatnonzero(members)])
+    return clusters
+
+def buildPlan(catalog: ProductCatalog, threshold: float = AGREEMENT, min_common: int = MIN_COMMON,
+              field: str = "price") -> dict:
+    store_ids, agreement, common = similarityMatrix(catalog, field=field)
+    clusters = clusterPriceLists(store_ids, agreement, common, threshold=threshold, min_common=min_common)
+    return {
+        "built": dt_date.today().isoformat(),
+        "threshold": threshold,
+        "clusters": [{"representative": str(c[0]), "members": [str(k) for k in c[1:]]} for c in clusters]
+    }
+
+def savePlan(plan: dict, path: str = PLAN_PATH):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as file:
+        json.dump(plan, file, indent=1)
+    os.replace(tmp, path)
+
+def loadPlan(path: str = PLAN_PATH) -> dict:
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+def planAge(plan: dict) -> int:
+    return (dt_date.today() - dt_date.fromisoformat(plan["built"])).days
+
+
+#### SCHEDULING ####
+def schedule(store_info: dict, plan: dict) -> tuple:
+    ### (stores to scrape in full, {member: representative} to spot-check); keys as in store_info
+    keys = {str(k): k for k in store_info.keys()}
+    full, spot, planned = {}, {}, set()
+    for cluster in plan["clusters"]:
+        present = [keys[k] for k in [cluster["representative"]] + cluster["members"] if k in keys]
+        planned.update(str(k) for k in present)
+        if not present:
+            continue
+        # a representative no longer in the list hands over to the next member
+        full[present[0]] = store_info[present[0]]
+        for k in present[1:]:
+            spot[k] = present[0]
+    for k in store_info.keys():
+        if str(k) not in planned:
+            full[k] = store_info[k]
+    return full, spot
+
+def firstPage(store_info: dict, sz: int) -> tuple:
+    ### (rowCount, extracted products) of the first facet page, (None, None) when it can not be fetched
+    street_id = str(store_info.get("street_id"))
+    drive_id = str(store_info.get("drive_id")) if store_info.get("drive_id") else None
+    response = fetch_first_page(get_pooled_session(street_id, drive_id), sz)
+    if response.status_code != 200:
+        return None, None
+    row_count, entities = decodeFacet(response.content)
+    return row_count, extract_product_info(entities)
+
+def spotCheck(store_info: dict, rep_key, catalog: ProductCatalog, rep_row_count: int, sz: int = SPOT_CHECK_SIZE,
+              threshold: float = AGREEMENT, row_tolerance: float = ROW_TOLERANCE) -> dict:
+    row_count, products = firstPage(store_info, sz)
+    result = {"representative": str(rep_key), "row_count": row_count, "common": 0, "agreement": 0.0, "ok": False}
+    if row_count is None:
+        return result
+    same = common = 0
+    for product_id, fields in products.items():
+        rep = catalog.get(rep_key, product_id)
+        if rep is None or rep.get("price") is None or fields.get("price") is None:
+            continue
+        common += 1
+        same += int(round(float(fields.get("price")) * 100) == round(rep["price"] * 100))
+    result["common"] = common
+    result["agreement"] = same / common if common else 0.0
+    result["ok"] = (common >= min(SPOT_CHECK_MIN_COMMON, len(products)) and common > 0
+                    and result["agreement"] >= threshold
+                    and abs(row_count - rep_row_count) <= row_tolerance * rep_row_count)
+    return result
+
+def mainClustered(store_info: dict, plan_path: str = PLAN_PATH, catalog: ProductCatalog = None,
+                  max_age_days: int = PLAN_MAX_AGE_DAYS, threshold: float = AGREEMENT, sz: int = SPOT_CHECK_SIZE,
+                  rebuild: bool = False, **kwargs) -> ProductCatalog:
+    ### kwargs go to main(). Stores passing the spot-check are linked to their representative in
+    ### the catalog (its prices, promos and stock); snapshots and history only get the stores
+    ### actually scraped.
+    catalog = catalog if catalog is not None else ProductCatalog()
+    plan = loadPlan(plan_path)
+    if rebuild or plan is None or planAge(plan) >= max_age_days:
+        logger.info("price lists: full scrape to (re)build the plan")
+        main(store_info, catalog=catalog, **kwargs)
+        if not catalog.stores:
+            # no plan rather than an empty one, the next run tries the full scrape again
+            logger.warning("price lists: no store scraped, plan not built")
+            return catalog
+        plan = buildPlan(catalog, threshold)
+        savePlan(plan, plan_path)
+        logger.info(f"price lists: {len(plan['clusters'])} clusters over {len(catalog.stores)} stores")
+        return catalog
+    full, spot = schedule(store_info, plan)
+    logger.info(f"price lists: {len(full)} stores in full, {len(spot)} spot-checks")
+    main(full, catalog=catalog, **kwargs)
+    rep_rows = {}
+    rep_lock = threading.Lock()
+
+    def repRowCount(rep) -> int:
+        ### one rowCount fetch per representative; members of the same cluster wait on its event,
+        ### different representatives are fetched in parallel
+        with rep_lock:
+            entry = rep_rows.get(rep)
+            owner = entry is None
+            if owner:
+                entry = rep_rows[rep] = {"ready": threading.Event(), "row_count": None}
+        if owner:
+            try:
+                entry["row_count"] = firstPage(full[rep], 1)[0]
+            finally:
+                entry["ready"].set()
+        entry["ready"].wait()
+        return entry["row_count"]
+
+    def check(member):
+        rep = spot[member]
+        if rep not in catalog.stores:
+            return member, None
+        # spot-checks share the store concurrency limit with the full scrapes (process_store_limited)
+        STORE_LIMITER.acquire()
+        started = time.time()
+        status = None
+        try:
+            rep_row_count = repRowCount(rep)
+            if rep_row_count is None:
+                return member, None
+            with METRICS.timed("spot_check"):
+                result = spotCheck(store_info[member], rep, catalog, rep_row_count, sz, threshold)
+            status = 200 if result["row_count"] is not None else None
+            return member, result
+        finally:
+            STORE_LIMITER.release(time.time() - started, status)
+
+    rescrape = {}
+    with ThreadPoolExecutor(max_workers=STORE_LIMITER.max_limit) as executor:
+        for future in as_completed([executor.submit(check, k) for k in spot]):
+            try:
+                member, result = future.result()
+            except Exception as e:
+                logger.error(f"spot-check failed: {str(e)}")
+                continue
+            if result is not None and result["ok"]:
+                METRICS.inc("spot_checks_total", result="match")
+                catalog.link_store(member, spot[member])
+            else:
+                METRICS.inc("spot_checks_total", result="mismatch" if result is not None else "error")
+                logger.info(f"price lists: store {member} left its cluster {result}")
+                rescrape[member] = store_info[member]
+    for k in spot:
+        # a spot-check that raised is retried as a full scrape too
+        if k not in catalog.stores and k not in rescrape:
+            rescrape[k] = store_info[k]
+    if rescrape:
+        main(rescrape, catalog=catalog, **kwargs)
+        # moved stores get scraped in full until the next rebuild
+        moved = {str(k) for k in rescrape}
+        for cluster in plan["clusters"]:
+            cluster["members"] = [k for k in cluster["members"] if k not in moved]
+        plan["clusters"] += [{"representative": k, "members": []} for k in sorted(moved)]
+        savePlan(plan, plan_path)
+    logger.info(f"price lists: {len(spot) - len(rescrape)}/{len(spot)} stores matched their representative")
+    return catalog
+
+
+###   python Esselunga_pricelists.py            scrape representatives, spot-check the rest
+###   python Esselunga_pricelists.py --rebuild  full scrape and new clusters
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scrape one store per price list and spot-check the others")
+    parser.add_argument("--plan", default=PLAN_PATH)
+    parser.add_argument("--rebuild", action="store_true")
+    parser.add_argument("--max-age", type=int, default=PLAN_MAX_AGE_DAYS)
+    parser.add_argument("--threshold", type=float, default=AGREEMENT)
+    args = parser.parse_args()
+    mainClustered(storesToScrape(), args.plan, max_age_days=args.max_age, threshold=args.threshold, rebuild=args.rebuild)
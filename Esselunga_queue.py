@@ -0,0 +1,284 @@
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from Esselunga_catalog import ProductCatalog
+from Esselunga_metrics import METRICS
+from Esselunga_records import recordDefault
+
+#### SHARDED SCRAPING ####
+### stores go into a sqlite work queue; any number of worker processes, on this machine or on
+### others sharing the filesystem, lease stores from it, scrape them with process_store and
+### write one result file per store. A lease is kept alive by a heartbeat thread: when a worker
+### dies its leases expire and the stores are handed out again. Result files are written
+### atomically and keyed by store, so a store scraped twice just overwrites the same file.
+QUEUE_PATH = "scrape_queue.sqlite"
+# workers are spawned, not forked: a forked child would inherit the transport's event loop
+# thread state, connection pools and locks (Esselunga_transport) without the threads behind them
+MP_CONTEXT = multiprocessing.get_context("spawn")
+RESULTS_DIR = "scrape_results"
+LEASE_SECONDS = 180
+MAX_ATTEMPTS = 3
+
+
+def workerName() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    def __init__(self, path: str = QUEUE_PATH, lease: float = LEASE_SECONDS, max_attempts: int = MAX_ATTEMPTS):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # rollback journal rather than WAL: WAL needs shared memory, which breaks across hosts on a network share
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS tasks (key TEXT PRIMARY KEY, payload TEXT, status TEXT, "
+                           "worker TEXT, lease_until REAL, attempts INTEGER, error TEXT, updated REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_until)")
+
+    def _write(self, sql: str, params=()) -> int:
+        with self._lock:
+            return self._conn.execute(sql, params).rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def enqueue(self, tasks: dict, reset: bool = False) -> int:
+        ### tasks: {store_key: store_info}; already queued stores are kept unless reset
+        verb = "INSERT OR REPLACE" if reset else "INSERT OR IGNORE"
+        now = time.time()
+        rows = [(str(k), json.dumps(v), "pending", None, 0, 0, None, now) for k, v in tasks.items()]
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany(f"{verb} INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._conn.execute("COMMIT")
+            return self._conn.total_changes - before
+
+    def claim(self, worker: str, n: int = 1) -> list:
+        ### pending stores first, then stores whose lease ran out (their worker crashed or hung)
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # out of attempts and abandoned again: give up on it
+                self._conn.execute("UPDATE tasks SET status = 'failed', error = 'lease expired', updated = ? "
+                                   "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?", (now, now, self.max_attempts))
+                rows = self._conn.execute(
+                    "SELECT key, payload, status FROM tasks WHERE (status = 'pending' OR (status = 'leased' AND lease_until < ?)) "
+                    "AND attempts < ? ORDER BY status DESC, updated LIMIT ?", (now, self.max_attempts, n)).fetchall()
+                self._conn.executemany(
+                    "UPDATE tasks SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, updated = ? WHERE key = ?",
+                    [(worker, now + self.lease, now, key) for key, _, _ in rows])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        reclaimed = sum(1 for _, _, status in rows if status == "leased")
+        if reclaimed:
+            METRICS.inc("queue_reclaimed_total", reclaimed)
+        return [(key, json.loads(payload)) for key, payload, _ in rows]
+
+    def heartbeat(self, worker: str, keys) -> int:
+        keys = list(keys)
+        if not keys:
+            return 0
+        now = time.time()
+        return self._write(f"UPDATE tasks SET lease_until = ?, updated = ? WHERE worker = ? AND status = 'leased' "
+                           f"AND key IN ({','.join('?' * len(keys))})", [now + self.lease, now, worker] + keys)
+
+    def complete(self, key: str, worker: str) -> bool:
+        return self._write("UPDATE tasks SET status = 'done', lease_until = 0, updated = ? WHERE key = ? AND worker = ?",
+                           (time.time(), key, worker)) == 1
+
+    def fail(self, key: str, worker: str, error: str = None):
+        ### back to pending until max_attempts, then failed for good
+        self._write("UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                    "lease_until = 0, error = ?, updated = ? WHERE key = ? AND worker = ?",
+                    (self.max_attempts, error, time.time(), key, worker))
+
+    def remaining(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM tasks WHERE status IN ('pending', 'leased') AND attempts < ?",
+                                      (self.max_attempts,)).fetchone()[0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall()
+            expired = self._conn.execute("SELECT COUNT(*) FROM tasks WHERE status = 'leased' AND lease_until < ?",
+                                         (time.time(),)).fetchone()[0]
+        stats = dict(rows)
+        stats["expired_leases"] = expired
+        return stats
+
+
+class Heartbeat:
+    ### renews the leases of the stores a worker holds, every lease/3 seconds
+    def __init__(self, queue: WorkQueue, worker: str):
+        self.queue = queue
+        self.worker = worker
+        self.held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.queue.lease / 3):
+            with self._lock:
+                held = list(self.held)
+            self.queue.heartbeat(self.worker, held)
+
+    def add(self, key: str):
+        with self._lock:
+            self.held.add(key)
+
+    def discard(self, key: str):
+        with self._lock:
+            self.held.discard(key)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def resultPath(results_dir: str, store_key: str) -> str:
+    return os.path.join(results_dir, f"store={store_key}.json")
+
+def writeResult(results_dir: str, store_key: str, products_extracted: dict):
+    path = resultPath(results_dir, store_key)
+    tmp = f"{path}.{workerName().replace(':', '_')}.tmp"
+    with open(tmp, "w", encoding="utf-8") as file:
+        json.dump(products_extracted, file, ensure_ascii=False, default=recordDefault)
+    os.replace(tmp, path)
+
+
+def runWorker(queue_path: str = QUEUE_PATH, results_dir: str = RESULTS_DIR, threads: int = 4, lease: float = LEASE_SECONDS,
+              snapshot_root: str = None, worker: str = None) -> int:
+    ### pulls stores until the queue is drained, returns the number of stores this worker completed
+    from Esselunga_scraper import process_store, logger, STORE_COVERAGE, STORE_COVERAGE_LOCK
+    worker = worker or workerName()
+    os.makedirs(results_dir, exist_ok=True)
+    queue = WorkQueue(queue_path, lease)
+    done = 0
+    done_lock = threading.Lock()
+
+    def loop(heartbeat: Heartbeat):
+        nonlocal done
+        while True:
+            claimed = queue.claim(worker)
+            if not claimed:
+                # the rest may still be leased by someone else: wait in case their lease expires
+                if queue.remaining() == 0:
+                    return
+                time.sleep(min(5.0, lease / 6))
+                continue
+            key, store_info = claimed[0]
+            heartbeat.add(key)
+            try:
+                products_extracted = process_store(store_info, store_key=key, snapshot_root=snapshot_root, compact=True)
+                if products_extracted is None:
+                    queue.fail(key, worker, "process_store returned no products")
+                    continue
+                writeResult(results_dir, key, products_extracted)
+                with STORE_COVERAGE_LOCK:
+                    coverage = STORE_COVERAGE.pop(key, None)
+                if coverage is not None:
+                    # keep the partial result but let another attempt try for the full store
+                    queue.fail(key, worker, "partial coverage {:.1%}".format(coverage["coverage"]))
+                    continue
+                if queue.complete(key, worker):
+                    with done_lock:
+                        done += 1
+                else:
+                    # lease was lost (e.g. a long GC pause) and the store reassigned: the result file is still valid
+                    logger.warning(f"{worker}: lease on {key} was lost before completion")
+            except Exception as e:
+                logger.error(f"{worker}: store {key} failed: {str(e)}")
+                queue.fail(key, worker, str(e))
+            finally:
+                heartbeat.discard(key)
+
+    with Heartbeat(queue, worker) as heartbeat:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for future in [executor.submit(loop, heartbeat) for _ in range(threads)]:
+                future.result()
+    METRICS.write_report(os.path.join(results_dir, f"metrics_{worker.replace(':', '_')}"))
+    logger.info(f"{worker}: {done} stores done, queue: {queue.stats()}")
+    queue.close()
+    return done
+
+
+def mergeResults(results_dir: str = RESULTS_DIR, catalog: ProductCatalog = None) -> ProductCatalog:
+    catalog = catalog if catalog is not None else ProductCatalog()
+    for name in sorted(os.listdir(results_dir)):
+        if not (name.startswith("store=") and name.endswith(".json")):
+            continue
+        with open(os.path.join(results_dir, name), "r", encoding="utf-8") as file:
+            catalog.add_store(name[len("store="):-len(".json")], json.load(file))
+    return catalog
+
+
+def runShards(store_info: dict, workers: int = None, threads: int = 4, queue_path: str = QUEUE_PATH,
+              results_dir: str = RESULTS_DIR, snapshot_root: str = None) -> ProductCatalog:
+    ### single-node convenience: enqueue, start one worker per core, wait, merge
+    queue = WorkQueue(queue_path)
+    queue.enqueue(store_info)
+    queue.close()
+    workers = workers or os.cpu_count() or 1
+    processes = [MP_CONTEXT.Process(target=runWorker, args=(queue_path, results_dir, threads),
+                                         kwargs={"snapshot_root": snapshot_root}) for _ in range(workers)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    queue = WorkQueue(queue_path)
+    print("queue: {}".format(queue.stats()))
+    queue.close()
+    return mergeResults(results_dir)
+
+
+### multi-node: enqueue once, then start "work" on every machine against the shared paths
+###   python Esselunga_queue.py enqueue --stores stores.json
+###   python Esselunga_queue.py work --processes 8
+###   python Esselunga_queue.py status
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sharded scraping over a shared sqlite work queue")
+    parser.add_argument("command", choices=["enqueue", "work", "status"])
+    parser.add_argument("--queue", default=QUEUE_PATH)
+    parser.add_argument("--results", default=RESULTS_DIR)
+    parser.add_argument("--stores", help="JSON file {store_key: store_info}, default storesToScrape()")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--reset", action="store_true", help="re-queue stores that are already done")
+    args = parser.parse_args()
+
+    if args.command == "enqueue":
+        if args.stores:
+            with open(args.stores, "r") as file:
+                stores = json.load(file)
+        else:
+            from Esselunga_scraper import storesToScrape
+            stores = storesToScrape()
+        queue = WorkQueue(args.queue)
+        print("queued {} stores".format(queue.enqueue(stores, reset=args.reset)))
+    elif args.command == "work":
+        processes = [MP_CONTEXT.Process(target=runWorker, args=(args.queue, args.results, args.threads))
+                     for _ in range(args.processes)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+    else:
+        print(WorkQueue(args.queue).stats())
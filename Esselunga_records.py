@@ -0,0 +1,136 @@
+import sys
+from datetime import datetime, date
+from functools import lru_cache
+
+#### COMPACT PRODUCT RECORDS ####
+### getProductFields builds a 20 key dict (plus a nested promo dict) per product; a national run
+### holds millions of them. ProductRecord keeps the same data in __slots__: prices as integer
+### cents, promo dates as datetime.date, the promo dict flattened into slots and the strings that
+### repeat across products (brand, label, unit, product/promo type) interned so every record
+### shares one copy. get()/items()/to_dict() give back exactly the getProductFields dict, so the
+### catalog and the snapshots accept records and dicts alike.
+PROMO_DATE_FORMAT = "%d/%m/%Y"
+# dict view key order, same as getProductFields
+PRODUCT_FIELDS = ("id", "product_code", "html", "name", "n_portions", "brand", "unit_price", "price", "disc_price",
+                  "attributes", "txt", "variable_weight", "oos", "prod_type", "raee", "quantity", "promo",
+                  "unit_text", "unit_value", "barcode")
+
+
+def toCents(value):
+    if value is None:
+        return None
+    try:
+        return int(round(float(value) * 100))
+    except (TypeError, ValueError):
+        return None
+
+def fromCents(cents):
+    return None if cents is None else cents / 100
+
+## the same few promo periods repeat over thousands of products
+@lru_cache(maxsize=4096)
+def parsePromoDate(text):
+    ### unparseable dates are kept as they came
+    try:
+        return datetime.strptime(text, PROMO_DATE_FORMAT).date()
+    except (TypeError, ValueError):
+        return text
+
+def formatPromoDate(value):
+    return value.strftime(PROMO_DATE_FORMAT) if isinstance(value, date) else value
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class ProductRecord:
+    __slots__ = ("id", "product_code", "html", "name", "n_portions", "brand", "unit_price", "price_cents",
+                 "disc_price_cents", "attributes", "txt", "variable_weight", "oos", "prod_type", "raee", "quantity",
+                 "has_promo", "promo_start", "promo_end", "promo_type", "promo_disc_cents", "unit_text", "unit_value",
+                 "barcode")
+
+    @classmethod
+    def from_fields(cls, fields: dict) -> "ProductRecord":
+        record = cls.__new__(cls)
+        get = fields.get
+        record.id = get("id")
+        record.product_code = get("product_code")
+        record.html = get("html")
+        record.name = get("name")
+        record.n_portions = get("n_portions")
+        record.brand = intern(get("brand"))
+        record.unit_price = intern(get("unit_price"))
+        record.attributes = get("attributes")
+        record.txt = get("txt")
+        record.variable_weight = get("variable_weight")
+        record.oos = get("oos")
+        record.prod_type = intern(get("prod_type"))
+        record.raee = get("raee")
+        record.quantity = get("quantity")
+        record.unit_text = intern(get("unit_text"))
+        record.unit_value = get("unit_value")
+        record.barcode = get("barcode")
+        record.price_cents = toCents(fields.get("price"))
+        record.disc_price_cents = toCents(fields.get("disc_price"))
+        promo = fields.get("promo") or {}
+        record.has_promo = bool(promo)
+        record.promo_start = parsePromoDate(promo["start"]) if "start" in promo else None
+        record.promo_end = parsePromoDate(promo["end"]) if "end" in promo else None
+        record.promo_type = intern(promo.get("promoType"))
+        record.promo_disc_cents = toCents(promo.get("disc_price"))
+        return record
+
+    @property
+    def price(self):
+        return fromCents(self.price_cents)
+
+    @property
+    def disc_price(self):
+        return fromCents(self.disc_price_cents)
+
+    @property
+    def promo(self) -> dict:
+        if not self.has_promo:
+            return {}
+        promo = {}
+        if self.promo_start is not None:
+            promo["start"] = formatPromoDate(self.promo_start)
+        if self.promo_end is not None:
+            promo["end"] = formatPromoDate(self.promo_end)
+        promo["promoType"] = self.promo_type
+        promo["disc_price"] = fromCents(self.promo_disc_cents)
+        return promo
+
+    ## dict view
+    def get(self, key, default=None):
+        return getattr(self, key) if key in PRODUCT_FIELDS else default
+
+    def __getitem__(self, key):
+        if key not in PRODUCT_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def keys(self):
+        return PRODUCT_FIELDS
+
+    def items(self):
+        return ((key, getattr(self, key)) for key in PRODUCT_FIELDS)
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    def __repr__(self) -> str:
+        return f"ProductRecord(id={self.id!r}, name={self.name!r}, price_cents={self.price_cents!r})"
+
+
+def toRecords(products_extracted: dict) -> dict:
+    return {k: v if isinstance(v, ProductRecord) else ProductRecord.from_fields(v) for k, v in products_extracted.items()}
+
+def toDicts(products_extracted: dict) -> dict:
+    return {k: v.to_dict() if isinstance(v, ProductRecord) else v for k, v in products_extracted.items()}
+
+## json.dump(..., default=recordDefault) writes records as their dict view
+def recordDefault(value):
+    if isinstance(value, ProductRecord):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
@@ -1,9 +1,32 @@
 import requests
 from fake_useragent import UserAgent
 import logging
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import aiohttp
 import pandas as pd
 import numpy as np
 import re
+import random
+from Esselunga_catalog import ProductCatalog
+from Esselunga_snapshot import snapshotStore
+from Esselunga_cache import DiskCache
+from Esselunga_history import PriceHistory
+from Esselunga_records import ProductRecord
+from Esselunga_decode import decodeFacet, decodeDetail
+from Esselunga_metrics import METRICS, aiohttpTraceConfig, SamplingProfiler
+from Esselunga_transport import newSession, STATELESS_SESSION, runAsync, sharedConnector
+from bs4 import BeautifulSoup
+try:
+    import lxml
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -11,10 +34,13 @@ logger = logging.getLogger(__name__)
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
+# overridable so the scraper can be pointed at a local stand-in (see benchmarks/mock_backend.py)
+BASE_URL = os.environ.get("ESSELUNGA_BASE_URL", "https://spesaonline.esselunga.it")
+
 
 def create_session():
     ua = UserAgent()
-    session = requests.Session()
+    session = newSession()
     session.headers.update({
         "User-Agent": ua.random,
         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
@@ -25,7 +51,7 @@ def create_session():
 
 def create_drive_session():
     ua = UserAgent()
-    session = requests.Session()
+    session = newSession()
     session.headers.update({
         "User-Agent": ua.random,
         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
@@ -36,19 +62,19 @@ def create_drive_session():
     return session
 
 def initial_request(session):
-    url = "https://spesaonline.esselunga.it/commerce/nav/onboarding/index"
+    url = f"{BASE_URL}/commerce/nav/onboarding/index"
     return session.get(url)
 
 def initial_request_drive(session):
     headers = {
-        'Host': 'spesaonline.esselunga.it',
+        'Host': BASE_URL.split("://")[-1],
         'X-PAGE-PATH': 'drive',
     }
-    url = 'https://spesaonline.esselunga.it/commerce/nav/drive/store/home'
+    url = f'{BASE_URL}/commerce/nav/drive/store/home'
     return session.get(url, headers=headers)
 
 def visit_supermarket(session, street_id):
-    url = "https://spesaonline.esselunga.it/commerce/nav/supermercato/visit?streetId="+str(street_id)
+    url = f"{BASE_URL}/commerce/nav/supermercato/visit?streetId="+str(street_id)
     response = session.get(url, allow_redirects=False)
     if response.status_code == 302:
         redirect_url = response.headers.get('Location')
@@ -57,7 +83,7 @@ def visit_supermarket(session, street_id):
     return response
 
 def visit_drive(session, street_id, drive_id):
-    url = "https://spesaonline.esselunga.it/commerce/nav/drive/visit?streetId="+str(street_id)+"&driveId"+str(drive_id)
+    url = f"{BASE_URL}/commerce/nav/drive/visit?streetId="+str(street_id)+"&driveId="+str(drive_id)
     response = session.get(url, allow_redirects=False)
     if response.status_code == 302:
         redirect_url = response.headers.get('Location')
@@ -66,22 +92,406 @@ def visit_drive(session, street_id, drive_id):
     return response
 
 
+FACET_URL = f"{BASE_URL}/commerce/resources/search/facet"
+
+
+#### ADAPTIVE CONCURRENCY ####
+### AIMD controller: the limit grows by ~1 every `limit` healthy completions and is
+### cut multiplicatively on 429/5xx/timeouts (at most once per cooldown window).
+### Threads wait on the condition, coroutines on a future of their own that release()
+### resolves on the waiter's loop (release may run on any thread)
+def _wakeWaiter(future):
+    if not future.done():
+        future.set_result(None)
+
+def congested(status) -> bool:
+    ### 429/5xx and timeouts/connection errors (None) mean the backend is overloaded
+    return status is None or status == 429 or status >= 500
+
+def worstStatus(statuses, default: int = 200):
+    ### the outcome a limiter should see for a group of pages: a timeout over 429/5xx over anything else
+    rank = lambda status: 2 if status is None else int(congested(status))
+    return max([default] + list(statuses), key=rank)
+
+class AdaptiveLimiter:
+    def __init__(self, initial: int = 8, min_limit: int = 1, max_limit: int = 64,
+                 latency_target: float = None, backoff: float = 0.5, cooldown: float = 1.0, window: float = 10.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.window = window
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._last_backoff = 0.0
+        self._completed = deque()
+        self._waiters = deque()
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def rps(self) -> float:
+        with self._cond:
+            self._trim(time.time())
+            return len(self._completed) / self.window
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "in_flight": self.in_flight, "rps": round(self.rps, 2)}
+
+    def _trim(self, now: float):
+        while self._completed and self._completed[0] < now - self.window:
+            self._completed.popleft()
+
+    def try_acquire(self) -> bool:
+        with self._cond:
+            if self._in_flight < self.limit:
+                self._in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self._in_flight < self.limit:
+                    self._in_flight += 1
+                    return
+                future = loop.create_future()
+                self._waiters.append((loop, future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                with self._cond:
+                    if (loop, future) in self._waiters:
+                        self._waiters.remove((loop, future))
+                    else:
+                        # woken but cancelled before taking the slot: pass the wake-up on
+                        self._wake()
+                raise
+
+    def _wake(self):
+        ### with self._cond held: one waiting coroutine per free slot
+        free = self.limit - self._in_flight
+        while self._waiters and free > 0:
+            loop, future = self._waiters.popleft()
+            loop.call_soon_threadsafe(_wakeWaiter, future)
+            free -= 1
+
+    def release(self, latency: float, status: int = None, adjust: bool = True):
+        ### status is the HTTP status code, None for timeouts/connection errors;
+        ### adjust=False only frees the slot (an outcome that says nothing about the backend)
+        now = time.time()
+        with self._cond:
+            self._in_flight -= 1
+            self._completed.append(now)
+            self._trim(now)
+            if not adjust:
+                pass
+            elif congested(status):
+                if now - self._last_backoff > self.cooldown:
+                    self._limit = max(self.min_limit, self._limit * self.backoff)
+                    self._last_backoff = now
+            elif self.latency_target is None or latency <= self.latency_target:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self._cond.notify_all()
+            self._wake()
+
+
+STORE_LIMITER = AdaptiveLimiter(initial=20, min_limit=2, max_limit=40)
+PAGE_LIMITER = AdaptiveLimiter(initial=20, min_limit=4, max_limit=200, latency_target=2.0)
+
 def get_facet_data(session, start: int, length: int = 99):
-    url = "https://spesaonline.esselunga.it/commerce/resources/search/facet"
     data = {
         "query": "*",
         "start": start,
         "length": length,
         "filters": []
     }
-    return session.post(url, json=data)
+    return session.post(FACET_URL, json=data, allow_redirects=False)
+
+
+#### PAGE RETRIES ####
+### a failed facet page is retried on its own with full-jitter exponential backoff, the pages
+### already fetched are kept; only auth/redirect answers (session no longer bound to the store)
+### cost a new warm-up, and whatever is still missing afterwards is reported, not dropped
+PAGE_RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 20.0
+RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504)
+
+class PageError(RuntimeError):
+    def __init__(self, start: int, status=None, message: str = None):
+        super().__init__(message or f"Failed to fetch products at offset {start}: {status}")
+        self.start = start
+        self.status = status
+
+class SessionExpired(PageError):
+    pass
+
+def backoffDelay(attempt: int, base: float = BACKOFF_BASE, cap: float = BACKOFF_MAX) -> float:
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def pageCoverage(row_count: int, sz: int, missing) -> float:
+    ### share of facet pages fetched; a store with no pages is covered unless something is missing
+    n_pages = -(-row_count // sz)
+    return 1.0 - len(missing) / n_pages if n_pages else float(not missing)
+
+class FacetPages(list):
+    ### entities in offset order (a plain list for the callers) plus what could not be fetched
+    def __init__(self, pages: dict = None, row_count: int = 0, sz: int = 99, missing=(), expired: bool = False,
+                 status: int = 200):
+        self.pages = pages if pages is not None else {}
+        super().__init__(entity for start in sorted(self.pages) for entity in self.pages[start])
+        self.row_count = row_count
+        self.sz = sz
+        self.missing = sorted(missing)
+        self.expired = expired
+        # worst final status of the missing pages (see worstStatus), 200 when nothing is missing
+        self.status = status
+
+    def coverage(self) -> float:
+        return pageCoverage(self.row_count, self.sz, self.missing)
+
+
+#### ASYNC FACET PAGINATION ####
+### page 0 tells us rowCount, after that every offset is known and the remaining
+### pages are fetched concurrently on an aiohttp client carrying the session cookies
+async def fetch_facet_page_async(client, semaphore, start: int, sz: int, retries: int = PAGE_RETRIES) -> list:
+    data = {
+        "query": "*",
+        "start": start,
+        "length": sz,
+        "filters": []
+    }
+    for attempt in range(retries + 1):
+        async with semaphore:
+            await PAGE_LIMITER.acquire_async()
+            started = time.time()
+            status = None
+            try:
+                with METRICS.timed("facet_page"):
+                    async with client.post(FACET_URL, json=data, allow_redirects=False) as response:
+                        status = response.status
+                        if status == 200:
+                            return decodeFacet(await response.read())[1]
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+                # connection drops, timeouts and truncated bodies are all worth another try:
+                # a 200 whose body could not be read or decoded counts as no answer at all
+                status = None
+                logger.debug(f"offset {start}: {str(e)}")
+            finally:
+                PAGE_LIMITER.release(time.time() - started, status)
+        if status in SESSION_EXPIRED_STATUS:
+            raise SessionExpired(start, status)
+        if status is not None and status not in RETRYABLE_STATUS:
+            raise PageError(start, status)
+        if attempt < retries:
+            METRICS.inc("page_retries_total", status=status or "error")
+            await asyncio.sleep(backoffDelay(attempt))
+    raise PageError(start, status)
+
+async def open_facet_client(session):
+    cookies = requests.utils.dict_from_cookiejar(session.cookies)
+    headers = {k: v for k, v in session.headers.items() if k.lower() != "connection"}
+    timeout = aiohttp.ClientTimeout(total=30)
+    # own cookie jar per client, connections come from the shared connector
+    return aiohttp.ClientSession(headers=headers, cookies=cookies, timeout=timeout, connector=sharedConnector(),
+                                 connector_owner=False, trace_configs=[aiohttpTraceConfig()])
+
+async def gather_facet_pages(client, semaphore, offsets: list, sz: int) -> list:
+    ### failed pages come back as their exception so one bad page does not cancel the others
+    tasks = [fetch_facet_page_async(client, semaphore, start, sz) for start in offsets]
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+async def fetch_remaining_pages(session, offsets: list, sz: int, max_in_flight: int) -> list:
+    semaphore = asyncio.Semaphore(max_in_flight)
+    async with await open_facet_client(session) as client:
+        return await gather_facet_pages(client, semaphore, offsets, sz)
+
+def pageStatus(page) -> int:
+    ### final status of a page that failed: the PageError's, None (no answer) for anything else
+    return page.status if isinstance(page, PageError) else None
+
+def fetch_offsets(session, offsets: list, sz: int, max_in_flight: int, pages: dict) -> tuple:
+    ### fills pages {offset: entities}, returns the offsets still missing, whether the session
+    ### expired and the worst status among the missing pages
+    missing, expired, statuses = [], False, []
+    if not offsets:
+        return missing, expired, worstStatus(statuses)
+    for start, page in zip(offsets, runAsync(fetch_remaining_pages(session, offsets, sz, max_in_flight))):
+        if isinstance(page, Exception):
+            missing.append(start)
+            expired = expired or isinstance(page, SessionExpired)
+            statuses.append(pageStatus(page))
+        else:
+            pages[start] = page
+    return missing, expired, worstStatus(statuses)
+
+def fetch_first_page(session, sz: int = 99, retries: int = PAGE_RETRIES):
+    for attempt in range(retries + 1):
+        PAGE_LIMITER.acquire()
+        started = time.time()
+        status = None
+        try:
+            with METRICS.timed("facet_page"):
+                facet_response = get_facet_data(session, 0, sz)
+            status = facet_response.status_code
+        except requests.RequestException as e:
+            if attempt == retries:
+                raise
+            logger.debug(f"first page: {str(e)}")
+        finally:
+            PAGE_LIMITER.release(time.time() - started, status)
+        if status is not None and status not in RETRYABLE_STATUS:
+            break
+        if attempt < retries:
+            METRICS.inc("page_retries_total", status=status or "error")
+            time.sleep(backoffDelay(attempt))
+    return facet_response
+
+def fetch_facet_pages(session, sz: int = 99, max_in_flight: int = 8) -> FacetPages:
+    facet_response = fetch_first_page(session, sz)
+    if facet_response.status_code in SESSION_EXPIRED_STATUS:
+        return None
+    if facet_response.status_code != 200:
+        logger.warning(f"Failed to fetch products: {facet_response.status_code} {facet_response.text[:200]}")
+        return FacetPages(sz=sz, missing=[0], status=facet_response.status_code)
+    prod_count, entities = decodeFacet(facet_response.content)
+    logger.debug(f"{prod_count} products found")
+    pages = {0: entities}
+    # pages come back in offset order, same as the old serial loop
+    missing, expired, status = fetch_offsets(session, list(range(sz, prod_count, sz)), sz, max_in_flight, pages)
+    return FacetPages(pages, prod_count, sz, missing, expired, status)
+
+def resume_facet_pages(session, result: FacetPages, max_in_flight: int = 8) -> FacetPages:
+    ### fetch only the offsets a previous attempt missed, keeping the pages it got
+    missing, expired, status = fetch_offsets(session, result.missing, result.sz, max_in_flight, result.pages)
+    return FacetPages(result.pages, result.row_count, result.sz, missing, expired, status)
+
+
+#### SESSION POOL ####
+### warmed sessions (onboarding + visit done, cookies bound to the store) are kept
+### per (street_id, drive_id) and reused until one of their cookies expires,
+### SESSION_MAX_AGE is reached or the backend stops accepting them
+SESSION_MAX_AGE = 30 * 60
+SESSION_EXPIRED_STATUS = (301, 302, 401, 403)
+SESSION_POOL = {}
+SESSION_POOL_LOCK = threading.Lock()
+
+def session_key(street_id, drive_id=None) -> tuple:
+    return (str(street_id), str(drive_id) if drive_id else None)
+
+def warm_session(street_id, drive_id=None):
+    with METRICS.timed("session_warmup", kind="drive" if drive_id else "supermarket"):
+        if drive_id:
+            session = create_drive_session()
+            initial_request_drive(session)
+            visit_drive(session, street_id, drive_id)
+        else:
+            session = create_session()
+            initial_request(session)
+            visit_supermarket(session, street_id)
+    session.warmed_at = time.time()
+    return session
+
+def session_expired(session, max_age: int = SESSION_MAX_AGE) -> bool:
+    if time.time() - getattr(session, "warmed_at", 0) > max_age:
+        return True
+    if len(session.cookies) == 0:
+        return True
+    return any(cookie.is_expired() for cookie in session.cookies)
+
+def get_pooled_session(street_id, drive_id=None):
+    key = session_key(street_id, drive_id)
+    with SESSION_POOL_LOCK:
+        session = SESSION_POOL.get(key)
+    if session is None or session_expired(session):
+        METRICS.inc("session_pool_total", result="warm")
+        logger.info(f"Warming session for {key}")
+        session = warm_session(street_id, drive_id)
+        with SESSION_POOL_LOCK:
+            SESSION_POOL[key] = session
+    else:
+        METRICS.inc("session_pool_total", result="hit")
+    return session
+
+def invalidate_session(street_id, drive_id=None):
+    with SESSION_POOL_LOCK:
+        session = SESSION_POOL.pop(session_key(street_id, drive_id), None)
+    if session is not None:
+        session.close()
+
+def save_session_pool(path: str = "session_pool.json"):
+    pool = {}
+    with SESSION_POOL_LOCK:
+        for (street_id, drive_id), session in SESSION_POOL.items():
+            pool[f"{street_id}|{drive_id or ''}"] = {
+                "warmed_at": getattr(session, "warmed_at", 0),
+                "headers": dict(session.headers),
+                "cookies": [{"name": c.name, "value": c.value, "domain": c.domain, "path": c.path,
+                             "expires": c.expires, "secure": c.secure} for c in session.cookies]
+            }
+    with open(path, "w") as file:
+        json.dump(pool, file)
+
+def load_session_pool(path: str = "session_pool.json") -> int:
+    if not os.path.exists(path):
+        return 0
+    with open(path, "r") as file:
+        pool = json.load(file)
+    loaded = 0
+    for key, state in pool.items():
+        street_id, drive_id = key.split("|")
+        session = newSession()
+        session.headers.clear()
+        session.headers.update(state["headers"])
+        for c in state["cookies"]:
+            session.cookies.set(c["name"], c["value"], domain=c["domain"], path=c["path"],
+                                expires=c["expires"], secure=c["secure"])
+        session.warmed_at = state["warmed_at"]
+        if session_expired(session):
+            continue
+        with SESSION_POOL_LOCK:
+            SESSION_POOL[session_key(street_id, drive_id or None)] = session
+        loaded += 1
+    logger.info(f"Loaded {loaded} warm sessions from {path}")
+    return loaded
+
+def fetch_pooled_products(street_id, drive_id=None, sz: int = 99, max_in_flight: int = 8) -> FacetPages:
+    session = get_pooled_session(street_id, drive_id)
+    all_products = fetch_facet_pages(session, sz, max_in_flight)
+    if all_products is None or all_products.expired:
+        # the backend no longer recognises the session: warm up again, once, and
+        # carry on from the pages already fetched
+        METRICS.inc("session_rewarm_total")
+        invalidate_session(street_id, drive_id)
+        session = get_pooled_session(street_id, drive_id)
+        if all_products is None:
+            all_products = fetch_facet_pages(session, sz, max_in_flight) or FacetPages(sz=sz, missing=[0])
+        else:
+            all_products = resume_facet_pages(session, all_products, max_in_flight)
+    return all_products
 
 
 
 ### CONSEGNA A CASA ###
-def fetch_all_products(store_info: dict, sz: int = 100) -> list:
+def fetch_all_products(store_info: dict, sz: int = 100, max_in_flight: int = 8) -> list:
     street_id = str(store_info.get("street_id"))
-    print(f"street_id: {street_id}")
+    logger.debug(f"street_id: {street_id}")
     # value = storeid.get("name")
     # postCode = storeid.get("postCode")
     # town = storeid.get("townName")
@@ -91,73 +501,21 @@ def fetch_all_products(store_info: dict, sz: int = 100) -> list:
     # visit_url = "https://spesaonline.esselunga.it/commerce/nav/drive/visit?streetId="+str(street_id)
     # session.get(visit_url)
     # url = "https://spesaonline.esselunga.it/commerce/resources/search/facet"
-    session = create_session()
-    initial_request(session)
-    visit_supermarket(session, street_id)
-    start = 0
-    prod_count = 20000
-    all_products = []
-    #visit_supermarket(session, street_id)
-    while start < prod_count:
-        data = {
-        "query": "*",
-        "start": start,
-        "length": sz,
-        "filters": []
-        }
-        # facet_response = session.post(url, json=data)
-        facet_response = get_facet_data(session, 0)
-        prod_count = facet_response.json()['displayables']['rowCount']
-        if facet_response.status_code != 200:
-            print(f"Failed to fetch products: {facet_response.status_code}")
-            print(facet_response.text)
-            break
-        response_cleaned = facet_response.json()["displayables"]["entities"]
-        if start == 0:
-            print(f"{prod_count} products found")
-        all_products.extend(response_cleaned)
-        start += sz
-    print("Retrieved {} products".format(len(all_products)))
+    all_products = fetch_pooled_products(street_id, None, sz, max_in_flight)
+    logger.debug("Retrieved {} products".format(len(all_products)))
     return all_products
 
 
 #### CLICCA E VAI ####
-def fetch_all_products_CEV(storeid, sz: int = 100) -> list:
+def fetch_all_products_CEV(storeid, sz: int = 100, max_in_flight: int = 8) -> list:
     street_id = str(storeid.get("street_id"))
-    print(f"street_id: {street_id}")
+    logger.debug(f"street_id: {street_id}")
     # value = storeid.get("name")
     # postCode = storeid.get("postCode")
     # town = storeid.get("townName")
     drive_id = str(storeid.get("drive_id"))
-    session = create_drive_session()
-    initial_url = 'https://spesaonline.esselunga.it/commerce/nav/drive/store/home'
-    session.get(initial_url)
-    visit_url = f"https://spesaonline.esselunga.it/commerce/nav/drive/visit?streetId={street_id}&driveId={drive_id}"
-    print(visit_url)
-    session.get(visit_url)
-    url = "https://spesaonline.esselunga.it/commerce/resources/search/facet"
-    start = 0
-    prod_count = 20000
-    all_products = []
-    while start < prod_count:
-        data = {
-        "query": "*",
-        "start": start,
-        "length": sz,
-        "filters": []
-        }
-        facet_response = session.post(url, json=data)
-        prod_count = facet_response.json()['displayables']['rowCount']
-        if facet_response.status_code != 200:
-            print(f"Failed to fetch products: {facet_response.status_code}")
-            print(facet_response.text)
-            break
-        response_cleaned = facet_response.json()["displayables"]["entities"]
-        if start == 0:
-            print(f"{prod_count} products found")
-        all_products.extend(response_cleaned)
-        start += sz
-    print("Retrieved {} products".format(len(all_products)))
+    all_products = fetch_pooled_products(street_id, drive_id, sz, max_in_flight)
+    logger.debug("Retrieved {} products".format(len(all_products)))
     return all_products
 
 
@@ -170,20 +528,24 @@ def extract_dates(text):
         return None
 
 
-def getProductFields(prod: dict) -> dict:
-    pattern = re.compile(r'\s(\d{1,2})\s?[xX]\s?\d{1,4}')
+def getPromoFields(promo, txt, disc_price) -> dict:
     promo_dict = {}
-    if isinstance(prod.get('promo'), list) and len(prod.get('promo')) == 1:
-        for i in range(len(prod["txt"])):
-            if prod["txt"][i].get("messageType") == "PROMO":
+    if isinstance(promo, list) and len(promo) == 1:
+        for i in range(len(txt)):
+            if txt[i].get("messageType") == "PROMO":
                 try:
-                    start, end = extract_dates(prod["txt"][i].get("text"))
+                    start, end = extract_dates(txt[i].get("text"))
                     promo_dict["start"] = start
                     promo_dict["end"] = end
                 except:
-                    print("promo dates not found")
-        promo_dict["promoType"] = prod["promo"][0].get("promoType")
-        promo_dict["disc_price"] = prod.get("disc_price")
+                    logger.debug("promo dates not found")
+        promo_dict["promoType"] = promo[0].get("promoType")
+        promo_dict["disc_price"] = disc_price
+    return promo_dict
+
+def getProductFields(prod: dict) -> dict:
+    pattern = re.compile(r'\s(\d{1,2})\s?[xX]\s?\d{1,4}')
+    promo_dict = getPromoFields(prod.get('promo'), prod.get("txt"), prod.get("disc_price"))
     return {
         "id": prod.get('id'),
         "product_code": prod.get('code'),
@@ -207,22 +569,63 @@ def getProductFields(prod: dict) -> dict:
         "barcode": prod.get('barcode')
     }
 
-def extract_product_info(products: list) -> dict:
+## getProductFields for entities decoded with the msgspec schema (Esselunga_decode.FacetEntity):
+## same dict, read straight from the struct attributes instead of dict lookups
+def getEntityFields(entity) -> dict:
+    return {
+        "id": entity.id,
+        "product_code": entity.code,
+        "html": entity.htmlDescription,
+        "name": entity.name,
+        "n_portions": entity.n_portions,
+        "brand": entity.brand,
+        "unit_price": entity.label,
+        "price": entity.price,
+        "disc_price": entity.discountedPrice,
+        "attributes": entity.attributes,
+        "txt": entity.values,
+        "variable_weight": entity.variableWeight,
+        "oos": entity.outOfStock,
+        "prod_type": entity.productType,
+        "raee": entity.raee,
+        "quantity": entity.quantity,
+        "promo": getPromoFields(entity.promo, entity.txt, entity.disc_price),
+        "unit_text": entity.unit_text,
+        "unit_value": entity.unit_value,
+        "barcode": entity.barcode
+    }
+
+## compact=True returns ProductRecord values (see Esselunga_records) instead of dicts
+def extract_product_info(products: list, compact: bool = False) -> dict:
     products_extracted = {}
     for prod in products:
         if prod.get('description'):
-            fields = getProductFields(prod)
-            products_extracted[fields.get("id")] = fields
+            fieldsOf = getProductFields if isinstance(prod, dict) else getEntityFields
+            fields = fieldsOf(prod)
+            products_extracted[fields.get("id")] = ProductRecord.from_fields(fields) if compact else fields
             children = prod.get("children")
             if isinstance(children, list) and len(children) > 0:
                 for child in children:
-                    child_field = getProductFields(child)
+                    child_field = fieldsOf(child)
                     child_field["id"] = child_field['id']
-                    products_extracted[child_field.get("id")] = child_field
+                    products_extracted[child_field.get("id")] = ProductRecord.from_fields(child_field) if compact else child_field
     return products_extracted
 
 
-def process_store(store_info: dict, max_retries=2):
+### stores scraped with pages missing after all retries: {store_key: {row_count, fetched, missing, coverage}}
+STORE_COVERAGE = {}
+STORE_COVERAGE_LOCK = threading.Lock()
+
+def recordCoverage(store_key, row_count: int, fetched: int, missing: list, sz: int = 99):
+    coverage = pageCoverage(row_count, sz, missing)
+    METRICS.inc("stores_total", result="partial")
+    logger.warning(f"store {store_key}: partial coverage {coverage:.1%}, {fetched} records for rowCount {row_count}, offsets {missing} missing")
+    with STORE_COVERAGE_LOCK:
+        STORE_COVERAGE[str(store_key)] = {"row_count": row_count, "fetched": fetched, "missing": list(missing), "coverage": coverage}
+
+def process_store(store_info: dict, max_retries=2, catalog: ProductCatalog = None, store_key=None, snapshot_root: str = None,
+                  compact: bool = False, history: PriceHistory = None, report: dict = None):
+    ### report, when given, receives the worst final status of the store's pages (200 when complete)
     street_id = str(store_info.get("street_id"))
     # value = store_info.get("name")
     # postCode = store_info.get("postCode")
@@ -232,23 +635,172 @@ def process_store(store_info: dict, max_retries=2):
         clicca_e_vai = True
     for attempt in range(max_retries + 1):
         try:
+            # pages are retried individually inside the fetchers, a whole-store retry
+            # only happens when warm-up or the first page could not be done at all
             if clicca_e_vai:
                 all_products_data = fetch_all_products_CEV(store_info, sz=99)
-                products_extracted = extract_product_info(all_products_data)
-                break
             else:
                 all_products_data = fetch_all_products(store_info, sz=99)
-                products_extracted = extract_product_info(all_products_data)
-                break
+            if not all_products_data and getattr(all_products_data, "missing", None):
+                raise RuntimeError("first facet page could not be fetched")
+            with METRICS.timed("extraction"):
+                products_extracted = extract_product_info(all_products_data, compact)
+            break
             # Additional processing of products can go here
         except Exception as e:
             if attempt < max_retries:
-                print(f"Attempt {attempt + 1} failed for store {street_id}. Retrying... Error: {str(e)}")
+                METRICS.inc("store_retries_total")
+                logger.warning(f"Attempt {attempt + 1} failed for store {street_id}. Retrying... Error: {str(e)}")
+                time.sleep(backoffDelay(attempt + 2))
             else:
-                print(f"Failed to set store {street_id} after {max_retries + 1} attempts. Skipping this store. {str(e)}")
+                METRICS.inc("stores_total", result="failed")
+                logger.error(f"Failed to set store {street_id} after {max_retries + 1} attempts. Skipping this store. {str(e)}")
                 return  # Skip this store after all retries fail
-            print(f"Error processing store {street_id}: {str(e)}")
-    print("for store {} I found {} products".format(street_id, len(products_extracted)))
+    store_key = store_key if store_key is not None else street_id
+    if report is not None:
+        report["status"] = getattr(all_products_data, "status", 200)
+    missing = getattr(all_products_data, "missing", None)
+    if missing:
+        recordCoverage(store_key, all_products_data.row_count, len(all_products_data), missing, all_products_data.sz)
+    else:
+        METRICS.inc("stores_total", result="ok")
+    METRICS.inc("products_total", len(products_extracted))
+    logger.info("for store {} I found {} products".format(street_id, len(products_extracted)))
+    if snapshot_root and missing:
+        # a partial snapshot would show every product on the missing pages as removed
+        logger.warning(f"store {store_key}: snapshot skipped, coverage incomplete")
+    elif snapshot_root:
+        # persist today's snapshot and write the change set against the previous run
+        snapshotStore(products_extracted, store_key, snapshot_root)
+    if history is not None:
+        # unlike a snapshot, every observed price is valid history even when pages are missing
+        with METRICS.timed("history"):
+            history.add(products_extracted, store_key)
+    if catalog is not None:
+        # static fields go to the shared catalog, only prices/promo/stock stay per store
+        catalog.add_store(store_key, products_extracted, getattr(all_products_data, "row_count", None))
+    return products_extracted
+
+
+#### STREAMING ####
+### pages are yielded as soon as their window completes and extracted one page at a time,
+### so a store never holds more than max_in_flight pages in memory
+def iter_facet_pages(street_id, drive_id=None, sz: int = 99, max_in_flight: int = 8, report: dict = None):
+    ### report, when given, receives row_count, the offsets still failing after retries (and one re-warm)
+    ### and the worst final status among them
+    report = report if report is not None else {}
+    report["missing"] = []
+    report["status"] = 200
+    session = get_pooled_session(street_id, drive_id)
+    facet_response = fetch_first_page(session, sz)
+    rewarmed = False
+    if facet_response.status_code in SESSION_EXPIRED_STATUS:
+        rewarmed = True
+        METRICS.inc("session_rewarm_total")
+        invalidate_session(street_id, drive_id)
+        session = get_pooled_session(street_id, drive_id)
+        facet_response = fetch_first_page(session, sz)
+    if facet_response.status_code != 200:
+        raise RuntimeError(f"Failed to fetch products: {facet_response.status_code}")
+    row_count, entities = decodeFacet(facet_response.content)
+    report["row_count"] = row_count
+    offsets = list(range(sz, row_count, sz))
+    yield entities
+    del entities, facet_response
+    if not offsets:
+        return
+    client = runAsync(open_facet_client(session))
+    semaphore = asyncio.Semaphore(max_in_flight)
+    try:
+        for i in range(0, len(offsets), max_in_flight):
+            window = offsets[i:i + max_in_flight]
+            pages = dict(zip(window, runAsync(gather_facet_pages(client, semaphore, window, sz))))
+            expired = [start for start, page in pages.items() if isinstance(page, SessionExpired)]
+            if expired and not rewarmed:
+                rewarmed = True
+                METRICS.inc("session_rewarm_total")
+                invalidate_session(street_id, drive_id)
+                session = get_pooled_session(street_id, drive_id)
+                runAsync(client.close())
+                client = runAsync(open_facet_client(session))
+                failed = [start for start, page in pages.items() if isinstance(page, Exception)]
+                pages.update(zip(failed, runAsync(gather_facet_pages(client, semaphore, failed, sz))))
+            for start in window:
+                if isinstance(pages[start], Exception):
+                    report["missing"].append(start)
+                    report["status"] = worstStatus([report["status"], pageStatus(pages[start])])
+                    continue
+                yield pages.pop(start)
+    finally:
+        runAsync(client.close())
+
+def iter_extracted(pages):
+    for page in pages:
+        # extract_product_info also expands the children of each entity
+        with METRICS.timed("extraction"):
+            extracted = extract_product_info(page)
+        yield from extracted.values()
+
+### after its products every streamed store gets one status record,
+###   {"record": "store_status", "store": ..., "status": "ok" | "partial" | "failed", "products": n, ...}
+### so the records of a store that stopped or missed pages can be told apart from a complete one
+STATUS_RECORD = "store_status"
+
+def isStatusRecord(record: dict) -> bool:
+    return record.get("record") == STATUS_RECORD
+
+def streamStatus(path: str) -> dict:
+    ### {store: last status record} of a JSONL stream
+    statuses = {}
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            if STATUS_RECORD in line:
+                record = json.loads(line)
+                if isStatusRecord(record):
+                    statuses[record["store"]] = record
+    return statuses
+
+class JsonlSink:
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def write(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+def stream_store(store_info: dict, sink, store_key=None, sz: int = 99, max_in_flight: int = 8, report: dict = None) -> int:
+    street_id = str(store_info.get("street_id"))
+    drive_id = store_info.get("drive_id")
+    store_key = store_key if store_key is not None else street_id
+    count = 0
+    report = report if report is not None else {}
+    try:
+        for record in iter_extracted(iter_facet_pages(street_id, drive_id, sz, max_in_flight, report)):
+            record["store"] = store_key
+            sink.write(record)
+            count += 1
+    except Exception as e:
+        METRICS.inc("stores_total", result="failed")
+        logger.error(f"Streaming store {street_id} stopped after {count} products: {str(e)}")
+        sink.write({"record": STATUS_RECORD, "store": store_key, "status": "failed", "products": count,
+                    "row_count": report.get("row_count"), "error": str(e)})
+        return None
+    if report.get("missing"):
+        recordCoverage(store_key, report["row_count"], count, report["missing"], sz)
+    else:
+        METRICS.inc("stores_total", result="ok")
+    sink.write({"record": STATUS_RECORD, "store": store_key, "status": "partial" if report.get("missing") else "ok",
+                "products": count, "row_count": report.get("row_count"), "missing": report.get("missing", [])})
+    METRICS.inc("products_total", count)
+    logger.info("for store {} I streamed {} products".format(street_id, count))
+    return count
 
 
 #### PROD ENRICHMENT ####
@@ -257,121 +809,205 @@ def extractURL(attributes_list: list) -> str:
         if isinstance(attributes_list[i], dict) and attributes_list[i].get("key") == "canonical":
             return attributes_list[i].get("value")
 
-def extractIngredients(informations: list) -> str:
-    ingredients = [info for info in informations if info["label"] == "Ingredienti"]
-    if len(ingredients) > 0:
-        soup = BeautifulSoup(ingredients[0]["value"], 'html.parser')
-        ingredient_section = ingredient_section = soup.find('strong', text="Ingredienti").find_parent('p')
-        if ingredient_section:
-            ingredients_text = ingredient_section.get_text()
-            ingredients_text = ingredients_text.replace('Ingredienti', '').strip()
-            return ingredients_text
-    else:
-        print("No ingredients found.")
+### a single pass over the informations: each HTML fragment is parsed once (lxml when
+### available) and ingredients + allergens come out of the same "Ingredienti" soup
+def getInformation(informations: list, label: str) -> str:
+    for info in informations:
+        if info.get("label") == label:
+            return info.get("value")
+    return None
+
+def parseIngredients(soup) -> str:
+    strong = soup.find('strong', string="Ingredienti")
+    ingredient_section = strong.find_parent('p') if strong else None
+    if ingredient_section:
+        return ingredient_section.get_text().replace('Ingredienti', '').strip()
+    return ""
+
+def parseAllergeni(soup) -> dict:
+    strong = soup.find('strong', string="Allergeni")
+    if not strong or not strong.find_parent('p'):
         return ""
+    allergeni_text = soup.get_text(separator=" ").replace('Allergeni', '').strip().replace("\n", " ").replace("\t", "")
+    allergeni_dict = {
+        "Contiene": "",
+        "Potrebbe contenere": "",
+        "Non contiene": ""
+    }
+    if "Contiene :" in allergeni_text:
+        allergeni_dict["Contiene"] = allergeni_text.split("Contiene :")[1].split("Potrebbe contenere :")[0].strip()
+    if "Potrebbe contenere :" in allergeni_text:
+        allergeni_dict["Potrebbe contenere"] = allergeni_text.split("Potrebbe contenere :")[1].split("Non contiene :")[0].strip()
+    if "Non contiene :" in allergeni_text:
+        allergeni_dict["Non contiene"] = allergeni_text.split("Non contiene :")[1].strip()
+    return allergeni_dict
 
-def extractAllergeni(informations: list) -> str:
-    ingredients = [info for info in informations if info["label"] == "Ingredienti"]
-    if len(ingredients) > 0:
-        soup = BeautifulSoup(ingredients[0]["value"], 'html.parser')
-        allergeni_section = soup.find('strong', text="Allergeni").find_parent('p')
-        if allergeni_section:
-            allergeni_text = soup.get_text(separator=" ").replace('Allergeni', '').strip().replace("\n", " ").replace("\t", "")
-            allergeni_dict = {
-                "Contiene": "",
-                "Potrebbe contenere": "",
-                "Non contiene": ""
-            }
-            if "Contiene :" in allergeni_text:
-                contiene_part = allergeni_text.split("Contiene :")[1].split("Potrebbe contenere :")[0].strip()
-                allergeni_dict["Contiene"] = contiene_part
-            if "Potrebbe contenere :" in allergeni_text:
-                potrebbe_part = allergeni_text.split("Potrebbe contenere :")[1].split("Non contiene :")[0].strip()
-                allergeni_dict["Potrebbe contenere"] = potrebbe_part
-            if "Non contiene :" in allergeni_text:
-                non_contiene_part = allergeni_text.split("Non contiene :")[1].strip()
-                allergeni_dict["Non contiene"] = non_contiene_part
-            return allergeni_dict 
-    else:
-        print("No allergeni found.")
+def parseNutritionalFacts(soup) -> dict:
+    nutritional_values = {}
+    table = soup.find('table')
+    if table:
+        for row in table.find_all('tr')[1:]:
+            columns = row.find_all('td')
+            if len(columns) >= 2:
+                nutritional_values[columns[0].get_text(strip=True)] = columns[1].get_text(strip=True)
+    return nutritional_values
+
+def extractInformations(informations: list, parser: str = HTML_PARSER) -> tuple:
+    ingredients, allergenes, nutritional_facts = "", "", {}
+    ingredients_html = getInformation(informations, "Ingredienti")
+    if ingredients_html:
+        soup = BeautifulSoup(ingredients_html, parser)
+        ingredients = parseIngredients(soup)
+        allergenes = parseAllergeni(soup)
+    nutrition_html = getInformation(informations, "Valori nutrizionali")
+    if nutrition_html:
+        nutritional_facts = parseNutritionalFacts(BeautifulSoup(nutrition_html, parser))
+    return ingredients, allergenes, nutritional_facts
+
+def extractIngredients(informations: list, parser: str = HTML_PARSER) -> str:
+    ingredients_html = getInformation(informations, "Ingredienti")
+    if not ingredients_html:
+        logger.debug("No ingredients found.")
         return ""
+    return parseIngredients(BeautifulSoup(ingredients_html, parser))
 
-def extractNutritionalFacts(informations: list) -> dict:
-    vn = [info for info in informations if info["label"] == "Valori nutrizionali"]
-    if len(vn) > 0:
-        soup = BeautifulSoup(vn[0]["value"], 'html.parser')
-        table = soup.find('table')
-        nutritional_values = {}
-        table = soup.find('table')
-        if table:
-            for row in table.find_all('tr')[1:]: 
-                columns = row.find_all('td')
-                if len(columns) >= 2: 
-                    nutrient_name = columns[0].get_text(strip=True)
-                    nutrient_value = columns[1].get_text(strip=True)
-                    nutritional_values[nutrient_name] = nutrient_value
-        return nutritional_values
-    else:
+def extractAllergeni(informations: list, parser: str = HTML_PARSER) -> str:
+    ingredients_html = getInformation(informations, "Ingredienti")
+    if not ingredients_html:
+        logger.debug("No allergeni found.")
+        return ""
+    return parseAllergeni(BeautifulSoup(ingredients_html, parser))
+
+def extractNutritionalFacts(informations: list, parser: str = HTML_PARSER) -> dict:
+    nutrition_html = getInformation(informations, "Valori nutrizionali")
+    if not nutrition_html:
         return {}
+    return parseNutritionalFacts(BeautifulSoup(nutrition_html, parser))
 
-def getProductDetails(product_id):
+def flatten(nested: dict, parent_key: str = "", sep: str = "_") -> dict:
+    flat = {}
+    items = nested.items() if isinstance(nested, dict) else enumerate(nested)
+    for k, v in items:
+        key = f"{parent_key}{sep}{k}" if parent_key else str(k)
+        if isinstance(v, (dict, list)) and len(v) > 0:
+            flat.update(flatten(v, key, sep))
+        else:
+            flat[key] = v
+    return flat
+
+def parseProductDetails(payload: dict, parser: str = HTML_PARSER) -> dict:
+    url = extractURL(payload["seo"].get("attributes"))
+    ingredients, allergenes, nutritional_facts = extractInformations(payload["informations"], parser)
+    details = {}
+    if len(payload["familyChildren"]) == 0:
+        details = flatten(payload["displayableProduct"])
+        details["url"] = url
+        details["ingredients"] = ingredients
+        details["allergenes"] = allergenes
+        details["nutritional_facts"] = nutritional_facts
+    else:
+        product = flatten(payload["displayableProduct"])
+        for child in payload["familyChildren"]:
+            child_dict = dict(product)
+            child_dict["id"] = child["productId"]
+            child_dict["productId"] = child["productId"]
+            child_dict["productCode"] = child["productCode"]
+            child_dict["familyAttributes"] = child["familyAttributes"]
+            child_dict["sanitizeDescription"] = child["sanitizeDescription"]
+            child_dict["description"] = child["sanitizeDescription"]
+            child_dict["url"] = url
+            child_dict["ingredients"] = ingredients
+            child_dict["allergenes"] = allergenes
+            child_dict["nutritional_facts"] = nutritional_facts
+            details[child["productId"]] = child_dict
+    return details
+
+def getProductDetails(product_id, session=None):
     """
     !!! N.B.: product_id is the (product) code field in the product dicts: product.get("code") !!!
     """
-    url = "https://spesaonline.esselunga.it/commerce/resources/displayable/detail/code/"+str(product_id)
-    res = requests.get(url, headers={"accept": "application/json, text/plain, */*", "x-page-path": "supermercato"})
-    if res.status_code == 200:
-        # url
-        url = extractURL(res.json()["seo"].get("attributes"))
-        # ingredients
-        ingredients = extractIngredients(res.json()["informations"])
-        # allergeni
-        allergenes = extractAllergeni(res.json()["informations"])
-        # nutritional fact
-        nutritional_facts = extractNutritionalFacts(res.json()["informations"])
-        details = {}
-        if len(res.json()["familyChildren"]) == 0:
-            details = flatten(res.json()["displayableProduct"])
-            details["url"] = url
-            details["ingredients"] = ingredients
-            details["allergenes"] = allergenes
-            details["nutritional_facts"] = nutritional_facts
-        else:
-            for child in res.json()["familyChildren"]:
-                child_dict = flatten(res.json()["displayableProduct"])
-                child_dict["id"] = child["productId"]
-                child_dict["productId"] = child["productId"]
-                child_dict["productCode"] = child["productCode"]
-                child_dict["familyAttributes"] = child["familyAttributes"]
-                child_dict["sanitizeDescription"] = child["sanitizeDescription"]
-                child_dict["description"] = child["sanitizeDescription"]
-                child_dict["url"] = url
-                child_dict["ingredients"] = ingredients
-                child_dict["allergenes"] = allergenes
-                child_dict["nutritional_facts"] = nutritional_facts
-                details[child["productId"]] = child_dict
+    url = f"{BASE_URL}/commerce/resources/displayable/detail/code/"+str(product_id)
+    with METRICS.timed("enrichment"):
+        res = (session or STATELESS_SESSION).get(url, headers={"accept": "application/json, text/plain, */*", "x-page-path": "supermercato"})
+        if res.status_code != 200:
+            return None
+        return parseProductDetails(decodeDetail(res.content))
+
+### ingredients/allergens/nutrition are not store specific and almost never change,
+### so details are cached on disk by product code and only misses hit the backend
+DETAILS_CACHE_PATH = "product_details.sqlite"
+DETAILS_TTL = 30 * 24 * 3600
+DETAILS_MAX_ENTRIES = 200000
+
+def open_details_cache(path: str = DETAILS_CACHE_PATH) -> DiskCache:
+    return DiskCache(path, table="details", ttl=DETAILS_TTL, max_entries=DETAILS_MAX_ENTRIES)
+
+def create_details_session():
+    # details need no store cookies: a fresh session on the shared pool
+    return newSession()
+
+## family details are keyed by productId (int), the cache stores JSON (str keys): use str keys
+## everywhere so a cache hit and a fresh fetch return the same dict
+def normalizeDetails(details: dict) -> dict:
+    return None if details is None else {str(k): v for k, v in details.items()}
+
+def getProductDetailsCached(product_id, cache: DiskCache, session=None):
+    details = cache.get(product_id)
+    METRICS.inc("details_cache_total", result="hit" if details is not None else "miss")
+    if details is None:
+        details = normalizeDetails(getProductDetails(product_id, session))
+        if details is not None:
+            cache.set(product_id, details)
+    return details
+
+def collectProductCodes(catalogs) -> set:
+    ### accepts a ProductCatalog or any iterable of extract_product_info dicts
+    if isinstance(catalogs, ProductCatalog):
+        return {f.get("product_code") for f in catalogs.static if f.get("product_code")}
+    codes = set()
+    for products_extracted in catalogs:
+        codes.update(f.get("product_code") for f in products_extracted.values() if f.get("product_code"))
+    return codes
+
+def enrichProducts(product_codes, cache: DiskCache = None, max_workers: int = 16, batch: int = 200) -> dict:
+    cache = cache if cache is not None else open_details_cache()
+    codes = list(dict.fromkeys(str(c) for c in product_codes))
+    details = cache.get_many(codes)
+    misses = [c for c in codes if c not in details]
+    METRICS.inc("details_cache_total", len(details), result="hit")
+    METRICS.inc("details_cache_total", len(misses), result="miss")
+    logger.info("enrichment: {} codes, {} cached, {} to fetch".format(len(codes), len(details), len(misses)))
+    session = create_details_session()
+    fetched = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(getProductDetails, code, session): code for code in misses}
+        for future in as_completed(futures):
+            code = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.warning(f"Error enriching product {code}: {str(e)}")
+                continue
+            if result is not None:
+                fetched[code] = normalizeDetails(result)
+            if len(fetched) >= batch:
+                cache.set_many(fetched)
+                details.update(fetched)
+                fetched = {}
+    if fetched:
+        cache.set_many(fetched)
+        details.update(fetched)
+    session.close()
     return details
     
 #### END PROD ENRICHMENT ####
 
 
 def get_number_of_products(street_id, drive_id):
-    session = requests.Session()
-    initial_url = 'https://spesaonline.esselunga.it/commerce/nav/drive/store/home'
-    session.get(initial_url)
-    visit_url = f"https://spesaonline.esselunga.it/commerce/nav/drive/visit?streetId={street_id}&driveId={drive_id}"
-    session.get(visit_url)
-    url = "https://spesaonline.esselunga.it/commerce/resources/search/facet"
-    data = {
-        "query": "*",
-        "start": 0,
-        "length": 15,
-        "filters": []
-    }
-    response = session.post(url, json=data)
+    session = get_pooled_session(street_id, drive_id)
+    response = get_facet_data(session, 0, 15)
     if response.status_code == 200:
-        data = response.json()
-        return data["displayables"]["rowCount"]
+        return decodeFacet(response.content)[0]
     else:
         return f"Error: {response.status_code}"
 
@@ -397,15 +1033,15 @@ def assignStore(store_id: int, store_info: pd.DataFrame):
         possible = ''
         try:
             street_id = str(int(stores.street_id.values[0]))
-            session = create_session()
-            initial_request(session)
-            visit_supermarket(session, street_id)
+            session = get_pooled_session(street_id)
             facet_response = get_facet_data(session, 0)
-            target_prods = facet_response.json()["displayables"]["rowCount"]
+            if facet_response.status_code != 200:
+                raise RuntimeError(f"Failed to fetch products: {facet_response.status_code}")
+            target_prods = decodeFacet(facet_response.content)[0]
             all_products_data = fetch_all_products({"street_id": street_id}, sz=99)
             products_extracted = extract_product_info(all_products_data)
             target_prods_id = set(products_extracted.keys())
-            print(target_prods)
+            logger.debug(f"store {store_id}: {target_prods} products")
             for k in range(candidates.shape[0]):
                 drive_id = str(int(candidates.drive_id.values[k]))
                 street_id_can = str(int(candidates.street_id.values[k]))
@@ -414,7 +1050,7 @@ def assignStore(store_id: int, store_info: pd.DataFrame):
                 products_extracted_can = extract_product_info(all_products_data_can)
                 prods_id = set(products_extracted_can.keys())
                 x = str(candidates.name2.values[k])  
-                print(prods)
+                logger.debug(f"candidate {drive_id}: {prods} products")
                 common_ids = target_prods_id.intersection(prods_id)
                 target_p = {k: {"id": products_extracted[k].get("id"), "price": products_extracted[k].get("price")} for k in common_ids}
                 can_p = {k: {"id": products_extracted_can[k].get("id"), "price": products_extracted_can[k].get("price")} for k in common_ids}
@@ -427,7 +1063,7 @@ def assignStore(store_id: int, store_info: pd.DataFrame):
                     Match = drive_id
                     #Match.append(x)
         except Exception as e:
-            print(f"Error processing store {store_id}: {e}")
+            logger.error(f"Error processing store {store_id}: {e}")
             #Match.append("null")    
     return Match
 
@@ -440,6 +1076,72 @@ def assigner():
         assignment[sid] = m
     return assignment
 
+
+#### VECTORIZED ASSIGNMENT ####
+### every target store and every CLICCA E VAI/LOCKER candidate is scraped exactly once into
+### a ProductCatalog, then the assignStore score
+###     |n_target - n_candidate| + ||price_target - price_candidate||_2 over common products
+### is computed for all (target, candidate) pairs at once from the aligned price matrix.
+### n is the facet rowCount recorded by process_store, as in assignStore; catalogs built without
+### it (e.g. merged queue results) fall back to the number of priced products. Ties go to the
+### last candidate, like assignStore's `<=`
+def assignmentPlan(store_map: pd.DataFrame) -> tuple:
+    targets = [x for x in store_map.store_id.unique().tolist() if int(x) < 1000000]
+    is_candidate = (store_map.description.str.contains("LOCKER")) | (store_map.description.str.contains("CLICCA E VAI"))
+    candidates = store_map.loc[is_candidate & store_map.drive_id.notnull()].drop_duplicates("drive_id")
+    to_scrape = {}
+    for sid in targets:
+        street_id = int(store_map.loc[store_map.store_id == sid].street_id.values[0])
+        to_scrape[f"store_{sid}"] = {"street_id": street_id}
+    for _, row in candidates.iterrows():
+        to_scrape[f"drive_{int(row.drive_id)}"] = {"street_id": int(row.street_id), "drive_id": int(row.drive_id)}
+    return targets, candidates, to_scrape
+
+def scoreMatrix(catalog: ProductCatalog, target_keys: list, candidate_keys: list) -> np.ndarray:
+    _, _, prices = catalog.price_matrix(list(target_keys) + list(candidate_keys))
+    T, C = prices[:, :len(target_keys)], prices[:, len(target_keys):]
+    Mt, Mc = (~np.isnan(T)).astype(np.float64), (~np.isnan(C)).astype(np.float64)
+    T, C = np.nan_to_num(T), np.nan_to_num(C)
+    # sum over common products of (t - c)^2 = sum t^2 + sum c^2 - 2 sum t*c, each one a matmul
+    squared = (T ** 2).T @ Mc + Mt.T @ (C ** 2) - 2 * T.T @ C
+    distance = np.sqrt(np.clip(squared, 0, None))
+    counts = np.abs(catalog.row_counts(target_keys)[:, None] - catalog.row_counts(candidate_keys)[None, :])
+    return counts + distance
+
+def assignStores_vectorized(store_map: pd.DataFrame, catalog: ProductCatalog = None) -> dict:
+    targets, candidates, to_scrape = assignmentPlan(store_map)
+    if catalog is None:
+        catalog = main(to_scrape, catalog=ProductCatalog())
+    target_keys = [f"store_{sid}" for sid in targets]
+    candidate_keys = [f"drive_{int(d)}" for d in candidates.drive_id]
+    scraped_targets = [k in catalog.stores for k in target_keys]
+    scraped_candidates = np.array([k in catalog.stores for k in candidate_keys], dtype=bool)
+    scores = np.full((len(target_keys), len(candidate_keys)), np.inf)
+    rows = [i for i, ok in enumerate(scraped_targets) if ok]
+    cols = np.flatnonzero(scraped_candidates)
+    if rows and len(cols):
+        scores[np.ix_(rows, cols)] = scoreMatrix(catalog, [target_keys[i] for i in rows],
+                                                 [candidate_keys[j] for j in cols])
+    # a candidate is only eligible for targets sharing one of its CAPs
+    target_caps = [set(store_map.loc[store_map.store_id == sid].cap) for sid in targets]
+    eligible = np.array([[cap in caps for cap in candidates.cap] for caps in target_caps], dtype=bool)
+    scores[~eligible] = np.inf
+    assignment = {}
+    for i, sid in enumerate(targets):
+        n_rows = int((store_map.store_id == sid).sum())
+        if n_rows == 1 and eligible[i].sum() == 1:
+            assignment[sid] = {sid: candidates.name2.values[eligible[i]][0]}
+        elif np.isfinite(scores[i]).any():
+            # last of the minimal scores, assignStore kept updating the match on `<=`
+            best = len(scores[i]) - 1 - int(np.argmin(scores[i][::-1]))
+            assignment[sid] = str(int(candidates.drive_id.values[best]))
+        else:
+            assignment[sid] = ''
+    return assignment
+
+def assigner_vectorized(path: str = "C:/Python312/map_stores_to_storeid.xlsx") -> dict:
+    return assignStores_vectorized(pd.read_excel(path))
+
 def storesToScrape():
     store_map = pd.read_excel("C:/Python312/map_stores_to_storeid.xlsx")
     stores = {}
@@ -460,19 +1162,80 @@ def storesToScrape():
     return stores
 
 
-def main(store_info):
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        futures = {executor.submit(process_store, store_info[k]): k for k in store_info.keys()}
-        for future in as_completed(futures):
-            store_index = futures[future]
-            try:
-                future.result()
-            except Exception as e:
-                print(f"Error processing store {store_index}: {str(e)}")
+def process_store_limited(store_info: dict, catalog: ProductCatalog = None, store_key=None, snapshot_root: str = None, sink=None,
+                          history: PriceHistory = None):
+    ### the executor is sized for the upper bound, STORE_LIMITER decides how many actually run
+    STORE_LIMITER.acquire()
+    started = time.time()
+    status = None
+    report = {}
+    METRICS.gauge("stores_in_flight", 1)
+    try:
+        if sink is not None:
+            streamed = stream_store(store_info, sink, store_key, report=report)
+            status = report.get("status", 200) if streamed is not None else None
+            return streamed
+        # with a catalog the per-store result is only transient: keep it compact
+        products_extracted = process_store(store_info, catalog=catalog, store_key=store_key, snapshot_root=snapshot_root,
+                                           compact=catalog is not None, history=history, report=report)
+        status = report.get("status", 200) if products_extracted is not None else None
+        return None if catalog is not None else products_extracted
+    finally:
+        METRICS.gauge("stores_in_flight", -1)
+        METRICS.observe("store_seconds", time.time() - started, kind="drive" if store_info.get("drive_id") else "supermarket")
+        # the store limit sees the worst page outcome of the store: pages lost to 429/5xx/timeouts
+        # back it off like the page limit, and so does a store that failed altogether (status None)
+        STORE_LIMITER.release(time.time() - started, status)
+
+def logMetricsSummary():
+    ### one line per stage/endpoint: count, p50/p99 (bucket upper bounds) and total seconds
+    for h in METRICS.to_dict()["histograms"]:
+        logger.info("{} {}: n={} p50<={}s p99<={}s total={:.1f}s".format(
+            h["name"], h["labels"], h["count"], h["p50"], h["p99"], h["sum"]))
+
+### metrics_prefix writes <prefix>.prom / <prefix>.json at the end of the run,
+### profile_path turns on the sampling profiler and writes collapsed stacks there,
+### history appends every store's prices to a PriceHistory (see Esselunga_history),
+### sink streams products out page by page instead (not together with catalog/snapshot_root/history)
+def main(store_info, session_pool_path: str = None, catalog: ProductCatalog = None, snapshot_root: str = None, sink=None,
+         metrics_prefix: str = None, profile_path: str = None, history: PriceHistory = None):
+    if sink is not None and (catalog is not None or snapshot_root or history is not None):
+        # a sink gets products page by page, the others need each store whole
+        raise ValueError("sink can not be combined with catalog, snapshot_root or history")
+    profiler = SamplingProfiler().start() if profile_path else None
+    if session_pool_path:
+        load_session_pool(session_pool_path)
+    try:
+        with ThreadPoolExecutor(max_workers=STORE_LIMITER.max_limit) as executor:
+            futures = {executor.submit(process_store_limited, store_info[k], catalog, k, snapshot_root, sink, history): k for k in store_info.keys()}
+            for done, future in enumerate(as_completed(futures), 1):
+                store_index = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    METRICS.inc("stores_total", result="error")
+                    logger.error(f"Error processing store {store_index}: {str(e)}")
+                logger.info(f"{done}/{len(futures)} stores, stores: {STORE_LIMITER.stats()} pages: {PAGE_LIMITER.stats()}")
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            profiler.write(profile_path)
+        logMetricsSummary()
+        if STORE_COVERAGE:
+            logger.warning(f"{len(STORE_COVERAGE)} stores scraped partially: {sorted(STORE_COVERAGE)}")
+        if metrics_prefix:
+            METRICS.write_report(metrics_prefix)
+            with open(metrics_prefix + "_coverage.json", "w") as file:
+                json.dump(STORE_COVERAGE, file, indent=1)
+    if session_pool_path:
+        save_session_pool(session_pool_path)
+    return catalog
 
 
 
-stores = storesToScrape()
-start = time.time()
-main(stores)
-print(f"Time taken: {time.time() - start:.2f} seconds")
+if __name__ == "__main__":
+    stores = storesToScrape()
+    start = time.time()
+    catalog = main(stores, catalog=ProductCatalog(), metrics_prefix="metrics_" + time.strftime("%Y%m%d_%H%M%S"),
+                   history=PriceHistory())
+    logger.info(f"Time taken: {time.time() - start:.2f} seconds")
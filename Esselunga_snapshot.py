@@ -0,0 +1,129 @@
+import logging
+import os
+from datetime import date as dt_date
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+### snapshots are written as Parquet, partitioned hive-style:
+###   <root>/date=YYYY-MM-DD/store=<store_id>/products.parquet
+### deltas against the previous snapshot of the same store go next to them:
+###   <root>/deltas/date=YYYY-MM-DD/store=<store_id>/changes.parquet
+SNAPSHOT_COLUMNS = ["id", "product_code", "name", "brand", "unit_price", "price", "disc_price", "oos",
+                    "quantity", "variable_weight", "prod_type", "unit_text", "unit_value", "barcode",
+                    "promo_type", "promo_start", "promo_end"]
+
+
+def productsToFrame(products_extracted: dict) -> pd.DataFrame:
+    rows = []
+    for fields in products_extracted.values():
+        row = {k: fields.get(k) for k in SNAPSHOT_COLUMNS if not k.startswith("promo_")}
+        promo = fields.get("promo") or {}
+        row["promo_type"] = promo.get("promoType")
+        row["promo_start"] = promo.get("start")
+        row["promo_end"] = promo.get("end")
+        rows.append(row)
+    df = pd.DataFrame(rows, columns=SNAPSHOT_COLUMNS)
+    df["id"] = df["id"].astype(str)
+    df["price"] = pd.to_numeric(df["price"], errors="coerce")
+    df["disc_price"] = pd.to_numeric(df["disc_price"], errors="coerce")
+    df["oos"] = df["oos"].fillna(False).astype(bool)
+    for col in ["product_code", "name", "brand", "unit_price", "prod_type", "unit_text", "unit_value", "barcode",
+                "promo_type", "promo_start", "promo_end", "quantity", "variable_weight"]:
+        df[col] = df[col].map(lambda x: None if x is None or (isinstance(x, float) and np.isnan(x)) else str(x))
+    return df
+
+
+def snapshotPath(root: str, store_id, date: str) -> str:
+    return os.path.join(root, f"date={date}", f"store={store_id}", "products.parquet")
+
+def deltaPath(root: str, store_id, date: str) -> str:
+    return os.path.join(root, "deltas", f"date={date}", f"store={store_id}", "changes.parquet")
+
+def listSnapshotDates(root: str, store_id=None) -> list:
+    if not os.path.isdir(root):
+        return []
+    dates = []
+    for d in os.listdir(root):
+        if not d.startswith("date="):
+            continue
+        if store_id is None or os.path.exists(snapshotPath(root, store_id, d[5:])):
+            dates.append(d[5:])
+    return sorted(dates)
+
+def previousSnapshotDate(root: str, store_id, date: str) -> str:
+    previous = [d for d in listSnapshotDates(root, store_id) if d < date]
+    return previous[-1] if previous else None
+
+def writeSnapshot(products_extracted: dict, store_id, root: str = "snapshots", date: str = None) -> str:
+    date = date or dt_date.today().isoformat()
+    path = snapshotPath(root, store_id, date)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    productsToFrame(products_extracted).to_parquet(path, index=False)
+    return path
+
+def loadSnapshot(store_id, date: str, root: str = "snapshots") -> pd.DataFrame:
+    return pd.read_parquet(snapshotPath(root, store_id, date))
+
+
+#### DELTA ####
+def computeDelta(previous: pd.DataFrame, current: pd.DataFrame) -> pd.DataFrame:
+    merged = previous.merge(current, on="id", how="outer", suffixes=("_old", "_new"), indicator=True)
+    both = merged["_merge"] == "both"
+
+    def changed(col: str) -> pd.Series:
+        old, new = merged[col + "_old"], merged[col + "_new"]
+        return ~((old == new) | (old.isna() & new.isna()))
+
+    had_promo = merged["promo_type_old"].notna()
+    has_promo = merged["promo_type_new"].notna()
+    masks = {
+        "new": merged["_merge"] == "right_only",
+        "removed": merged["_merge"] == "left_only",
+        "price": both & (changed("price") | changed("disc_price")),
+        "promo_start": both & ~had_promo & has_promo,
+        "promo_end": both & had_promo & ~has_promo,
+        "oos": both & changed("oos")
+    }
+    columns = ["id", "name_old", "name_new", "price_old", "price_new", "disc_price_old", "disc_price_new",
+               "promo_type_old", "promo_type_new", "promo_start_new", "promo_end_new", "oos_old", "oos_new"]
+    changes = []
+    for change, mask in masks.items():
+        if mask.any():
+            part = merged.loc[mask, columns].copy()
+            part.insert(1, "change", change)
+            changes.append(part)
+    if not changes:
+        return pd.DataFrame(columns=["id", "change"] + columns[3:] + ["name"])
+    delta = pd.concat(changes, ignore_index=True)
+    delta["name"] = delta["name_new"].fillna(delta["name_old"])
+    delta = delta.drop(columns=["name_new", "name_old"])
+    delta["oos_old"] = delta["oos_old"].astype(object).where(delta["oos_old"].notna(), None)
+    delta["oos_new"] = delta["oos_new"].astype(object).where(delta["oos_new"].notna(), None)
+    return delta.replace({np.nan: None})
+
+## write today's snapshot and the change set against the previous one (None on the first run)
+def snapshotStore(products_extracted: dict, store_id, root: str = "snapshots", date: str = None) -> pd.DataFrame:
+    date = date or dt_date.today().isoformat()
+    writeSnapshot(products_extracted, store_id, root, date)
+    previous_date = previousSnapshotDate(root, store_id, date)
+    if previous_date is None:
+        return None
+    delta = computeDelta(loadSnapshot(store_id, previous_date, root), loadSnapshot(store_id, date, root))
+    path = deltaPath(root, store_id, date)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    delta.to_parquet(path, index=False)
+    logger.info("store {}: {} changes since {}".format(store_id, len(delta), previous_date))
+    return delta
+
+def loadDeltas(date: str, root: str = "snapshots") -> pd.DataFrame:
+    base = os.path.join(root, "deltas", f"date={date}")
+    if not os.path.isdir(base):
+        return pd.DataFrame()
+    frames = []
+    for d in sorted(os.listdir(base)):
+        df = pd.read_parquet(os.path.join(base, d, "changes.parquet"))
+        df.insert(0, "store", d[len("store="):])
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
@@ -0,0 +1,97 @@
+import json
+import os
+import numpy as np
+
+### compact store <-> street map: store_to_map_new.json holds {store_id: [street_id, ...]} as strings,
+### here it becomes sorted int arrays (CSR style) saved as .npy so they can be memory-mapped:
+###   stores[i]                          sorted store ids
+###   streets[offsets[i]:offsets[i+1]]   sorted street ids of stores[i]
+###   rev_streets / rev_stores           every street id (sorted) and the store delivering it
+STOREMAP_ARRAYS = ("stores", "offsets", "streets", "rev_streets", "rev_stores")
+# ids are well below 2**31, int32 halves the footprint of the int64 default
+ID_DTYPE = np.int32
+
+
+class StoreMap:
+    def __init__(self, stores, offsets, streets, rev_streets, rev_stores):
+        self.stores = stores
+        self.offsets = offsets
+        self.streets = streets
+        self.rev_streets = rev_streets
+        self.rev_stores = rev_stores
+
+    def __len__(self) -> int:
+        return len(self.stores)
+
+    @classmethod
+    def from_dict(cls, ssmap: dict) -> "StoreMap":
+        stores = np.array(sorted(int(k) for k in ssmap.keys()), dtype=ID_DTYPE)
+        lists = [np.unique(np.array([int(s) for s in ssmap[str(k)] if str(s).isdigit()], dtype=ID_DTYPE))
+                 for k in stores]
+        offsets = np.zeros(len(stores) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(l) for l in lists])
+        streets = np.concatenate(lists) if lists else np.zeros(0, dtype=ID_DTYPE)
+        owners = np.repeat(stores, np.diff(offsets))
+        order = np.argsort(streets, kind="stable")
+        rev_streets, first = np.unique(streets[order], return_index=True)
+        # a street listed under several stores keeps the lowest store id
+        rev_stores = owners[order][first]
+        return cls(stores, offsets, streets, rev_streets, rev_stores)
+
+    @classmethod
+    def from_json(cls, path: str = "store_to_map_new.json") -> "StoreMap":
+        with open(path, "r") as file:
+            return cls.from_dict(json.load(file))
+
+    @classmethod
+    def load(cls, directory: str = "store_map", mmap: bool = True) -> "StoreMap":
+        mode = "r" if mmap else None
+        return cls(*(np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mode) for name in STOREMAP_ARRAYS))
+
+    def save(self, directory: str = "store_map"):
+        os.makedirs(directory, exist_ok=True)
+        for name in STOREMAP_ARRAYS:
+            np.save(os.path.join(directory, f"{name}.npy"), np.ascontiguousarray(getattr(self, name)))
+
+    ## street ids delivered by a store, O(log n)
+    def streets_of(self, store_id) -> np.ndarray:
+        i = int(np.searchsorted(self.stores, int(store_id)))
+        if i >= len(self.stores) or self.stores[i] != int(store_id):
+            return np.zeros(0, dtype=ID_DTYPE)
+        return self.streets[self.offsets[i]:self.offsets[i + 1]]
+
+    ## store delivering a street, O(log n), None if unknown
+    def store_of(self, street_id):
+        i = int(np.searchsorted(self.rev_streets, int(street_id)))
+        if i >= len(self.rev_streets) or self.rev_streets[i] != int(street_id):
+            return None
+        return int(self.rev_stores[i])
+
+    ## vectorized store_of, -1 where the street is unknown
+    def store_of_many(self, street_ids) -> np.ndarray:
+        street_ids = np.asarray(street_ids, dtype=np.int64)
+        if len(self.rev_streets) == 0:
+            return np.full(street_ids.shape, -1, dtype=np.int64)
+        i = np.clip(np.searchsorted(self.rev_streets, street_ids), 0, len(self.rev_streets) - 1)
+        return np.where(self.rev_streets[i] == street_ids, self.rev_stores[i], -1)
+
+    def to_dict(self) -> dict:
+        return {str(s): [str(x) for x in self.streets_of(s)] for s in self.stores}
+
+
+def convertStoreMap(json_path: str = "store_to_map_new.json", directory: str = "store_map") -> StoreMap:
+    store_map = StoreMap.from_json(json_path)
+    store_map.save(directory)
+    print("converted {} stores / {} streets to {}".format(len(store_map), len(store_map.rev_streets), directory))
+    return store_map
+
+## memory-mapped map, rebuilt from the JSON whenever the JSON is newer than the binary copy
+def loadStoreMap(json_path: str = "store_to_map_new.json", directory: str = "store_map") -> StoreMap:
+    marker = os.path.join(directory, "rev_stores.npy")
+    if not os.path.exists(marker) or (os.path.exists(json_path) and os.path.getmtime(json_path) > os.path.getmtime(marker)):
+        convertStoreMap(json_path, directory)
+    return StoreMap.load(directory)
+
+
+if __name__ == "__main__":
+    convertStoreMap()
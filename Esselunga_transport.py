@@ -0,0 +1,205 @@
+import asyncio
+import atexit
+import os
+import ssl
+import threading
+import time
+from datetime import timedelta
+from email.message import Message
+from http.cookiejar import DefaultCookiePolicy
+import requests
+from requests.adapters import HTTPAdapter, BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers, select_proxy, DEFAULT_CA_BUNDLE_PATH
+from Esselunga_metrics import instrumentSession
+try:
+    import httpx
+    import h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+#### SHARED TRANSPORT ####
+### one connection pool per process, shared by every stage: each requests.Session keeps its own
+### cookie jar (sessions are bound to a store through cookies) but they all mount the same adapter,
+### so a warm-up, a facet page, a detail call and a trolley probe reuse the same keep-alive
+### connections instead of paying a TLS handshake each. The aiohttp facet clients share one
+### connector on one background event loop for the same reason.
+### ESSELUNGA_HTTP2=1 routes https through httpx with HTTP/2 multiplexing when httpx[http2] is installed.
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = int(os.environ.get("ESSELUNGA_POOL_MAXSIZE", 64))
+ASYNC_POOL_LIMIT = int(os.environ.get("ESSELUNGA_ASYNC_POOL_LIMIT", 100))
+HTTP2 = os.environ.get("ESSELUNGA_HTTP2") == "1"
+
+
+class SharedAdapter(HTTPAdapter):
+    ### Session.close() closes its adapters; the shared pool outlives any single session
+    def close(self):
+        pass
+
+    def shutdown(self):
+        super().close()
+
+
+class _RawResponse:
+    ### just enough of urllib3's response for requests to read cookies and release it
+    def __init__(self, headers):
+        msg = Message()
+        for k, v in headers.multi_items():
+            msg[k] = v
+        self._original_response = type("OriginalResponse", (), {"msg": msg})()
+
+    def release_conn(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def sslContext(verify, cert) -> ssl.SSLContext:
+    ### requests' verify (bool or CA bundle path) and cert (path or (cert, key)) as an ssl context for httpx
+    if verify is False:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif isinstance(verify, str) and os.path.isdir(verify):
+        context = ssl.create_default_context(capath=verify)
+    else:
+        context = ssl.create_default_context(cafile=verify if isinstance(verify, str) else DEFAULT_CA_BUNDLE_PATH)
+    if cert:
+        context.load_cert_chain(*cert) if isinstance(cert, (tuple, list)) else context.load_cert_chain(cert)
+    return context
+
+
+class Http2Adapter(BaseAdapter):
+    ### requests adapter on top of an httpx HTTP/2 transport: many concurrent requests are
+    ### multiplexed on a single connection per host. The transport has no cookie handling,
+    ### cookies stay in the jar of the requests.Session that sent the request.
+    ### verify/cert/proxies are honoured with one transport per distinct setting.
+    def __init__(self, max_connections: int = POOL_CONNECTIONS * 4):
+        super().__init__()
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self._transports = {}
+        self._lock = threading.Lock()
+        self.transport = self.transportFor(True, None, None)
+
+    def transportFor(self, verify, cert, proxy) -> "httpx.HTTPTransport":
+        key = (verify, tuple(cert) if isinstance(cert, list) else cert, proxy)
+        with self._lock:
+            transport = self._transports.get(key)
+            if transport is None:
+                # the default setting keeps httpx's own ssl context
+                context = True if verify is True and not cert else sslContext(verify, cert)
+                transport = httpx.HTTPTransport(http2=True, limits=self.limits, verify=context, proxy=proxy)
+                self._transports[key] = transport
+        return transport
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        else:
+            timeout = httpx.Timeout(timeout)
+        transport = self.transportFor(verify, cert, select_proxy(request.url, proxies or {}))
+        body = request.body.encode("utf-8") if isinstance(request.body, str) else request.body
+        started = time.perf_counter()
+        try:
+            r = transport.handle_request(httpx.Request(request.method, request.url, headers=dict(request.headers),
+                                                       content=body, extensions={"timeout": timeout.as_dict()}))
+        except httpx.TimeoutException as e:
+            raise requests.Timeout(e, request=request)
+        except httpx.TransportError as e:
+            raise requests.ConnectionError(e, request=request)
+        try:
+            content = r.read()
+        finally:
+            r.close()
+        elapsed = time.perf_counter() - started
+        response = requests.Response()
+        response.status_code = r.status_code
+        response.headers = CaseInsensitiveDict(r.headers.multi_items())
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.reason = r.extensions.get("reason_phrase", b"").decode("latin-1")
+        response.raw = _RawResponse(r.headers)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response._content = content
+        response._content_consumed = True
+        response.elapsed = timedelta(seconds=elapsed)
+        return response
+
+    def close(self):
+        pass
+
+    def shutdown(self):
+        with self._lock:
+            transports, self._transports = list(self._transports.values()), {}
+        for transport in transports:
+            transport.close()
+
+
+SHARED_ADAPTER = SharedAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=0)
+HTTP2_ADAPTER = Http2Adapter() if HTTP2 and HTTP2_AVAILABLE else None
+
+
+def mountShared(session: requests.Session, http2: bool = None) -> requests.Session:
+    http2 = HTTP2_ADAPTER is not None if http2 is None else http2
+    session.mount("http://", SHARED_ADAPTER)
+    session.mount("https://", HTTP2_ADAPTER if http2 and HTTP2_ADAPTER is not None else SHARED_ADAPTER)
+    return session
+
+def newSession(headers: dict = None, http2: bool = None) -> requests.Session:
+    ### a cookie-isolated session on the shared pool, instrumented like every other session
+    session = mountShared(requests.Session(), http2)
+    if headers:
+        session.headers.update(headers)
+    return instrumentSession(session)
+
+## for calls that need no state (drive lookups, product details): cookies are neither stored nor sent
+STATELESS_SESSION = newSession()
+STATELESS_SESSION.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+
+#### SHARED ASYNC TRANSPORT ####
+### one event loop thread with one aiohttp connector; coroutines from any thread run on it
+### through runAsync, and every facet client opened on it keeps its own cookie jar
+_LOOP = None
+_CONNECTOR = None
+_LOOP_LOCK = threading.Lock()
+
+def eventLoop() -> asyncio.AbstractEventLoop:
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            _LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_LOOP.run_forever, name="transport-loop", daemon=True).start()
+        return _LOOP
+
+def runAsync(coro, timeout: float = None):
+    return asyncio.run_coroutine_threadsafe(coro, eventLoop()).result(timeout)
+
+def sharedConnector():
+    ### only valid on the transport loop, i.e. inside coroutines passed to runAsync
+    import aiohttp
+    global _CONNECTOR
+    if _CONNECTOR is None or _CONNECTOR.closed:
+        _CONNECTOR = aiohttp.TCPConnector(limit=ASYNC_POOL_LIMIT, ttl_dns_cache=300, keepalive_timeout=60)
+    return _CONNECTOR
+
+def closeTransport(timeout: float = 5.0):
+    ### closes the shared connector and stops the loop thread; both are recreated on next use.
+    ### Registered with atexit, so pooled connections survive repeated main() calls in one process
+    global _LOOP, _CONNECTOR
+    with _LOOP_LOCK:
+        loop, connector = _LOOP, _CONNECTOR
+        _LOOP = _CONNECTOR = None
+    if loop is None:
+        return
+    if connector is not None and not connector.closed:
+        try:
+            asyncio.run_coroutine_threadsafe(connector.close(), loop).result(timeout)
+        except Exception:
+            pass
+    loop.call_soon_threadsafe(loop.stop)
+
+atexit.register(closeTransport)
@@ -12,14 +12,36 @@ import aiohttp
 import asyncio
 import nest_asyncio
 import random
+import logging
 from tqdm import tqdm
 import pandas as pd
 import time
+import os
+from Esselunga_cache import DiskCache
+from Esselunga_metrics import METRICS
+from Esselunga_transport import newSession, STATELESS_SESSION
+from Esselunga_decode import decodeFacet
+from collections import defaultdict
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+try:
+    from rapidfuzz import process as fuzz_process
+    from rapidfuzz.distance import Levenshtein
+except ImportError:
+    fuzz_process = None
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# overridable so the discovery stage can be pointed at a local stand-in (see benchmarks/mock_backend.py)
+BASE_URL = os.environ.get("ESSELUNGA_BASE_URL", "https://spesaonline.esselunga.it")
 
 ### retrieve the list of physical stores:
 def getEsselungaStoresList():
     url = "https://www.esselunga.it/services/istituzionale35/all-stores.json"
-    response = requests.get(url)
+    response = STATELESS_SESSION.get(url)
     response.raise_for_status()
     return response.json()
 
@@ -48,35 +70,97 @@ def getEsselungaStoresInfo(stores: dict) -> dict:
             stores_dict[store["abbrev"]] = temp
     return stores_dict
 
+headers_template = {
+    'Accept': 'application/json, text/plain, */*',
+    'Accept-Encoding': 'gzip, deflate, br, zstd',
+    'Accept-Language': 'it-IT,it;q=0.9,en-US;q=0.8,en;q=0.7',
+    'Sec-Fetch-Dest': 'empty',
+    'Sec-Fetch-Mode': 'cors',
+    'Sec-Fetch-Site': 'same-origin',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36'
+}
+
 ### get the list of streets_id for each post code where there is a store.
 ### this returns a tuple (dict of streets, list with streets not found)
 ### the streets not found are usually due to lost/aborted connections
 def getStreetsId(stores: dict) -> Tuple[dict, List]:
-    headers_template = {
-        'Accept': 'application/json, text/plain, */*',
-        'Accept-Encoding': 'gzip, deflate, br, zstd',
-        'Accept-Language': 'it-IT,it;q=0.9,en-US;q=0.8,en;q=0.7',
-        'Sec-Fetch-Dest': 'empty',
-        'Sec-Fetch-Mode': 'cors',
-        'Sec-Fetch-Site': 'same-origin',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36'
-    }
     streets_DB = {}
     postcode_errors = []
     for k in stores.keys():
         store = stores[k]
         postcode = store.get('CAP')
-        res = requests.post('https://spesaonline.esselunga.it/commerce/resources/onboarding/postcode/check', json={"postcode":postcode}, headers=headers_template)
+        res = STATELESS_SESSION.post(f'{BASE_URL}/commerce/resources/onboarding/postcode/check', json={"postcode":postcode}, headers=headers_template)
         if res.status_code ==200:#.json()["code"] == "SUPPORTED":
-            available = requests.post("https://spesaonline.esselunga.it/commerce/resources/onboarding/street/suggestions", json={"postcode":postcode}, headers=headers_template)
+            available = STATELESS_SESSION.post(f"{BASE_URL}/commerce/resources/onboarding/street/suggestions", json={"postcode":postcode}, headers=headers_template)
             for ava in available.json():
                 streets_DB[ava.get("id")] = ava
         else:
             postcode_errors.append(postcode)
     if len(postcode_errors) > 0:
-        print("I didn't find {} postcodes.".format(len(postcode_errors)))
+        logger.warning("I didn't find {} postcodes.".format(len(postcode_errors)))
+    else:
+        logger.info("All postcodes found.")
+    return streets_DB, postcode_errors
+
+### same discovery, but each CAP is queried once, concurrently, over one pooled session.
+### results are cached on disk per postcode and later rounds only retry the postcode_errors
+# session-level copy of the headers getStreetsId sends with every request
+POSTCODE_HEADERS = dict(headers_template)
+POSTCODE_CACHE_PATH = "postcodes.sqlite"
+POSTCODE_TTL = 7 * 24 * 3600
+
+def createPooledSession(headers: dict = None) -> requests.Session:
+    # connections come from the process-wide pool in Esselunga_transport
+    return newSession(headers)
+
+def fetchPostcodeStreets(session: requests.Session, postcode: str) -> list:
+    res = session.post(f'{BASE_URL}/commerce/resources/onboarding/postcode/check', json={"postcode": postcode}, timeout=20)
+    if res.status_code != 200:
+        return None
+    available = session.post(f"{BASE_URL}/commerce/resources/onboarding/street/suggestions", json={"postcode": postcode}, timeout=20)
+    if available.status_code != 200:
+        return None
+    return available.json()
+
+def getStreetsId_parallel(stores: dict, cache: DiskCache = None, max_workers: int = 16, retries: int = 2) -> Tuple[dict, List]:
+    postcodes = list(dict.fromkeys(str(stores[k].get('CAP')) for k in stores.keys() if stores[k].get('CAP')))
+    cache = cache if cache is not None else DiskCache(POSTCODE_CACHE_PATH, table="postcodes", ttl=POSTCODE_TTL)
+    found = cache.get_many(postcodes)
+    postcode_errors = [p for p in postcodes if p not in found]
+    logger.info("{} stores, {} distinct postcodes, {} cached".format(len(stores), len(postcodes), len(found)))
+    session = createPooledSession(POSTCODE_HEADERS)
+    for attempt in range(retries + 1):
+        if not postcode_errors:
+            break
+        if attempt > 0:
+            time.sleep(2 ** (attempt - 1))
+        todo, postcode_errors, fetched = postcode_errors, [], {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(fetchPostcodeStreets, session, p): p for p in todo}
+            for future in as_completed(futures):
+                postcode = futures[future]
+                try:
+                    result = future.result()
+                except Exception as exc:
+                    logger.warning(f"Postcode {postcode} generated an exception: {exc}")
+                    result = None
+                if result is None:
+                    postcode_errors.append(postcode)
+                else:
+                    fetched[postcode] = result
+        cache.set_many(fetched)
+        found.update(fetched)
+    session.close()
+    streets_DB = {}
+    for postcode in postcodes:
+        for ava in found.get(postcode, []):
+            streets_DB[ava.get("id")] = ava
+    METRICS.inc("postcodes_total", len(postcodes) - len(postcode_errors), result="ok")
+    METRICS.inc("postcodes_total", len(postcode_errors), result="failed")
+    if len(postcode_errors) > 0:
+        logger.warning("I didn't find {} postcodes.".format(len(postcode_errors)))
     else:
-        print("All postcodes found.")
+        logger.info("All postcodes found.")
     return streets_DB, postcode_errors
 
 ### The following 3 functions are used to retrieve the maximum number of stores/lockers
@@ -84,16 +168,19 @@ def getStoresId_list(streets: list, length: int) -> dict:
     storesId = {}
     counter = length
     for k in streets:
-        url_drive = "https://spesaonline.esselunga.it/commerce/resources/onboarding/drives/" + str(k) 
-        res = requests.get(url_drive)
+        url_drive = f"{BASE_URL}/commerce/resources/onboarding/drives/" + str(k) 
+        res = STATELESS_SESSION.get(url_drive)
+        if res.status_code != 200:
+            continue
         for r in res.json():
             storesId[counter] = r
             counter+=1
     return storesId
 
 def fetch_store_data(street_id: str) -> list:
-    url_drive = f"https://spesaonline.esselunga.it/commerce/resources/onboarding/drives/{street_id}"
-    response = requests.get(url_drive)
+    url_drive = f"{BASE_URL}/commerce/resources/onboarding/drives/{street_id}"
+    response = STATELESS_SESSION.get(url_drive)
+    response.raise_for_status()
     return response.json()
 
 def getStoresId_parallel(streets: dict) -> Tuple[dict, dict, List]:
@@ -113,9 +200,9 @@ def getStoresId_parallel(streets: dict) -> Tuple[dict, dict, List]:
                     storesId[counter] = r
                     counter += 1
             except Exception as exc:
-                print(f"Street {future_to_street[future]} generated an exception: {exc}")
+                logger.warning(f"Street {future_to_street[future]} generated an exception: {exc}")
                 errors.append(future_to_street[future])
-    print("number of streets missed: {}".format(len(errors))) #len(errors) is < len(new_storesId.keys()) because the list returned by requests.get(url_drive) has len >= 1
+    logger.info("number of streets missed: {}".format(len(errors))) #len(errors) is < len(new_storesId.keys()) because the list returned by requests.get(url_drive) has len >= 1
     if len(errors) >0:
         new_storesId = getStoresId_list(errors, len(storesId.keys()))
         return storesId, new_storesId, errors
@@ -151,31 +238,94 @@ def filterDict(storesId: dict, city: str, postcode: str) -> bool:
 def getDistance(lat1: float, long1: float, lat2: float, long2: float) -> float:
     return np.sqrt((lat2 - lat1)**2 + (long2 - long1)**2)
 
+## great-circle distance in km, works on scalars and numpy arrays
+EARTH_RADIUS_KM = 6371.0088
+
+def getHaversineDistance(lat1, long1, lat2, long2):
+    lat1, long1, lat2, long2 = map(np.radians, (lat1, long1, lat2, long2))
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((long2 - long1) / 2)**2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def toFloat(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
 def findClosestStore(store: dict, storesIdList: List[dict]) -> dict:
-    closest = storesIdList[0]
-    distance = getDistance(store.get("latitude"), store.get("longitude"), storesIdList[0].get("latitude"), storesIdList[0].get("longitude"))
-    for i in range(1, len(storesIdList)):
-        new_distance = getDistance(store.get("latitude"), store.get("longitude"), storesIdList[i].get("latitude"), storesIdList[i].get("longitude"))
-        if new_distance < distance:
-            closest = storesIdList[i]
-            distance = new_distance
-    return closest
+    lat = np.array([toFloat(s.get("latitude")) for s in storesIdList])
+    lon = np.array([toFloat(s.get("longitude")) for s in storesIdList])
+    distance = getHaversineDistance(toFloat(store.get("latitude")), toFloat(store.get("longitude")), lat, lon)
+    if np.isnan(distance).all():
+        return storesIdList[0]
+    return storesIdList[int(np.nanargmin(distance))]
 
-## store matcher based on distance
-def storeMatcher(storesId: dict, stores: dict) -> dict:
-    matched = {}
-    for k in stores.keys():
-        city = stores[k].get("city").lower()
-        postcode = stores[k].get("CAP")
-        candidates = [storesId[k] for k in storesId.keys() if filterDict(storesId[k], city, postcode)] 
-        if len(candidates) == 1:
-            matched[k] = candidates[0].get("name")
-        elif len(candidates) == 0:
-            matched[k] = ""
+### spatial index over all drives/lockers: a KD-tree on unit-sphere coordinates (chord distance
+### is monotonic in the great-circle one, so nearest/radius queries are exact haversine queries)
+### plus a (town, postCode) hash index. Without scipy it falls back to a vectorized brute force.
+class StoreIndex:
+    def __init__(self, storesId: dict):
+        self.entries = [v for v in storesId.values() if isinstance(v, dict)]
+        self.lat = np.array([toFloat(e.get("latitude")) for e in self.entries])
+        self.lon = np.array([toFloat(e.get("longitude")) for e in self.entries])
+        self.by_town_postcode = defaultdict(list)
+        for i, e in enumerate(self.entries):
+            self.by_town_postcode[(str(e.get("townName")).lower(), e.get("postCode"))].append(i)
+        self.located = np.flatnonzero(~np.isnan(self.lat) & ~np.isnan(self.lon))
+        self.tree = None
+        if cKDTree is not None and len(self.located) > 0:
+            self.tree = cKDTree(self.toXYZ(self.lat[self.located], self.lon[self.located]))
+
+    @staticmethod
+    def toXYZ(lat, lon) -> np.ndarray:
+        lat, lon = np.radians(np.atleast_1d(lat)), np.radians(np.atleast_1d(lon))
+        return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+    def candidates(self, town: str, postcode: str) -> List[dict]:
+        return [self.entries[i] for i in self.by_town_postcode.get((str(town).lower(), postcode), [])]
+
+    def nearest(self, lats, lons, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        ### batched k-nearest: returns (indexes into self.entries, distances in km), both shaped (n, k)
+        lats, lons = np.atleast_1d(lats).astype(float), np.atleast_1d(lons).astype(float)
+        k = min(k, len(self.located))
+        if self.tree is not None:
+            chord, idx = self.tree.query(self.toXYZ(lats, lons), k=k)
+            chord, idx = chord.reshape(len(lats), k), idx.reshape(len(lats), k)
+            return self.located[idx], 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0, 1))
+        distance = getHaversineDistance(lats[:, None], lons[:, None], self.lat[self.located][None, :], self.lon[self.located][None, :])
+        idx = np.argsort(distance, axis=1)[:, :k]
+        return self.located[idx], np.take_along_axis(distance, idx, axis=1)
+
+    def within(self, lat: float, lon: float, radius_km: float) -> List[Tuple[dict, float]]:
+        if self.tree is not None:
+            chord = 2 * np.sin(radius_km / (2 * EARTH_RADIUS_KM))
+            idx = self.located[self.tree.query_ball_point(self.toXYZ(lat, lon)[0], chord)]
         else:
-            cand = findClosestStore(stores[k], candidates)
-            matched[k] = cand.get("name")
-    return matched
+            idx = self.located
+        distance = getHaversineDistance(lat, lon, self.lat[idx], self.lon[idx])
+        order = np.argsort(distance)
+        return [(self.entries[idx[i]], float(distance[i])) for i in order if distance[i] <= radius_km]
+
+    def match(self, stores: dict) -> dict:
+        ### one call for the whole store list: hash lookup on (city, CAP), ties broken by haversine
+        matched = {}
+        for k, store in stores.items():
+            idx = self.by_town_postcode.get((store.get("city").lower(), store.get("CAP")), [])
+            if len(idx) == 0:
+                matched[k] = ""
+            elif len(idx) == 1:
+                matched[k] = self.entries[idx[0]].get("name")
+            else:
+                idx = np.array(idx)
+                distance = getHaversineDistance(toFloat(store.get("latitude")), toFloat(store.get("longitude")), self.lat[idx], self.lon[idx])
+                best = idx[0] if np.isnan(distance).all() else idx[int(np.nanargmin(distance))]
+                matched[k] = self.entries[best].get("name")
+        return matched
+
+## store matcher based on distance
+def storeMatcher(storesId: dict, stores: dict, index: StoreIndex = None) -> dict:
+    index = index or StoreIndex(storesId)
+    return index.match(stores)
 
 ## filter stores based on consegna_a_domicilio = true
 def filterConsegnaADomicilio(store: dict) -> dict:
@@ -197,7 +347,7 @@ def filterGivenField(store: dict, field: str, field_value: any) -> dict:
         if field in store.keys():
             return store.get(field).lower() == field_value
     else:
-        print("error in either the key or the value")
+        logger.warning("error in either the key or the value")
         return False
 
 ## find closest store based on the address string
@@ -213,25 +363,84 @@ def findClosestStore_Lev(store_address: str, streets_address: List[str]) -> int:
             distance = new_distance
     return closest
 
+## plain Levenshtein (same costs as nltk.edit_distance) that gives up as soon as every
+## cell of a row exceeds the cutoff, used when rapidfuzz is not installed
+def editDistanceCutoff(a: str, b: str, cutoff: int = None) -> int:
+    if cutoff is None:
+        cutoff = max(len(a), len(b))
+    if abs(len(a) - len(b)) > cutoff:
+        return cutoff + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > cutoff:
+            return cutoff + 1
+        previous = current
+    return previous[-1]
+
+## rapidfuzz stops scoring a pair once its distance passes the cutoff; a query with no choice
+## that close (a store address unlike every street of its CAP) is scored again in full
+MATCH_SCORE_CUTOFF = 10
+
+## best match of each query among choices: (index, distance) per query, index -1 when there are no choices
+def bestMatches(queries: List[str], choices: List[str], score_cutoff: int = MATCH_SCORE_CUTOFF) -> List[Tuple[int, int]]:
+    if not choices:
+        return [(-1, None) for _ in queries]
+    if fuzz_process is not None:
+        distances = fuzz_process.cdist(queries, choices, scorer=Levenshtein.distance, dtype=np.int32,
+                                       score_cutoff=score_cutoff, workers=-1)
+        far = np.flatnonzero(distances.min(axis=1) > score_cutoff)
+        if len(far):
+            distances[far] = fuzz_process.cdist([queries[i] for i in far], choices, scorer=Levenshtein.distance,
+                                                dtype=np.int32, workers=-1)
+        best = distances.argmin(axis=1)
+        return [(int(b), int(distances[i, b])) for i, b in enumerate(best)]
+    matches = []
+    for query in queries:
+        closest, distance = 0, editDistanceCutoff(query, choices[0])
+        for i in range(1, len(choices)):
+            new_distance = editDistanceCutoff(query, choices[i], distance - 1)
+            if new_distance < distance:
+                closest, distance = i, new_distance
+        matches.append((closest, distance))
+    return matches
+
+### streets grouped by postCode once, with the normalized address used for matching
+def buildStreetIndex(streets: dict) -> dict:
+    index = defaultdict(lambda: ([], []))
+    for street in streets.values():
+        if isinstance(street, dict) and street.get("postCode") is not None and street.get("value"):
+            substreets, streets_address = index[str(street.get("postCode")).lower()]
+            substreets.append(street)
+            streets_address.append(street.get("value").lower().split(" - ")[0])
+    return dict(index)
+
 ## store matcher based on address string
-def storeInfo(streets: dict, stores: dict) -> dict:
-    store_info = {}
+def storeInfo(streets: dict, stores: dict, street_index: dict = None) -> dict:
+    street_index = street_index or buildStreetIndex(streets)
+    by_cap = defaultdict(list)
     for k in stores.keys():
-        try:
-            print(k)
-            cap = stores[k].get("CAP")
-            address = stores[k].get("address").lower()
-            substreets = [streets[k] for k in streets.keys() if filterGivenField(streets[k], "postCode", cap)]
-            streets_address = [street.get("value").lower().split(" - ")[0] for street in substreets]
-            closest = findClosestStore_Lev(address.split(",")[0], streets_address)
+        if stores[k].get("CAP") is None or not stores[k].get("address"):
+            logger.debug(f"skipping {k}")
+            continue
+        by_cap[str(stores[k].get("CAP")).lower()].append(k)
+    store_info = {}
+    for cap, keys in by_cap.items():
+        substreets, streets_address = street_index.get(cap, ([], []))
+        addresses = [stores[k].get("address").lower() for k in keys]
+        matches = bestMatches([address.split(",")[0] for address in addresses], streets_address)
+        for k, address, (closest, score) in zip(keys, addresses, matches):
+            if closest < 0:
+                logger.debug(f"skipping {k}")
+                continue
             store_info[k] = {"name": k,
-                            "street_id": substreets[closest].get("id"), 
+                            "street_id": substreets[closest].get("id"),
                             "address": address,
-                            "postCode": cap,
-                            "town": stores[k].get("city")}
-        except:
-            print(f"skipping {k}")
-            next
+                            "postCode": stores[k].get("CAP"),
+                            "town": stores[k].get("city"),
+                            "score": score}
     return store_info
 
 ### the following 2 functions are used to map the correspondence between street_id and store_id:
@@ -242,13 +451,13 @@ def fetch_store_data2(street_id, street_data):
     value = street_data.get("name")
     postCode = street_data.get("postCode")
     town = street_data.get("town")
-    base_url = 'https://spesaonline.esselunga.it'
+    base_url = BASE_URL
     headers = {
-        'Host': 'spesaonline.esselunga.it',
+        'Host': BASE_URL.split("://")[-1],
         'X-PAGE-PATH': 'supermercato',
     }
-    with requests.Session() as session:
-        session.headers.update(headers)
+    # own cookie jar per street (the trolley answer depends on the visited street), shared connections
+    with newSession(headers) as session, METRICS.timed("trolley_probe"):
         try:
             response_1 = session.get(f'{base_url}/commerce/nav/drive/store/home', allow_redirects=True)
             store_url = f"{base_url}/commerce/nav/supermercato/visit?streetId={street_id}"
@@ -257,12 +466,12 @@ def fetch_store_data2(street_id, street_data):
             params = {"query": "*", "start": 0, "length": 100, "filters": []}
             response = session.post(facet_url, json=params, timeout=10, allow_redirects=False)
             if response.status_code != 200:
-                print(f"Failed to fetch products: {response.status_code}")
+                logger.debug(f"street {street_id}: failed to fetch products: {response.status_code}")
+                METRICS.inc("trolley_probes_total", result="failed")
                 return None, street_id
             try:
-                response_json = response.json()
-                prod_count = response_json["displayables"]['rowCount']
-                print(f"Total products found in store: {prod_count}")
+                prod_count = decodeFacet(response.content)[0]
+                logger.debug(f"street {street_id}: {prod_count} products in store")
                 trolley_url = f"{base_url}/commerce/resources/auth/trolley"
                 response4 = session.get(
                     trolley_url,
@@ -270,19 +479,23 @@ def fetch_store_data2(street_id, street_data):
                     timeout=10,
                     allow_redirects=False
                 )
-                if response4.status_code == 200:
-                    store_id = response4.json().get("storeId")
-                    print("---------------------------------------")
-                    print(store_id)
-                    print("---------------------------------------")
+                store_id = response4.json().get("storeId") if response4.status_code == 200 else None
+                if store_id is not None:
+                    logger.debug(f"street {street_id}: store {store_id}")
+                    METRICS.inc("trolley_probes_total", result="ok")
                     return {store_id: [street_id]}, None
                 else:
+                    # a trolley without storeId says nothing about the street
+                    logger.debug(f"street {street_id}: trolley {response4.status_code} without storeId")
+                    METRICS.inc("trolley_probes_total", result="failed")
                     return None, street_id
             except Exception as e:
-                print(e)
+                logger.debug(f"street {street_id}: {str(e)}")
+                METRICS.inc("trolley_probes_total", result="error")
                 return None, street_id
         except Exception as e:
-            print(e)
+            logger.debug(f"street {street_id}: {str(e)}")
+            METRICS.inc("trolley_probes_total", result="error")
             return None, street_id
 
 def mapStoreidToStreetid(streets):
@@ -303,6 +516,147 @@ def mapStoreidToStreetid(streets):
                 errors.append(error)
     return ssmap, errors
 
+### journaled variant: every probed street is appended to a JSONL journal as soon as it completes
+### ({"street_id", "store_id", "error"}), so a restart skips the completed streets, re-queues only
+### the ones that errored, and periodically merges the results into the on-disk store->street map
+STREET_JOURNAL_PATH = "street_map_journal.jsonl"
+STORE_MAP_PATH = "store_to_map_new.json"
+
+def readStreetJournal(journal_path: str = STREET_JOURNAL_PATH) -> Tuple[dict, set]:
+    done = {}
+    errors = set()
+    if not os.path.exists(journal_path):
+        return done, errors
+    with open(journal_path, "r") as journal:
+        for line in journal:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # torn last line after a crash
+            street_id = str(entry.get("street_id"))
+            # older journals could hold a success without store id
+            if entry.get("error") or entry.get("store_id") in (None, "None"):
+                errors.add(street_id)
+            else:
+                done[street_id] = str(entry.get("store_id"))
+                errors.discard(street_id)
+    return done, errors
+
+def mergeStoreMap(results: dict, map_path: str = STORE_MAP_PATH) -> dict:
+    ssmap = {}
+    if os.path.exists(map_path):
+        with open(map_path, "r") as file:
+            ssmap = json.load(file)
+    owner = {street: store for store, street_list in ssmap.items() for street in street_list}
+    for street_id, store_id in results.items():
+        previous = owner.get(street_id)
+        if previous == store_id:
+            continue
+        if previous is not None:
+            ssmap[previous].remove(street_id)
+        ssmap.setdefault(store_id, []).append(street_id)
+        owner[street_id] = store_id
+    tmp_path = map_path + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(ssmap, file)
+    os.replace(tmp_path, map_path)
+    return ssmap
+
+def mapStoreidToStreetid_journaled(streets: dict, journal_path: str = STREET_JOURNAL_PATH, map_path: str = STORE_MAP_PATH,
+                                   max_workers: int = 10, merge_every: int = 500) -> Tuple[dict, List]:
+    done, previous_errors = readStreetJournal(journal_path)
+    # streets journaled before a crash may not have reached the map yet
+    mergeStoreMap(done, map_path)
+    todo = [i for i in streets.keys() if str(i) not in done]
+    logger.info("{} streets: {} already mapped, {} to probe ({} failed last time)".format(
+        len(streets), len(done), len(todo), len(previous_errors)))
+    results, errors = probeStreets(streets, todo, journal_path, map_path, max_workers, merge_every)
+    ssmap = mergeStoreMap(results, map_path)
+    logger.info("mapped {} streets, {} errors".format(len(results), len(errors)))
+    return ssmap, errors
+
+## probe the given street keys, journaling each result; returns ({street_id: store_id}, [failed street_id])
+def probeStreets(streets: dict, keys: list, journal_path: str = STREET_JOURNAL_PATH, map_path: str = STORE_MAP_PATH,
+                 max_workers: int = 10, merge_every: int = 500) -> Tuple[dict, List]:
+    results = {}
+    pending = {}
+    errors = []
+    with open(journal_path, "a") as journal, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch_store_data2, str(i), streets[i]): i for i in keys}
+        for future in tqdm(as_completed(futures), total=len(keys)):
+            street_id = str(futures[future])
+            try:
+                result, error = future.result()
+            except Exception as e:
+                result, error = None, street_id
+            store_id = next(iter(result.keys())) if result else None
+            if store_id is not None:
+                store_id = str(store_id)
+                journal.write(json.dumps({"street_id": street_id, "store_id": store_id, "error": False}) + "\n")
+                results[street_id] = pending[street_id] = store_id
+            else:
+                journal.write(json.dumps({"street_id": street_id, "store_id": None, "error": True}) + "\n")
+                errors.append(street_id)
+            journal.flush()
+            if len(pending) >= merge_every:
+                mergeStoreMap(pending, map_path)
+                pending = {}
+    return results, errors
+
+### sampling variant: streets of a postcode are nearly always served by the same store, so only a few
+### evenly spread streets per postcode are probed first; a postcode is probed exhaustively only when
+### its samples disagree (or all fail), otherwise the agreed store is assigned to all its streets
+def samplePostcodeStreets(keys: list, known: dict, samples: int) -> list:
+    keys = sorted(keys, key=lambda k: int(k) if str(k).isdigit() else str(k))
+    if len(keys) <= samples:
+        return keys
+    # streets mapped on a previous run are free samples
+    already = [k for k in keys if str(k) in known]
+    spread = [keys[int(round(p))] for p in np.linspace(0, len(keys) - 1, samples)]
+    return list(dict.fromkeys(already + spread))[:samples]
+
+def mapStoreidToStreetid_sampled(streets: dict, samples_per_postcode: int = 3, journal_path: str = STREET_JOURNAL_PATH,
+                                 map_path: str = STORE_MAP_PATH, max_workers: int = 10) -> Tuple[dict, List, dict]:
+    known, _ = readStreetJournal(journal_path)
+    by_postcode = defaultdict(list)
+    for k in streets.keys():
+        by_postcode[str(streets[k].get("postCode"))].append(k)
+    samples = {pc: samplePostcodeStreets(keys, known, samples_per_postcode) for pc, keys in by_postcode.items()}
+    to_probe = [k for keys in samples.values() for k in keys if str(k) not in known]
+    results, errors = probeStreets(streets, to_probe, journal_path, map_path, max_workers)
+    known.update(results)
+    assigned = {}
+    inferred = 0
+    unanimous = 0
+    exhaustive = []
+    for pc, keys in by_postcode.items():
+        sampled_stores = {known[str(k)] for k in samples[pc] if str(k) in known}
+        if len(sampled_stores) == 1:
+            store_id = sampled_stores.pop()
+            unanimous += 1
+            for k in keys:
+                if str(k) not in known:
+                    inferred += 1
+                assigned[str(k)] = known.get(str(k), store_id)
+        else:
+            exhaustive.extend(k for k in keys if str(k) not in known)
+            assigned.update({str(k): known[str(k)] for k in keys if str(k) in known})
+    if exhaustive:
+        logger.info("{} postcodes disagree or failed, probing {} more streets".format(len(by_postcode) - unanimous, len(exhaustive)))
+        results, more_errors = probeStreets(streets, exhaustive, journal_path, map_path, max_workers)
+        assigned.update(results)
+        errors.extend(more_errors)
+    ssmap = mergeStoreMap(assigned, map_path)
+    errors = [e for e in errors if e not in assigned]
+    report = {"streets": len(streets),
+              "postcodes": len(by_postcode),
+              "probes": len(to_probe) + len(exhaustive),
+              "inferred": inferred,
+              "coverage": round(len(assigned) / len(streets), 4) if streets else 1.0,
+              "confidence": round(unanimous / len(by_postcode), 4) if by_postcode else 1.0}
+    logger.info("sampled mapping: {}".format(report))
+    return ssmap, errors, report
+
 ## function to merge stores (supposed delivery + lockers) into a single dict 
 def mergeStores(store_info: dict, storesId: dict) -> dict:
     common_keys= set(store_info.keys()).intersection(storesId.keys())
@@ -332,14 +686,14 @@ def storesToScrape(ssmap: dict, store_merged: dict) -> dict:
 el = getEsselungaStoresList()
 el = getEsselungaStoresInfo(el)
 start = time.time()
-streets = getStreetsId(el)
-print("duration: {}".format(time.time() - start))
+streets = getStreetsId_parallel(el)
+logger.info("duration: {}".format(time.time() - start))
 
 streets = streets[0]
 
 start = time.time()
 stores1, stores2, errors = getStoresId_parallel(streets)
-print("duration getStoresId_parallel: {}".format(time.time() - start))
+logger.info("duration getStoresId_parallel: {}".format(time.time() - start))
 set(stores1.keys()).intersection(stores2.keys()) 
 
 stores = {**stores1, **stores2}
@@ -349,7 +703,9 @@ store_info = storeInfo(streets, el)
 
 stores_merged = mergeStores(store_info, storesId)
 
-## this one is rather long:
-ssmap = mapStoreidToStreetid(streets)
+## this one is rather long, it can be interrupted and restarted:
+ssmap, street_errors = mapStoreidToStreetid_journaled(streets)
+## or probe a few streets per postcode and expand only where they disagree:
+# ssmap, street_errors, mapping_report = mapStoreidToStreetid_sampled(streets)
 
 stores_to_scrape = storesToScrape(ssmap, stores_merged)
\ No newline at end of file
@@ -0,0 +1,52 @@
+### decode + extract cost per facet page (and per detail payload) for each available decoder
+### usage: python benchmarks/bench_decode.py [iterations] [page size]
+import json
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import Esselunga_scraper as scraper
+from Esselunga_decode import DECODERS, decodeFacet, decodeDetail
+from mock_backend import MockState, load_fixture
+
+
+## what the pagination loop used to do: one generic decode for rowCount, another for the entities
+def legacy_page(body: bytes) -> dict:
+    json.loads(body)["displayables"]["rowCount"]
+    return scraper.extract_product_info(json.loads(body)["displayables"]["entities"])
+
+def decoded_page(body: bytes, decoder: str) -> dict:
+    row_count, entities = decodeFacet(body, decoder)
+    return scraper.extract_product_info(entities)
+
+def bench(fn, iterations: int) -> float:
+    fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    sz = int(sys.argv[2]) if len(sys.argv) > 2 else 99
+    body = json.dumps(MockState(products=sz).facet("300000", 0, sz)).encode("utf-8")
+    expected = legacy_page(body)
+    for decoder in DECODERS:
+        # every decoder must produce the same extracted products
+        assert decoded_page(body, decoder) == expected, decoder
+    print(f"page: {sz} entities, {len(body) / 1024:.0f} KiB, iterations: {iterations}")
+    print(f"{'facet page':<22}{'decode+extract us':>19}{'us/entity':>11}")
+    cost = bench(lambda: legacy_page(body), iterations)
+    print(f"{'legacy (2x json)':<22}{cost:>19.1f}{cost / sz:>11.2f}")
+    for decoder in DECODERS:
+        cost = bench(lambda: decoded_page(body, decoder), iterations)
+        print(f"{decoder:<22}{cost:>19.1f}{cost / sz:>11.2f}")
+    print(f"{'detail payload':<22}{'decode us':>19}")
+    for name in ("detail_single.json", "detail_family.json"):
+        detail = json.dumps(load_fixture(name)).encode("utf-8")
+        for decoder in DECODERS:
+            print(f"{name + ' ' + decoder:<22}{bench(lambda: decodeDetail(detail, decoder), iterations * 10):>19.1f}")
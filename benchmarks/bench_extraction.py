@@ -0,0 +1,140 @@
+### micro-benchmark of the product detail extraction over the fixtures in benchmarks/fixtures
+### usage: python benchmarks/bench_extraction.py [iterations]
+import glob
+import json
+import os
+import sys
+import time
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Esselunga_scraper as scraper
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def load_fixtures(pattern: str = "detail_*.json") -> dict:
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURES, pattern))):
+        with open(path, "rb") as file:
+            fixtures[os.path.basename(path)] = file.read()
+    return fixtures
+
+## copy of the extractors before the single-pass rewrite (prints dropped): one res.json() per
+## field, one html.parser soup per extractor. Kept here so the outputs can be compared.
+def legacy_flatten(nested: dict, parent_key: str = "", sep: str = "_") -> dict:
+    flat = {}
+    items = nested.items() if isinstance(nested, dict) else enumerate(nested)
+    for k, v in items:
+        key = f"{parent_key}{sep}{k}" if parent_key else str(k)
+        if isinstance(v, (dict, list)) and len(v) > 0:
+            flat.update(legacy_flatten(v, key, sep))
+        else:
+            flat[key] = v
+    return flat
+
+def legacy_ingredients(informations: list) -> str:
+    ingredients = [info for info in informations if info["label"] == "Ingredienti"]
+    if len(ingredients) > 0:
+        soup = BeautifulSoup(ingredients[0]["value"], 'html.parser')
+        ingredient_section = soup.find('strong', string="Ingredienti").find_parent('p')
+        if ingredient_section:
+            ingredients_text = ingredient_section.get_text()
+            ingredients_text = ingredients_text.replace('Ingredienti', '').strip()
+            return ingredients_text
+    else:
+        return ""
+
+def legacy_allergeni(informations: list) -> str:
+    ingredients = [info for info in informations if info["label"] == "Ingredienti"]
+    if len(ingredients) > 0:
+        soup = BeautifulSoup(ingredients[0]["value"], 'html.parser')
+        allergeni_section = soup.find('strong', string="Allergeni").find_parent('p')
+        if allergeni_section:
+            allergeni_text = soup.get_text(separator=" ").replace('Allergeni', '').strip().replace("\n", " ").replace("\t", "")
+            allergeni_dict = {
+                "Contiene": "",
+                "Potrebbe contenere": "",
+                "Non contiene": ""
+            }
+            if "Contiene :" in allergeni_text:
+                contiene_part = allergeni_text.split("Contiene :")[1].split("Potrebbe contenere :")[0].strip()
+                allergeni_dict["Contiene"] = contiene_part
+            if "Potrebbe contenere :" in allergeni_text:
+                potrebbe_part = allergeni_text.split("Potrebbe contenere :")[1].split("Non contiene :")[0].strip()
+                allergeni_dict["Potrebbe contenere"] = potrebbe_part
+            if "Non contiene :" in allergeni_text:
+                non_contiene_part = allergeni_text.split("Non contiene :")[1].strip()
+                allergeni_dict["Non contiene"] = non_contiene_part
+            return allergeni_dict
+    else:
+        return ""
+
+def legacy_nutritional_facts(informations: list) -> dict:
+    vn = [info for info in informations if info["label"] == "Valori nutrizionali"]
+    if len(vn) > 0:
+        soup = BeautifulSoup(vn[0]["value"], 'html.parser')
+        nutritional_values = {}
+        table = soup.find('table')
+        if table:
+            for row in table.find_all('tr')[1:]:
+                columns = row.find_all('td')
+                if len(columns) >= 2:
+                    nutrient_name = columns[0].get_text(strip=True)
+                    nutrient_value = columns[1].get_text(strip=True)
+                    nutritional_values[nutrient_name] = nutrient_value
+        return nutritional_values
+    else:
+        return {}
+
+def legacy_extract(body: bytes) -> dict:
+    url = scraper.extractURL(json.loads(body)["seo"].get("attributes"))
+    ingredients = legacy_ingredients(json.loads(body)["informations"])
+    allergenes = legacy_allergeni(json.loads(body)["informations"])
+    nutritional_facts = legacy_nutritional_facts(json.loads(body)["informations"])
+    details = {}
+    if len(json.loads(body)["familyChildren"]) == 0:
+        details = legacy_flatten(json.loads(body)["displayableProduct"])
+        details["url"] = url
+        details["ingredients"] = ingredients
+        details["allergenes"] = allergenes
+        details["nutritional_facts"] = nutritional_facts
+    else:
+        for child in json.loads(body)["familyChildren"]:
+            child_dict = legacy_flatten(json.loads(body)["displayableProduct"])
+            child_dict["id"] = child["productId"]
+            child_dict["productId"] = child["productId"]
+            child_dict["productCode"] = child["productCode"]
+            child_dict["familyAttributes"] = child["familyAttributes"]
+            child_dict["sanitizeDescription"] = child["sanitizeDescription"]
+            child_dict["description"] = child["sanitizeDescription"]
+            child_dict["url"] = url
+            child_dict["ingredients"] = ingredients
+            child_dict["allergenes"] = allergenes
+            child_dict["nutritional_facts"] = nutritional_facts
+            details[child["productId"]] = child_dict
+    return details
+
+def single_pass_extract(body: bytes) -> dict:
+    return scraper.parseProductDetails(json.loads(body))
+
+def bench(fn, body: bytes, iterations: int) -> float:
+    fn(body)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(body)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    fixtures = load_fixtures()
+    for name, body in fixtures.items():
+        # the single pass must extract exactly what the old extractors did
+        assert single_pass_extract(body) == legacy_extract(body), name
+    print(f"parser: {scraper.HTML_PARSER}, iterations: {iterations}")
+    print(f"{'fixture':<22}{'legacy us':>12}{'single-pass us':>16}{'speedup':>10}")
+    for name, body in fixtures.items():
+        legacy = bench(legacy_extract, body, iterations)
+        single = bench(single_pass_extract, body, iterations)
+        print(f"{name:<22}{legacy:>12.1f}{single:>16.1f}{legacy / single:>9.1f}x")
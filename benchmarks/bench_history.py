@@ -0,0 +1,73 @@
+### load + query times of Esselunga_history.PriceHistory on synthetic scrapes
+### usage: python benchmarks/bench_history.py [products] [stores] [days] [db path]
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from Esselunga_history import PriceHistory
+from Esselunga_snapshot import SNAPSHOT_COLUMNS
+
+
+## one store on one day, in the productsToFrame layout: 3 price lists, ~10% of products on promo
+def build_frame(products: int, store: int, day: int, rng) -> pd.DataFrame:
+    ids = np.arange(100000, 100000 + products)
+    price = np.round(1 + (ids % 997) / 100 + (store % 3) * 0.1, 2)
+    promo = rng.random(products) < 0.1
+    frame = pd.DataFrame({c: None for c in SNAPSHOT_COLUMNS}, index=range(products))
+    frame["id"] = ids.astype(str)
+    frame["name"] = [f"product {i}" for i in ids]
+    frame["price"] = price
+    frame["disc_price"] = np.where(promo, np.round(price * 0.8, 2), np.nan)
+    frame["oos"] = rng.random(products) < 0.02
+    frame["promo_type"] = np.where(promo, "SCONTO", None)
+    return frame
+
+def timed(label: str, fn, repeat: int = 5):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    print(f"{label:<40}{(time.perf_counter() - start) / repeat * 1000:>10.1f} ms")
+    return result
+
+
+if __name__ == "__main__":
+    products = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    stores = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    days = int(sys.argv[3]) if len(sys.argv) > 3 else 60
+    path = sys.argv[4] if len(sys.argv) > 4 else os.path.join(tempfile.mkdtemp(), "history.sqlite")
+    rng = np.random.default_rng(0)
+    first = date(2026, 1, 1)
+    history = PriceHistory(path)
+    start = time.perf_counter()
+    rows = 0
+    for d in range(days):
+        # one transaction per scrape day, like importSnapshots
+        for s in range(stores):
+            rows += history.addFrame(build_frame(products, s, d, rng), f"store{s}", first + timedelta(days=d), commit=False)
+        history.commit()
+    elapsed = time.perf_counter() - start
+    print(f"loaded {rows} rows in {elapsed:.1f}s ({rows / elapsed:.0f} rows/s)")
+    start = time.perf_counter()
+    history.refresh()
+    print(f"daily rollup of {days} days in {time.perf_counter() - start:.1f}s, {os.path.getsize(path) / rows:.1f} bytes/row")
+    last = (first + timedelta(days=days - 1)).isoformat()
+    product = "100500"
+    timed("point", lambda: history.point(product, "store7", last))
+    timed(f"history, all stores, {days} days", lambda: history.history(product, start=first, end=last))
+    timed("history, one store", lambda: history.history(product, "store7", first, last))
+    timed("priceStats (min/median/max)", lambda: history.priceStats(product, first, last))
+    timed("cheapestStore top 5", lambda: history.cheapestStore(product, n=5))
+    timed("promoFrequency, 100 products", lambda: history.promoFrequency(first, last, [str(100000 + i) for i in range(100)]))
+    timed("priceSummary, 100 products + median",
+          lambda: history.priceSummary(first, last, [str(100000 + i) for i in range(100)], with_median=True))
+    timed(f"priceSummary, all products, {days} days", lambda: history.priceSummary(first, last))
+    timed("promoFrequency, all products", lambda: history.promoFrequency(first, last))
+    timed("priceSummary, one store, all products", lambda: history.priceSummary(first, last, store="store7"), 1)
+    history.close()
@@ -0,0 +1,50 @@
+### memory of extract_product_info output: getProductFields dicts vs compact ProductRecord
+### usage: python benchmarks/bench_records.py [products]
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import Esselunga_scraper as scraper
+
+FIXTURES = os.path.join(BENCH_DIR, "fixtures")
+
+
+def build_entities(n: int) -> list:
+    with open(os.path.join(FIXTURES, "facet_entities.json"), "r", encoding="utf-8") as file:
+        templates = json.load(file)
+    entities = []
+    for i in range(n):
+        entity = dict(templates[i % len(templates)])
+        entity["id"] = 100000 + i
+        entity["code"] = str(2000000 + i)
+        entity["price"] = round(entity["price"] + 0.01 * (i % 300), 2)
+        entity["children"] = [dict(child, id=f"{100000 + i}{k}", code=f"{2000000 + i}{k}")
+                              for k, child in enumerate(entity.get("children") or [])]
+        entities.append(entity)
+    # round trip so every entity owns its strings, like a decoded response
+    return json.loads(json.dumps(entities))
+
+def measure(n: int, compact: bool) -> tuple:
+    entities = build_entities(n)
+    start = time.perf_counter()
+    scraper.extract_product_info(entities, compact)
+    # timed without tracemalloc, which slows allocation down several times
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    products = scraper.extract_product_info(entities, compact)
+    del entities
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return len(products), retained, elapsed
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    print(f"{'records':<10}{'products':>10}{'retained MB':>14}{'bytes/product':>15}{'extract s':>11}")
+    for compact in (False, True):
+        count, retained, elapsed = measure(n, compact)
+        print(f"{'compact' if compact else 'dict':<10}{count:>10}{retained / 1e6:>14.1f}{retained / count:>15.0f}{elapsed:>11.2f}")
@@ -0,0 +1,88 @@
+### end-to-end throughput benchmark: drives process_store / main against benchmarks/mock_backend.py
+### usage: python benchmarks/bench_throughput.py --stores 40 --products 2000 --latency 0.05 --throttle-rate 0.01
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from mock_backend import start_mock_backend
+
+
+def serve(port: int, config: dict):
+    start_mock_backend(port, **config)
+    while True:
+        time.sleep(3600)
+
+def backend_call(base_url: str, path: str) -> dict:
+    with urllib.request.urlopen(base_url + path) as response:
+        return json.loads(response.read())
+
+def wait_for_backend(base_url: str, timeout: float = 10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            return backend_call(base_url, "/__stats")
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"mock backend at {base_url} did not come up")
+
+def build_stores(n: int, drive_share: float = 0.25) -> dict:
+    stores = {}
+    for i in range(n):
+        if i < n * drive_share:
+            stores[f"cev_{i}"] = {"street_id": 300000 + i, "drive_id": 500 + i}
+        else:
+            stores[f"store_{i}"] = {"street_id": 300000 + i}
+    return stores
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scraper throughput against the local mock backend")
+    parser.add_argument("--mode", choices=["main", "process_store"], default="main")
+    parser.add_argument("--stores", type=int, default=20)
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    config = {"products": args.products, "latency": args.latency, "jitter": args.jitter,
+              "error_rate": args.error_rate, "throttle_rate": args.throttle_rate}
+    backend = multiprocessing.Process(target=serve, args=(args.port, config), daemon=True)
+    backend.start()
+    base_url = f"http://localhost:{args.port}"
+    os.environ["ESSELUNGA_BASE_URL"] = base_url
+    try:
+        wait_for_backend(base_url)
+        import Esselunga_scraper as scraper
+        from Esselunga_catalog import ProductCatalog
+
+        stores = build_stores(args.stores)
+        backend_call(base_url, "/__reset")
+        start = time.time()
+        if args.mode == "main":
+            catalog = scraper.main(stores, catalog=ProductCatalog())
+            scraped = len(catalog.stores)
+        else:
+            scraped = sum(1 for k in stores if scraper.process_store(stores[k]) is not None)
+        elapsed = time.time() - start
+        stats = backend_call(base_url, "/__stats")
+    finally:
+        backend.terminate()
+
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"mode: {args.mode}, stores: {scraped}/{args.stores}, products/store: {args.products}")
+    print(f"elapsed:      {elapsed:.2f} s")
+    print(f"stores/min:   {scraped / elapsed * 60:.1f}")
+    print(f"requests/s:   {stats['requests'] / elapsed:.1f} ({stats['requests']} requests, status {stats['status']})")
+    print(f"latency p50:  {stats['p50'] * 1000:.1f} ms, p99: {stats['p99'] * 1000:.1f} ms (server side)")
+    print(f"peak RSS:     {peak_rss_mb:.1f} MB")
@@ -0,0 +1,41 @@
+### DiskCache: entries expire after the TTL and max_entries evicts the least recently read
+### usage: python benchmarks/check_cache.py
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from Esselunga_cache import DiskCache
+
+
+if __name__ == "__main__":
+    root = tempfile.mkdtemp()
+    # TTL: a stale entry is a miss, and the next write drops it from the table
+    cache = DiskCache(os.path.join(root, "ttl.sqlite"), ttl=0.2)
+    cache.set_many({"a": {"x": 1}, 2: [1, 2]})
+    assert cache.get("a") == {"x": 1} and cache.get(2) == [1, 2] and 2 in cache
+    time.sleep(0.3)
+    assert cache.get("a") is None and "a" not in cache and len(cache) == 2
+    cache.set("b", 3)
+    assert len(cache) == 1 and cache.get("b") == 3
+    assert cache.stats()["hits"] == 4 and cache.stats()["misses"] == 2, cache.stats()
+    cache.close()
+    # LRU: reading an entry keeps it, the least recently read go first
+    cache = DiskCache(os.path.join(root, "lru.sqlite"), max_entries=3)
+    for key in ("k1", "k2", "k3"):
+        cache.set(key, key)
+        time.sleep(0.01)
+    assert cache.get("k1") == "k1"
+    time.sleep(0.01)
+    cache.set("k4", "k4")
+    assert len(cache) == 3 and "k2" not in cache, cache.get_many(["k1", "k2", "k3", "k4"])
+    cache.set_many({"k5": 5, "k6": 6})
+    assert set(cache.get_many(["k1", "k2", "k3", "k4", "k5", "k6"])) == {"k4", "k5", "k6"}
+    cache.close()
+    # entries survive reopening
+    cache = DiskCache(os.path.join(root, "lru.sqlite"), max_entries=3)
+    assert cache.get("k6") == 6
+    cache.close()
+    print("disk cache: TTL expiry and LRU eviction ok")
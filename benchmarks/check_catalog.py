@@ -0,0 +1,44 @@
+### ProductCatalog: stores round-trip through the shared static fields, linked stores read their
+### source, price_matrix lines up products and stores
+### usage: python benchmarks/check_catalog.py
+import os
+import sys
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from Esselunga_catalog import ProductCatalog
+
+
+def product(product_id: str, price, promo: dict = None) -> dict:
+    return {"id": product_id, "name": f"product {product_id}", "brand": "Esselunga", "price": price,
+            "disc_price": None, "promo": promo or {}, "oos": False, "quantity": None}
+
+
+if __name__ == "__main__":
+    catalog = ProductCatalog()
+    promo = {"start": "01/01/2026", "end": "15/01/2026", "promoType": "SCONTO", "disc_price": 1.0}
+    a = {p["id"]: p for p in (product("3", 3.5), product("1", 1.25, promo), product("2", None))}
+    b = {p["id"]: p for p in (product("2", 2.0), product("4", 4.0))}
+    catalog.add_store("A", a, row_count=10)
+    catalog.add_store("B", b)
+    assert len(catalog) == 4
+    assert catalog.store_products("A") == a and catalog.store_products("B") == b
+    assert catalog.get("A", "1")["promo"] == promo and catalog.get("A", "4") is None
+    assert catalog.product_stores("2") == {"A": {k: a["2"][k] for k in ("price", "disc_price", "promo", "oos", "quantity")},
+                                           "B": {k: b["2"][k] for k in ("price", "disc_price", "promo", "oos", "quantity")}}
+    assert list(catalog.row_counts(["A", "B"])) == [10, 2]
+    # a linked store answers with its source's prices, and its arrays are counted once
+    nbytes = catalog.nbytes()
+    catalog.link_store("C", "A")
+    assert catalog.store_products("C") == a and catalog.get("C", "1") == catalog.get("A", "1")
+    assert catalog.nbytes() == nbytes
+    assert list(catalog.row_counts(["C"])) == [10]
+    product_ids, store_ids, matrix = catalog.price_matrix(["B", "C"])
+    assert store_ids == ["B", "C"] and matrix.shape == (4, 2)
+    rows = {product_id: row for product_id, row in zip(product_ids, matrix)}
+    expected = {"1": [np.nan, 1.25], "2": [2.0, np.nan], "3": [np.nan, 3.5], "4": [4.0, np.nan]}
+    for product_id, row in expected.items():
+        np.testing.assert_array_equal(rows[product_id], row)
+    assert catalog.price_matrix()[1] == ["A", "B", "C"]
+    print("catalog: store round-trip, link_store and price_matrix ok")
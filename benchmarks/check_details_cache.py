@@ -0,0 +1,39 @@
+### product details cache against benchmarks/mock_backend.py: a cache hit returns exactly what the fetch returned
+### usage: python benchmarks/check_details_cache.py
+import os
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from mock_backend import start_mock_backend
+
+DETAIL_PATH = "/commerce/resources/displayable/detail/code/"
+
+
+def detail_requests(state) -> int:
+    return sum(n for path, n in state.stats()["paths"].items() if path.startswith(DETAIL_PATH))
+
+
+if __name__ == "__main__":
+    server = start_mock_backend(0)
+    os.environ["ESSELUNGA_BASE_URL"] = server.base_url
+    import Esselunga_scraper as scraper
+    state = server.RequestHandlerClass.state
+    codes = [str(2000000 + i) for i in range(30)]
+    cache = scraper.open_details_cache(os.path.join(tempfile.mkdtemp(), "details.sqlite"))
+    # an empty cache is still the cache to use, not a reason to open the default one
+    assert len(cache) == 0
+    fetched = scraper.enrichProducts(codes, cache)
+    assert detail_requests(state) == 30 and len(cache) == 30, (detail_requests(state), len(cache))
+    cached = scraper.enrichProducts(codes, cache)
+    assert detail_requests(state) == 30, detail_requests(state)
+    assert cached == fetched
+    # family payloads are keyed by productId, single products by field name
+    assert any("640001" in details for details in fetched.values())
+    miss = scraper.getProductDetailsCached("7654321", cache)
+    hit = scraper.getProductDetailsCached("7654321", cache)
+    assert detail_requests(state) == 31, detail_requests(state)
+    assert miss == hit and miss == scraper.normalizeDetails(scraper.getProductDetails("7654321"))
+    print(f"{len(fetched)} codes: cached details equal fetched details")
@@ -0,0 +1,79 @@
+### AdaptiveLimiter: coroutines wait for a slot without polling, never exceed the limit and survive cancellation;
+### against benchmarks/mock_backend.py, a store that fails on 429s backs the store limit off
+### usage: python benchmarks/check_limiter.py
+import asyncio
+import os
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from mock_backend import start_mock_backend
+
+
+async def run(limiter: "AdaptiveLimiter", n: int) -> int:
+    running = peak = 0
+
+    async def page(i: int):
+        nonlocal running, peak
+        await limiter.acquire_async()
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.002)
+        running -= 1
+        if i % 2:
+            # half of the slots are given back from another thread, like the sync fetchers do
+            await asyncio.to_thread(limiter.release, 0.002, 200, False)
+        else:
+            limiter.release(0.002, 200, adjust=False)
+
+    # waiters cancelled while queued (or just after their wake-up) must not swallow a slot
+    while limiter.try_acquire():
+        pass
+    cancelled = [asyncio.ensure_future(limiter.acquire_async()) for _ in range(3)]
+    await asyncio.sleep(0)
+    limiter.release(0.0, 200, adjust=False)
+    for task in cancelled:
+        task.cancel()
+    await asyncio.gather(*cancelled, return_exceptions=True)
+    for _ in range(limiter.limit - 2):
+        limiter.release(0.0, 200, adjust=False)
+    await asyncio.wait_for(asyncio.gather(*(page(i) for i in range(n))), timeout=30)
+    return peak
+
+
+def check_store_limit(scraper, state):
+    # retries without sleeping, the outcome is the same
+    scraper.backoffDelay = lambda attempt, base=0.0, cap=0.0: 0.0
+    assert scraper.worstStatus([]) == 200 and scraper.worstStatus([404]) == 200
+    assert scraper.worstStatus([404, 503, 429]) == 503 and scraper.worstStatus([429, None, 500]) is None
+    limit = scraper.STORE_LIMITER.limit
+    assert scraper.process_store_limited({"street_id": 300001}) is not None
+    assert scraper.STORE_LIMITER.limit >= limit, scraper.STORE_LIMITER.limit
+    # every page throttled: the store fails and counts as congestion
+    state.throttle_rate = 1.0
+    limit = scraper.STORE_LIMITER.limit
+    assert scraper.process_store_limited({"street_id": 300002}) is None
+    assert scraper.STORE_LIMITER.limit == max(scraper.STORE_LIMITER.min_limit, limit // 2), scraper.STORE_LIMITER.limit
+    assert scraper.STORE_LIMITER.in_flight == 0
+    return limit, scraper.STORE_LIMITER.limit
+
+
+if __name__ == "__main__":
+    server = start_mock_backend(0, products=300)
+    os.environ["ESSELUNGA_BASE_URL"] = server.base_url
+    import Esselunga_scraper as scraper
+    from Esselunga_scraper import AdaptiveLimiter
+    limiter = AdaptiveLimiter(initial=4, min_limit=4, max_limit=4)
+    # a thread holding a slot for a while
+    limiter.acquire()
+    threading.Timer(0.05, limiter.release, (0.05, 200)).start()
+    started = time.perf_counter()
+    peak = asyncio.run(run(limiter, 400))
+    assert peak <= 4, peak
+    assert limiter.in_flight == 0 and not limiter._waiters, (limiter.in_flight, len(limiter._waiters))
+    print(f"400 coroutines through a limit of 4 in {time.perf_counter() - started:.2f}s, peak {peak}")
+    before, after = check_store_limit(scraper, server.RequestHandlerClass.state)
+    print(f"throttled store: store limit {before} -> {after}")
@@ -0,0 +1,22 @@
+### page retries against benchmarks/mock_backend.py: a 200 with a truncated body is retried, not reported missing
+### usage: python benchmarks/check_page_retries.py
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from mock_backend import start_mock_backend
+
+
+if __name__ == "__main__":
+    server = start_mock_backend(0, products=1000, truncated_offsets=[99, 495])
+    os.environ["ESSELUNGA_BASE_URL"] = server.base_url
+    import Esselunga_scraper as scraper
+    state = server.RequestHandlerClass.state
+    pages = scraper.fetch_all_products({"street_id": 300000}, sz=99)
+    assert pages.missing == [], pages.missing
+    assert len(pages) == 1000, len(pages)
+    assert state.facet_offsets[99] == 2 and state.facet_offsets[495] == 2, state.facet_offsets
+    assert all(n == 1 for start, n in state.facet_offsets.items() if start not in (99, 495)), state.facet_offsets
+    print(f"truncated pages retried once each, {len(pages)} entities, coverage {pages.coverage():.0%}")
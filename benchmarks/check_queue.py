@@ -0,0 +1,48 @@
+### WorkQueue: a store whose worker stops heartbeating is handed to another worker once the lease
+### runs out, and is given up after MAX_ATTEMPTS
+### usage: python benchmarks/check_queue.py
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from Esselunga_queue import WorkQueue, Heartbeat
+
+
+if __name__ == "__main__":
+    path = os.path.join(tempfile.mkdtemp(), "queue.sqlite")
+    queue = WorkQueue(path, lease=0.3, max_attempts=2)
+    assert queue.enqueue({"s1": {"street_id": 1}, "s2": {"street_id": 2}}) == 2
+    assert queue.enqueue({"s1": {"street_id": 9}}) == 0
+    # w1 keeps s1 alive with a heartbeat, s2 is abandoned
+    claimed = dict(queue.claim("w1", 2))
+    assert claimed == {"s1": {"street_id": 1}, "s2": {"street_id": 2}} and queue.claim("w2") == []
+    with Heartbeat(queue, "w1") as heartbeat:
+        heartbeat.add("s1")
+        time.sleep(0.5)
+        assert queue.stats()["expired_leases"] == 1
+        # a second queue handle, like another worker process
+        other = WorkQueue(path, lease=0.3, max_attempts=2)
+        assert other.claim("w2", 2) == [("s2", {"street_id": 2})]
+    # the old owner can no longer complete it, the new one can
+    assert not queue.complete("s2", "w1") and other.complete("s2", "w2")
+    assert queue.complete("s1", "w1")
+    assert queue.stats() == {"done": 2, "expired_leases": 0} and queue.remaining() == 0
+    # abandoned on every attempt: failed for good
+    queue.enqueue({"s3": {}})
+    for attempt in range(2):
+        assert [key for key, _ in queue.claim(f"w{attempt}")] == ["s3"]
+        time.sleep(0.35)
+    assert queue.claim("w9") == [] and queue.stats()["failed"] == 1 and queue.remaining() == 0
+    # fail() puts a store back until max_attempts
+    queue.enqueue({"s4": {}})
+    queue.claim("w1")
+    queue.fail("s4", "w1", "boom")
+    assert queue.claim("w2") == [("s4", {})]
+    queue.fail("s4", "w2", "boom")
+    assert queue.claim("w3") == [] and queue.stats()["failed"] == 2
+    other.close()
+    queue.close()
+    print("work queue: lease reclaim, attempts and failures ok")
@@ -0,0 +1,32 @@
+### ProductRecord: the compact records give back exactly the getProductFields dicts
+### usage: python benchmarks/check_records.py
+import json
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import Esselunga_scraper as scraper
+from Esselunga_records import ProductRecord, PRODUCT_FIELDS, toRecords, toDicts, recordDefault
+from bench_records import build_entities
+
+
+if __name__ == "__main__":
+    entities = build_entities(500)
+    dicts = scraper.extract_product_info(entities)
+    records = scraper.extract_product_info(entities, True)
+    assert list(records) == list(dicts)
+    assert all(isinstance(record, ProductRecord) for record in records.values())
+    assert any(fields.get("promo") for fields in dicts.values())
+    for key, fields in dicts.items():
+        record = records[key]
+        assert record.to_dict() == fields and list(record.to_dict()) == list(fields), key
+        assert all(record.get(k) == fields.get(k) and record[k] == fields[k] for k in PRODUCT_FIELDS), key
+    assert toDicts(records) == dicts and toDicts(toRecords(dicts)) == dicts
+    assert toRecords(records)[next(iter(records))] is next(iter(records.values()))
+    assert json.loads(json.dumps(records, default=recordDefault)) == json.loads(json.dumps(dicts))
+    # prices keep their cents, unparseable promo dates are kept as they came
+    record = ProductRecord.from_fields({"id": "1", "price": "2.675", "promo": {"start": "soon", "promoType": "X"}})
+    assert record.price_cents == 268 and record.promo == {"start": "soon", "promoType": "X", "disc_price": None}
+    print(f"{len(records)} records: dict view equals getProductFields output")
@@ -0,0 +1,222 @@
+### local stand-in for the spesaonline.esselunga.it endpoints used by the scraper and the
+### discovery utilities, serving the fixtures in benchmarks/fixtures
+### usage: python benchmarks/mock_backend.py --port 8765 --latency 0.05 --error-rate 0.01 --throttle-rate 0.02
+import argparse
+import glob
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http.cookies import SimpleCookie
+from urllib.parse import urlparse, parse_qs
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def load_fixture(name: str):
+    with open(os.path.join(FIXTURES, name), "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+class MockState:
+    def __init__(self, products: int = 2000, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 throttle_rate: float = 0.0, price_lists: int = 3, seed: int = 0, truncated_offsets=()):
+        self.products = products
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.price_lists = price_lists
+        # facet offsets whose first answer is a 200 with half of the body missing
+        self.truncated_offsets = set(truncated_offsets)
+        self.random = random.Random(seed)
+        self.entities = load_fixture("facet_entities.json")
+        self.details = [load_fixture(os.path.basename(p)) for p in sorted(glob.glob(os.path.join(FIXTURES, "detail_*.json")))]
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latencies = []
+            self.status = {}
+            self.paths = {}
+            self.facet_offsets = {}
+            self.started = time.time()
+
+    def record(self, path: str, status: int, latency: float):
+        with self.lock:
+            self.latencies.append(latency)
+            self.status[status] = self.status.get(status, 0) + 1
+            self.paths[path] = self.paths.get(path, 0) + 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            latencies = sorted(self.latencies)
+            status = dict(self.status)
+            paths = dict(self.paths)
+            elapsed = time.time() - self.started
+        pct = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else 0.0
+        return {"requests": len(latencies), "elapsed": elapsed, "status": status, "paths": paths,
+                "p50": pct(0.50), "p99": pct(0.99)}
+
+    def entity(self, i: int, price_list: int) -> dict:
+        template = self.entities[i % len(self.entities)]
+        entity = dict(template)
+        entity["id"] = 100000 + i
+        entity["code"] = str(2000000 + i)
+        entity["price"] = round(template["price"] + 0.01 * price_list, 2)
+        entity["children"] = [dict(child, id=f"{100000 + i}{k}", code=f"{2000000 + i}{k}")
+                              for k, child in enumerate(template.get("children") or [])]
+        return entity
+
+    def facet(self, store: str, start: int, length: int) -> dict:
+        price_list = int(store) % self.price_lists if store.isdigit() else 0
+        end = min(self.products, start + length)
+        return {"displayables": {"rowCount": self.products,
+                                 "entities": [self.entity(i, price_list) for i in range(start, end)]}}
+
+    def trolley_store(self, store: str) -> int:
+        # neighbouring street ids (same hundred) are served by the same store, like real postcodes
+        return 200 + (int(store) // 100) % 50 if store.isdigit() else 200
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: MockState = None
+    base_url: str = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def cookies(self) -> dict:
+        cookie = SimpleCookie(self.headers.get("Cookie", ""))
+        return {k: v.value for k, v in cookie.items()}
+
+    def reply(self, status: int, body=None, content_type: str = "application/json", headers: dict = None, cookies: dict = None):
+        payload = b"" if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode("utf-8"))
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        for k, v in (cookies or {}).items():
+            self.send_header("Set-Cookie", f"{k}={v}; Path=/")
+        self.end_headers()
+        self.wfile.write(payload)
+        return status
+
+    def read_json(self) -> dict:
+        return json.loads(self.body or b"{}")
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def handle_request(self, method: str):
+        started = time.time()
+        # always consume the body, error replies must not leave it on a keep-alive connection
+        self.body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        state = self.state
+        if url.path == "/__stats":
+            self.reply(200, state.stats())
+            return
+        if url.path == "/__reset":
+            state.reset()
+            self.reply(200, {})
+            return
+        if state.latency or state.jitter:
+            time.sleep(max(0.0, state.latency + state.random.uniform(-state.jitter, state.jitter)))
+        status = self.route(method, url.path, query)
+        state.record(url.path, status, time.time() - started)
+
+    def route(self, method: str, path: str, query: dict) -> int:
+        state = self.state
+        if path.startswith("/commerce/resources/"):
+            roll = state.random.random()
+            if roll < state.throttle_rate:
+                return self.reply(429, {"error": "too many requests"})
+            if roll < state.throttle_rate + state.error_rate:
+                return self.reply(500, {"error": "internal"})
+        html = b"<html><body>ok</body></html>"
+        session = {"JSESSIONID": f"{state.random.getrandbits(64):x}", "XSRF-ECOM-TOKEN": f"{state.random.getrandbits(32):x}"}
+        if path in ("/commerce/nav/onboarding/index", "/commerce/nav/drive/store/home"):
+            return self.reply(200, html, "text/html", cookies=session)
+        if path == "/commerce/nav/supermercato/visit":
+            return self.reply(302, b"", "text/html", headers={"Location": f"{self.base_url}/commerce/nav/supermercato/store/home"},
+                              cookies={"store": query.get("streetId", "")})
+        if path == "/commerce/nav/drive/visit":
+            return self.reply(302, b"", "text/html", headers={"Location": f"{self.base_url}/commerce/nav/drive/store/home"},
+                              cookies={"store": query.get("driveId") or query.get("streetId", "")})
+        if path == "/commerce/nav/supermercato/store/home":
+            return self.reply(200, html, "text/html")
+        if path == "/commerce/resources/search/facet" and method == "POST":
+            store = self.cookies().get("store")
+            if not store:
+                return self.reply(302, b"", "text/html", headers={"Location": f"{self.base_url}/commerce/nav/onboarding/index"})
+            data = self.read_json()
+            start = int(data.get("start", 0))
+            with state.lock:
+                state.facet_offsets[start] = state.facet_offsets.get(start, 0) + 1
+                truncate = start in state.truncated_offsets
+                state.truncated_offsets.discard(start)
+            body = json.dumps(state.facet(store, start, int(data.get("length", 99)))).encode("utf-8")
+            return self.reply(200, body[:len(body) // 2] if truncate else body)
+        if path.startswith("/commerce/resources/displayable/detail/code/"):
+            code = path.rsplit("/", 1)[-1]
+            # crc32, not hash(): str hashes are salted per process and the benchmark must repeat
+            return self.reply(200, state.details[zlib.crc32(code.encode("utf-8")) % len(state.details)])
+        if path == "/commerce/resources/auth/trolley":
+            store = self.cookies().get("store")
+            if not store:
+                return self.reply(401, {"error": "unauthorized"})
+            return self.reply(200, {"storeId": state.trolley_store(store)})
+        if path.startswith("/commerce/resources/onboarding/drives/"):
+            street_id = path.rsplit("/", 1)[-1]
+            return self.reply(200, [{"id": 9000 + int(street_id) % 7, "streetId": street_id, "name": f"D{int(street_id) % 7}",
+                                     "code": "CEV", "description": "CLICCA E VAI", "postCode": "20100", "townName": "MILANO",
+                                     "streetName": "via mock", "houseNumber": "1", "mapLatitude": 45.46, "mapLongitude": 9.19}])
+        if path == "/commerce/resources/onboarding/postcode/check" and method == "POST":
+            self.read_json()
+            return self.reply(200, {"code": "SUPPORTED"})
+        if path == "/commerce/resources/onboarding/street/suggestions" and method == "POST":
+            postcode = str(self.read_json().get("postcode"))
+            return self.reply(200, [{"id": int(postcode) * 100 + k, "value": f"via mock {k} - {postcode}", "postCode": postcode,
+                                     "town": "MILANO", "name": f"via mock {k}"} for k in range(5)])
+        return self.reply(404, {"error": "not found"})
+
+
+def start_mock_backend(port: int = 0, **config) -> ThreadingHTTPServer:
+    ### runs the server on a daemon thread and returns it, server.base_url is the URL to point the scraper at
+    handler = type("Handler", (MockHandler,), {"state": MockState(**config)})
+    server = ThreadingHTTPServer(("localhost", port), handler)
+    server.daemon_threads = True
+    server.base_url = handler.base_url = f"http://localhost:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Esselunga backend")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--price-lists", type=int, default=3)
+    args = parser.parse_args()
+    server = start_mock_backend(args.port, products=args.products, latency=args.latency, jitter=args.jitter,
+                                error_rate=args.error_rate, throttle_rate=args.throttle_rate, price_lists=args.price_lists)
+    print(f"mock backend listening on {server.base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()